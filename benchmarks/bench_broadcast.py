@@ -0,0 +1,26 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Relaying a packet to every player, including writing it out to each connection."""
+
+import pyccs.server as server
+
+from run import benchmark
+from pyccs.harness import Harness
+from pyccs.protocol import Position
+from pyccs.protocol import cp7x
+
+
+@benchmark("broadcast.relay_to_all.{}_players", [10, 50, 128])
+async def relay_to_all(players):
+    harness = Harness(Position(64, 32, 64))
+    for number in range(players):
+        await harness.connect(f"bench{number}")
+    sender = harness.clients[0].player
+    packet = cp7x.PLAYER_POSITION_CHANGE.to_packet(player_id=sender.player_id, position=Position(1, 2, 3))
+
+    async def operation():
+        await server.relay_to_all(sender, packet)
+        await harness.settle()
+    return operation, harness.close
@@ -0,0 +1,53 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Packet encoding and decoding."""
+
+from run import benchmark
+from pyccs.protocol import Position, CoarseVector, FineVector
+from pyccs.protocol import cp7x
+
+SAMPLES = {
+    "PLAYER_IDENTIFICATION": dict(version=7, username="bench", mp_pass="x" * 32, cpe_byte=0),
+    "SERVER_IDENTIFICATION": dict(version=7, name="PyCCS Server", motd="benchmark", user_type=0),
+    "PING": {},
+    "INITIALIZE_LEVEL": {},
+    "LEVEL_DATA_CHUNK": dict(length=1024, data=bytes(range(256)) * 4, percent_complete=50),
+    "FINALIZE_LEVEL": dict(map_size=Position(256, 64, 256)),
+    "CLIENT_SET_BLOCK": dict(position=Position(10, 20, 30), mode=1, block_id=4),
+    "SERVER_SET_BLOCK": dict(position=Position(10, 20, 30), block_id=4),
+    "SPAWN_PLAYER": dict(player_id=5, name="bench", position=Position(10.5, 20, 30.25, 90, 45)),
+    "PLAYER_POSITION_CHANGE": dict(player_id=5, position=Position(10.5, 20, 30.25, 90, 45)),
+    "DESPAWN_PLAYER": dict(player_id=5),
+    "CHAT_MESSAGE": dict(player_id=-1, message="The quick brown fox jumps over the lazy dog"),
+    "DISCONNECT": dict(reason="Kicked"),
+    "UPDATE_MODE": dict(mode=0x64),
+}
+
+
+@benchmark("codec.to_bytes.{}", SAMPLES)
+def to_bytes(name):
+    packet = getattr(cp7x, name).to_packet(**SAMPLES[name])
+    return packet.to_bytes
+
+
+@benchmark("codec.from_bytes.{}", SAMPLES)
+def from_bytes(name):
+    info = getattr(cp7x, name)
+    data = info.to_packet(**SAMPLES[name]).to_bytes()[1:]
+
+    def operation():
+        info.to_packet().from_bytes(data)
+    return operation
+
+
+@benchmark("codec.vector.{}", ["fine.to_bytes", "fine.unpack", "coarse.to_bytes", "coarse.unpack"])
+def vectors(name):
+    kind, method = name.split(".")
+    vector = FineVector if kind == "fine" else CoarseVector
+    position = Position(100.5, 32, 200.25, 180, 90)
+    if method == "to_bytes":
+        return lambda: vector.to_bytes(position)
+    unpacked = vector.struct.unpack(vector.to_bytes(position))
+    return lambda: vector.unpack(unpacked)
@@ -0,0 +1,23 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Event dispatch."""
+
+from run import benchmark
+from pyccs.util import Event
+
+
+@benchmark("events.fire.{}_listeners", [1, 10, 100])
+def fire(listeners):
+    event = Event()
+
+    async def listener(player, packet):
+        pass
+
+    for _ in range(listeners):
+        event.connect(listener)
+
+    async def operation():
+        await event.fire(None, None)
+    return operation
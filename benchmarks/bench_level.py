@@ -0,0 +1,17 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Level compression, as done for every level sent to a joining player."""
+
+from run import benchmark
+from pyccs import mapgen, shared
+from pyccs.protocol import Position
+
+SIZES = {"64x64x64": Position(64, 64, 64), "256x64x256": Position(256, 64, 256), "512x64x512": Position(512, 64, 512)}
+
+
+@benchmark("level.compress.{}", SIZES)
+def compress(size):
+    level = mapgen.generate("terrain", SIZES[size], seed=1)
+    return lambda: shared.compress_level(level.volume, level.chunks())
@@ -0,0 +1,44 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Block reads and edits on dense and sectioned levels."""
+
+import numpy
+
+from run import benchmark
+from pyccs import mapgen
+from pyccs.protocol import Position
+
+SIZE = Position(256, 64, 256)
+
+
+def _level(storage):
+    return mapgen.generate("terrain", SIZE, seed=1, sectioned=storage == "sectioned")
+
+
+@benchmark("map.set_block.{}", ["dense", "sectioned"])
+def set_block(storage):
+    level = _level(storage)
+    positions = [Position(x, y, z) for x, y, z in numpy.random.default_rng(1).integers(0, 64, (1024, 3)).tolist()]
+    state = {"i": 0}
+
+    def operation():
+        i = state["i"] = (state["i"] + 1) & 1023
+        level.set_block(positions[i], i & 1)
+    return operation
+
+
+@benchmark("map.get_block.{}", ["dense", "sectioned"])
+def get_block(storage):
+    level = _level(storage)
+    position = Position(100, 20, 100)
+    return lambda: level.get_block(position)
+
+
+@benchmark("map.set_blocks_10000.{}", ["dense", "sectioned"])
+def set_blocks(storage):
+    level = _level(storage)
+    indices = numpy.random.default_rng(1).choice(level.volume, 10000, replace=False)
+    blocks = numpy.ones(10000, dtype=numpy.uint8)
+    return lambda: level.set_blocks(indices, blocks)
@@ -0,0 +1,150 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Runs the microbenchmarks in this directory and stores the results as JSON.
+
+Benchmarks live in bench_*.py files, as functions decorated with `benchmark`. Each is called once per parameter and
+returns the operation to time, a function or a coroutine function taking no arguments, or the operation and a
+teardown of the same kind, which is called once the operation was timed. Every operation is repeated
+until a run takes at least `MIN_TIME`, and the best and median time per operation over `REPEAT` runs are reported.
+
+    python benchmarks/run.py                        # run everything, write results/<revision>.json
+    python benchmarks/run.py -k codec               # only benchmarks with codec in their name
+    python benchmarks/run.py --compare old.json     # also fail if anything got over 10% slower
+"""
+
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+MIN_TIME = 0.2
+"""Seconds each timed run should at least take."""
+REPEAT = 5
+"""Timed runs per benchmark."""
+
+_benchmarks = []
+
+
+def benchmark(name: str, params=(None,)):
+    """Register a benchmark. *name* may contain {} which is replaced with each of *params*."""
+    def inner(func):
+        for param in params:
+            _benchmarks.append((name.format(param), func, param))
+        return func
+    return inner
+
+
+def _time_sync(operation, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        operation()
+    return time.perf_counter() - started
+
+
+async def _time_async(operation, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        await operation()
+    return time.perf_counter() - started
+
+
+def _measure(operation, loop: asyncio.AbstractEventLoop) -> dict:
+    if asyncio.iscoroutinefunction(operation):
+        def run(number):
+            return loop.run_until_complete(_time_async(operation, number))
+    else:
+        def run(number):
+            return _time_sync(operation, number)
+    number = 1
+    while (elapsed := run(number)) < MIN_TIME:
+        number *= 2 if elapsed == 0 else max(2, min(int(MIN_TIME / elapsed * 1.2) + 1, 100))
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        times = [run(number) / number for _ in range(REPEAT)]
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return {"number": number, "best": min(times), "median": statistics.median(times), "times": times}
+
+
+def _revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=HERE, timeout=5).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def _compare(results: dict, old_file: str, threshold: float) -> bool:
+    with open(old_file) as file:
+        old = json.load(file)["results"]
+    ok = True
+    for name, result in results.items():
+        if name not in old:
+            continue
+        ratio = result["best"] / old[name]["best"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{name:50} {ratio:6.2f}x{flag}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the PyCCS microbenchmarks")
+    parser.add_argument("-k", dest="filter", help="Only run benchmarks whose name contains this")
+    parser.add_argument("-o", "--output", help="File to write results to, defaults to results/<revision>.json")
+    parser.add_argument("--compare", metavar="FILE", help="Results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown counted as a regression")
+    options = parser.parse_args(argv)
+    for file_name in sorted(os.listdir(HERE)):
+        if file_name.startswith("bench_") and file_name.endswith(".py"):
+            importlib.import_module(file_name[:-3])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = {}
+    for name, func, param in _benchmarks:
+        if options.filter and options.filter not in name:
+            continue
+        operation = func() if param is None else func(param)
+        if asyncio.iscoroutine(operation):
+            operation = loop.run_until_complete(operation)
+        operation, teardown = operation if isinstance(operation, tuple) else (operation, None)
+        results[name] = _measure(operation, loop)
+        if teardown and asyncio.iscoroutine(done := teardown()):
+            loop.run_until_complete(done)
+        print(f"{name:50} {results[name]['best'] * 1000000:12.2f}us")
+    revision = _revision()
+    report = {
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    output = options.output or os.path.join(HERE, "results", f"{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"Wrote {output}")
+    if options.compare and not _compare(results, options.compare, options.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.modules.setdefault("run", sys.modules["__main__"])
+    main(sys.argv[1:])
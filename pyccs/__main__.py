@@ -1,4 +1,9 @@
+import atexit
+import cProfile
+import importlib
+import io
 import logging
+import pstats
 import signal
 import argparse
 import inspect
@@ -7,12 +12,20 @@ import asyncio
 import pyccs.server as server
 
 from datetime import datetime
-from pyccs.util import Configuration
+from pyccs.util import Configuration, wrap_coroutine
 from pyccs.constants import VERSION
-
-import pyccs.protocol.cp7x as BasePlug
+from pyccs import (admission, capture, cluster, entities, heartbeat, keepalive, logqueue, mapgen, metrics, profiles,
+                   ratelimit, shared, watchdog)
 
 version = str(VERSION)
+PLUGINS = [
+    "pyccs.protocol.cp7x",
+    "pyccs.plugin.main",
+    # "pyccs.plugin.livewire",
+    "pyccs.plugin.autocracy",
+    "pyccs.plugin.protection",
+]
+"""Modules of the plugins the server runs, only imported by the process which runs them."""
 
 
 parser = argparse.ArgumentParser(prog="pyccs",
@@ -22,6 +35,61 @@ parser.add_argument("-n", "--name", dest="name", type=str, help="Name of the ser
 parser.add_argument("-l", "--level", dest="main_level", type=str, help="What level the server should use")
 parser.add_argument("-P", "--port", dest="port", type=int, help="The port the server will listen on")
 parser.add_argument("-p", "--players", dest="max_players", type=int, help="Maximum number of players")
+parser.add_argument("-g", "--generate", dest="generator", type=str, choices=mapgen.GENERATORS,
+                    help="Generates a new level instead of loading one, saved to the level file if it does not exist")
+parser.add_argument("--size", dest="size", type=mapgen.parse_size, default="256x64x256",
+                    help="Size of a generated level, as XxYxZ")
+parser.add_argument("--seed", dest="seed", type=int, help="Seed for the level generator")
+parser.add_argument("--sectioned", dest="sectioned", action="store_true",
+                    help="Stores levels in sparse sections, for very large levels")
+parser.add_argument("--history-memory", dest="history_memory", type=int,
+                    help="Megabytes of memory used to record block edits for undo, 0 disables it")
+parser.add_argument("--history-spill", dest="history_spill", type=str,
+                    help="File block edits are written to once they no longer fit in memory")
+parser.add_argument("--levels", dest="levels", nargs="+", default=[], metavar="NAME=FILE",
+                    help="Extra levels to host, players can move between them with /goto")
+parser.add_argument("-w", "--workers", dest="workers", type=int, default=0,
+                    help="Runs levels in this many worker processes behind a front-end process")
+parser.add_argument("--level-helpers", dest="level_helpers", type=int, default=0,
+                    help="Keeps levels in shared memory and compresses and saves them in this many helper processes")
+parser.add_argument("--metrics-port", dest="metrics_port", type=int,
+                    help="Serves Prometheus metrics on this local port, workers use the following ports")
+parser.add_argument("--metrics-listeners", dest="metrics_listeners", action="store_true",
+                    help="Also time every event listener on its own, slower but shows which listener is slow")
+parser.add_argument("--watchdog", dest="watchdog", type=int, metavar="MS",
+                    help="Logs what is blocking the event loop whenever it stalls for longer than this")
+parser.add_argument("--watchdog-debug", dest="watchdog_debug", action="store_true",
+                    help="Also turns on asyncio debug mode, which logs every slow callback but is slower")
+parser.add_argument("--capture", dest="capture", type=str, metavar="FILE",
+                    help="Records player traffic to this file, replay it with python -m pyccs.replay")
+parser.add_argument("--capture-outgoing", dest="capture_outgoing", action="store_true",
+                    help="Also records traffic sent to players")
+parser.add_argument("--max-connections", dest="max_connections", type=int,
+                    help="Connections which may be open at once, including ones still joining")
+parser.add_argument("--max-per-ip", dest="max_per_ip", type=int,
+                    help="Connections which may be open at once from one address, loopback is exempt")
+parser.add_argument("--handshake-timeout", dest="handshake_timeout", type=float, metavar="SECONDS",
+                    help="Time new connections have to identify themselves")
+parser.add_argument("--ping-interval", dest="ping_interval", type=float, default=5.0, metavar="SECONDS",
+                    help="Time between pings to each player, 0 disables pings and idle checks")
+parser.add_argument("--idle-timeout", dest="idle_timeout", type=float, default=60.0, metavar="SECONDS",
+                    help="Remove players which sent nothing for this long")
+parser.add_argument("--rate-limit", dest="rate_limits", action="append", type=ratelimit.parse_rule, default=[],
+                    metavar="ID=RATE/BURST:ACTION", help="Limit a packet ID to RATE a second per player, taking "
+                    f"ACTION ({', '.join(ratelimit.ACTIONS)}) on packets over it, like 0x0d=3/10:kick")
+parser.add_argument("--no-rate-limits", dest="no_rate_limits", action="store_true",
+                    help="Handle every packet from players however fast they arrive")
+parser.add_argument("--max-speed", dest="max_speed", type=float, metavar="BLOCKS",
+                    help="Move players back which move more than this many blocks a second, 20 allows some speed hacks")
+parser.add_argument("--profiles", dest="profiles", nargs="?", const="profiles.db", metavar="FILE",
+                    help="Keep player profiles between sessions, in profiles.db unless FILE is given")
+parser.add_argument("--heartbeat", dest="heartbeat", nargs="?", const=heartbeat.CLASSICUBE, metavar="URL",
+                    help="Send heartbeats to a server list, ClassiCube's unless URL is given")
+parser.add_argument("--private", dest="public", action="store_false",
+                    help="Keep the server off the public server list")
+parser.add_argument("--profile-startup", dest="profile_startup", nargs="?", const="", metavar="FILE",
+                    help="Log where the time went until the server accepted connections, and write the profile to "
+                         "FILE if given")
 parser.add_argument("--no-verify", dest="verify_names", action="store_const", help="Disables name verification",
                     const=False)
 parser.add_argument("-v", "--verbose", dest="debug_level", action="store_const",
@@ -33,32 +101,95 @@ def setup_logger():
     logger.propagate = False
     logger.setLevel(logging.DEBUG)
     os.makedirs(os.path.dirname("./logs/"), exist_ok=True)
-    fh = logging.FileHandler(f'./logs/{datetime.now().strftime("%Y.%m.%d-%H.%M.%S")}.log')
+    fh = logqueue.BatchedFileHandler(f'./logs/{datetime.now().strftime("%Y.%m.%d-%H.%M.%S")}.log')
     fh.setLevel(logging.DEBUG)
     ch = logging.StreamHandler()
     ch.setLevel(args.debug_level)
     formatter = logging.Formatter('[{asctime}-{name}/{levelname}] {message}', style="{")
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    logqueue.start(logger, [fh, ch])
+    atexit.register(logqueue.stop)
     return logger
 
 
+def setup_admission():
+    for option in ("max_connections", "max_per_ip", "handshake_timeout"):
+        if getattr(args, option) is not None:
+            setattr(admission.limits, option, getattr(args, option))
+
+
+def setup_plugins():
+    for module_name in PLUGINS:
+        module = importlib.import_module(module_name)
+        server.add_plugin(module)
+        module.PLUGIN.config.set_file(f"./plugins/{module.PLUGIN.name}.json")
+    server.protocol = importlib.import_module("pyccs.protocol.cp7x").PARSEABLES
+
+
+def profile_startup(profiler: cProfile.Profile):
+    async def report():
+        profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(25)
+        server.logger.info(f"Startup profile:\n{output.getvalue()}")
+        if args.profile_startup:
+            profiler.dump_stats(args.profile_startup)
+
+    server.starting.connect(report)
+
+
 def setup_signals():
     signal.signal(signal.SIGINT, server.stop)
     signal.signal(signal.SIGTERM, server.stop)
 
 
+def setup_level():
+    if args.port:
+        server.port(args.port)
+    if args.main_level:
+        server.level_file = args.main_level
+    server.sectioned_levels = args.sectioned
+    if args.history_memory is not None:
+        server.history_memory = args.history_memory * 1024 * 1024
+    server.history_spill = args.history_spill
+    server.metrics_port = args.metrics_port
+    metrics.time_listeners = args.metrics_listeners
+    if args.generator:
+        server.logger.info(f"Generating {args.generator} level of size {args.size}")
+        server.main_level = mapgen.generate(args.generator, args.size, args.seed, args.sectioned)
+        if os.path.exists(server.level_file):
+            server.logger.warning(f"{server.level_file} already exists, the generated level will not be saved")
+        else:
+            server.main_level.save(server.level_file)
+
+
+def setup_levels():
+    for entry in args.levels:
+        level_name, _, file_name = entry.partition("=")
+        if not file_name:
+            parser.error(f"Expected NAME=FILE, got '{entry}'")
+        server.level_files[level_name] = file_name
+
+
 def build_config():
-    defaults = {}
+    defaults = {"name": server.name, "max_players": server.max_players}
     configuration = Configuration(defaults)
     configuration.set_file("./pyccs.json")
     return configuration
 
 
+def apply_config():
+    """Take on the settings which can change while the server runs."""
+    server.name = config.get("name")
+    server.max_players = config.get("max_players")
+
+
 if __name__ == "__main__":
     args = parser.parse_args()
+    profiler = cProfile.Profile() if args.profile_startup is not None else None
+    if profiler:
+        profiler.enable()
     config = build_config()
     args_override = {
         "name": args.name,
@@ -68,14 +199,49 @@ if __name__ == "__main__":
         "max_players": args.max_players,
         # "verify_names": args.verify_names
     }
-    server.protocol = BasePlug.PARSEABLES
     server.logger = setup_logger()
-    config.merge(args_override, ignore_none=True)
-    server.add_plugin(BasePlug)
-    #  server.add_plugin(LiveWire)
-    #  server.add_plugin(Autocracy)
+    config.override(args_override, ignore_none=True)
+    apply_config()
+    config.changed.connect(wrap_coroutine(apply_config))
+    server.starting.connect(wrap_coroutine(config.start_watching))
+    server.shutdown.connect(config.close)
+    setup_level()
+    setup_levels()
+    setup_admission()
     setup_signals()
+    rate_limits = None if args.no_rate_limits else {**ratelimit.DEFAULT_RULES, **dict(args.rate_limits)}
     try:
-        server.start()
+        if args.workers:
+            cluster.run({"main": server.level_file, **server.level_files}, args.workers,
+                         {"log_level": args.debug_level, "level_helpers": args.level_helpers,
+                          "metrics_port": args.metrics_port,
+                          "metrics_listeners": args.metrics_listeners, "watchdog": args.watchdog,
+                          "watchdog_debug": args.watchdog_debug, "capture": args.capture,
+                          "capture_outgoing": args.capture_outgoing, "max_connections": args.max_connections,
+                          "max_per_ip": args.max_per_ip, "handshake_timeout": args.handshake_timeout,
+                          "ping_interval": args.ping_interval, "idle_timeout": args.idle_timeout,
+                          "rate_limits": rate_limits, "max_speed": args.max_speed,
+                          "profiles": args.profiles, "plugins": PLUGINS})
+        else:
+            if args.level_helpers:
+                shared.enable(args.level_helpers)
+            if args.watchdog:
+                watchdog.enable(args.watchdog / 1000, args.watchdog_debug)
+            if args.capture:
+                capture.enable(args.capture, args.capture_outgoing)
+            if args.ping_interval:
+                keepalive.enable(args.ping_interval, args.idle_timeout)
+            if rate_limits:
+                ratelimit.enable(rate_limits)
+            if args.max_speed:
+                entities.enable(args.max_speed)
+            if args.profiles:
+                profiles.enable(args.profiles)
+            if args.heartbeat:
+                heartbeat.enable(args.heartbeat, args.public)
+            setup_plugins()
+            if profiler:
+                profile_startup(profiler)
+            server.start()
     except KeyboardInterrupt:
         server.stop()
\ No newline at end of file
@@ -0,0 +1,176 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Persistent operator and ban lists.
+
+An AccessStore keeps operators and bans in a SQLite database, and everything needed to check a joining player in
+memory: operator names and bans in hash tables, and banned IP networks by network address, per prefix length.
+Checking a player is a handful of lookups however many bans there are, one per distinct prefix length in use.
+
+Changes update memory right away and are written to the database one row at a time on a single background thread,
+so the event loop never waits for the disk and the database is never rewritten as a whole. Processes sharing the
+database call `reload` to see each other's changes."""
+
+import asyncio
+import ipaddress
+import sqlite3
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+import pyccs.server as server
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS operators (name TEXT PRIMARY KEY, added_by TEXT, added_at REAL);
+CREATE TABLE IF NOT EXISTS bans (target TEXT PRIMARY KEY, reason TEXT, added_by TEXT, added_at REAL);
+"""
+
+
+class Ban(NamedTuple):
+    target: str
+    """Banned name, or IP network in CIDR notation."""
+    reason: str
+    added_by: str
+    added_at: float
+
+
+def parse_network(target: str) -> Optional[Network]:
+    """Return *target* as an IP network if it is an address or CIDR range, otherwise None."""
+    if "." not in target and ":" not in target:
+        return None
+    try:
+        return ipaddress.ip_network(target, strict=False)
+    except ValueError:
+        return None
+
+
+class AccessStore:
+    """Operators and bans stored in the SQLite database *file_name*. Names are matched case-insensitively."""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.operators: Set[str] = set()
+        self.bans: Dict[str, Ban] = {}
+        """Every ban by its normalized target."""
+        self._networks: Dict[Tuple[int, int], Dict[int, str]] = {}
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="access-store")
+        self._db = sqlite3.connect(file_name, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._load(*self._read())
+
+    def _read(self) -> Tuple[Set[str], List[Ban]]:
+        operators = {name for name, in self._db.execute("SELECT name FROM operators")}
+        return operators, [Ban(*row) for row in self._db.execute("SELECT target, reason, added_by, added_at FROM bans")]
+
+    def _load(self, operators: Set[str], bans: List[Ban]):
+        self.operators = operators
+        self.bans = {}
+        self._networks = {}
+        for ban in bans:
+            self._add_ban(ban)
+
+    def __len__(self):
+        return len(self.bans)
+
+    @staticmethod
+    def _key(target: str) -> str:
+        network = parse_network(target)
+        return str(network) if network else target.lower()
+
+    def _add_ban(self, ban: Ban):
+        self.bans[ban.target] = ban
+        if network := parse_network(ban.target):
+            key = (network.version, network.prefixlen)
+            self._networks.setdefault(key, {})[int(network.network_address)] = ban.target
+
+    def _write(self, statement: str, parameters: tuple):
+        self._writer.submit(self._db.execute, statement, parameters).add_done_callback(self._written)
+
+    def _written(self, future: Future):
+        if error := future.exception():
+            server.logger.error(f"Could not write to {self.file_name}", exc_info=error)
+
+    def is_operator(self, name: str) -> bool:
+        return name.lower() in self.operators
+
+    def is_banned(self, name: Optional[str] = None, ip: Optional[str] = None) -> Optional[Ban]:
+        """Return the ban matching *name* or *ip*, if there is one."""
+        if name and (ban := self.bans.get(name.lower(), None)):
+            return ban
+        if ip and self._networks:
+            try:
+                address = ipaddress.ip_address(ip)
+            except ValueError:
+                return None
+            bits = address.max_prefixlen
+            value = int(address)
+            for (version, prefix), networks in self._networks.items():
+                if version == address.version:
+                    host_bits = bits - prefix
+                    if target := networks.get(value >> host_bits << host_bits, None):
+                        return self.bans[target]
+        return None
+
+    def add_operator(self, name: str, added_by: str = ""):
+        name = name.lower()
+        if name not in self.operators:
+            self.operators.add(name)
+            self._write("INSERT OR REPLACE INTO operators VALUES (?, ?, ?)", (name, added_by, time.time()))
+
+    def remove_operator(self, name: str) -> bool:
+        name = name.lower()
+        if name not in self.operators:
+            return False
+        self.operators.discard(name)
+        self._write("DELETE FROM operators WHERE name = ?", (name,))
+        return True
+
+    def ban(self, target: str, reason: str = "", added_by: str = "") -> Ban:
+        """Ban a name, IP address or CIDR range."""
+        ban = Ban(self._key(target), reason, added_by, time.time())
+        self._add_ban(ban)
+        self._write("INSERT OR REPLACE INTO bans VALUES (?, ?, ?, ?)", tuple(ban))
+        return ban
+
+    def unban(self, target: str) -> bool:
+        key = self._key(target)
+        if not self.bans.pop(key, None):
+            return False
+        if network := parse_network(key):
+            networks = self._networks[(network.version, network.prefixlen)]
+            del networks[int(network.network_address)]
+            if not networks:
+                del self._networks[(network.version, network.prefixlen)]
+        self._write("DELETE FROM bans WHERE target = ?", (key,))
+        return True
+
+    def import_lists(self, operators: Iterable[str], bans: Iterable[str]):
+        """Add operators and bans kept elsewhere, in one transaction. Only call this before the server starts."""
+        operators = [name.lower() for name in operators if name.lower() not in self.operators]
+        bans = [Ban(self._key(target), "", "", time.time()) for target in bans if self._key(target) not in self.bans]
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO operators VALUES (?, '', ?)",
+                                 [(name, time.time()) for name in operators])
+            self._db.executemany("INSERT OR REPLACE INTO bans VALUES (?, ?, ?, ?)", bans)
+        self.operators.update(operators)
+        for ban in bans:
+            self._add_ban(ban)
+
+    async def flush(self):
+        """Wait until every change made so far is written."""
+        await asyncio.wrap_future(self._writer.submit(lambda: None))
+
+    async def reload(self):
+        """Read every operator and ban again, to pick up changes made by other processes."""
+        self._load(*await asyncio.wrap_future(self._writer.submit(self._read)))
+
+    async def close(self):
+        """Wait for pending writes and close the database."""
+        await asyncio.wrap_future(self._writer.submit(self._db.close))
+        self._writer.shutdown()
@@ -0,0 +1,105 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Admission control for new connections, checked before the server allocates anything for them.
+
+A connection is turned away with a disconnect packet if its address opened too many connections recently, if too
+many connections were opened recently overall, or if its address or the whole server has too many connections open.
+Accepted connections must send the player identification packet within `handshake_timeout` seconds.
+
+Accept rates are counted in fixed windows, which keeps the bookkeeping to one counter per address seen in the
+current window. Loopback addresses are exempt from the per-address limits, so load tests and proxies on the same
+machine keep working."""
+
+import time
+
+from typing import Dict, Optional
+
+from pyccs import metrics
+
+_ACCEPTED = metrics.Counter("pyccs_connections_accepted_total", "Connections admitted")
+_REJECTED = metrics.Counter("pyccs_connections_rejected_total", "Connections turned away", ["reason"])
+
+
+def disconnect_packet(reason: str) -> bytes:
+    """Encoded disconnect packet with *reason*, for connections which never got a Player."""
+    return b"\x0e" + bytes(reason[:64].ljust(64), encoding="ascii", errors="replace")
+
+
+class Admission:
+    """Connection limits. *ip_rate* connections per address and *rate* connections overall may be opened every
+    *window* seconds, and at most *max_per_ip* per address and *max_connections* overall may be open at once."""
+
+    def __init__(self, max_connections: int = 256, max_per_ip: int = 5, rate: int = 200, ip_rate: int = 10,
+                 window: float = 10.0, handshake_timeout: float = 10.0, exempt=("127.0.0.1", "::1")):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.rate = rate
+        self.ip_rate = ip_rate
+        self.window = window
+        self.handshake_timeout = handshake_timeout
+        """Seconds a new connection has to send the player identification packet."""
+        self.exempt = set(exempt)
+        """Addresses the per-address limits do not apply to."""
+        self.open = 0
+        """Connections open right now."""
+        self.rejected = 0
+        self._open_by_ip: Dict[str, int] = {}
+        self._window_started = 0.0
+        self._window_total = 0
+        self._window_by_ip: Dict[str, int] = {}
+
+    def _reject(self, reason: str) -> str:
+        self.rejected += 1
+        _REJECTED.inc(reason)
+        return reason
+
+    def check_rate(self, ip: str) -> Optional[str]:
+        """Count a connection from *ip*, return why it should be turned away if it is over a rate limit."""
+        now = time.monotonic()
+        if now - self._window_started >= self.window:
+            self._window_started = now
+            self._window_total = 0
+            self._window_by_ip.clear()
+        self._window_total += 1
+        if self._window_total > self.rate:
+            return self._reject("Server is busy, try again later")
+        if ip not in self.exempt:
+            count = self._window_by_ip[ip] = self._window_by_ip.get(ip, 0) + 1
+            if count > self.ip_rate:
+                return self._reject("Too many connections, slow down")
+        return None
+
+    def admit(self, ip: str) -> Optional[str]:
+        """Admit a connection from *ip*, or return why it should be turned away. Admitted connections must be
+        released once they close."""
+        if reason := self.check_rate(ip):
+            return reason
+        if self.open >= self.max_connections:
+            return self._reject("Server is full")
+        if ip not in self.exempt:
+            if self._open_by_ip.get(ip, 0) >= self.max_per_ip:
+                return self._reject("Too many connections from your address")
+            self._open_by_ip[ip] = self._open_by_ip.get(ip, 0) + 1
+        self.open += 1
+        _ACCEPTED.inc()
+        return None
+
+    def release(self, ip: str):
+        self.open -= 1
+        if ip in self._open_by_ip:
+            if self._open_by_ip[ip] <= 1:
+                del self._open_by_ip[ip]
+            else:
+                self._open_by_ip[ip] -= 1
+
+    def timed_out(self):
+        _REJECTED.inc("Handshake timed out")
+        self.rejected += 1
+
+
+limits = Admission()
+"""Limits applied to every connection the server accepts."""
+metrics.Gauge("pyccs_connections_open", "Connections open, including ones still handshaking",
+              function=lambda: limits.open)
@@ -0,0 +1,147 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Recording of raw player traffic to compact binary capture files.
+
+A capture file starts with `MAGIC` and is followed by records, each a `RECORD` header (kind, connection, time in
+microseconds since the capture started, payload length) and its payload. Connections are numbered in the order they
+were opened. Open records carry the peer address, frame records carry the raw bytes of one or more packets.
+
+The Recorder buffers records in memory and writes them from the default executor, one write at a time. If the disk
+falls behind by more than `max_buffer` bytes, frames are dropped and counted instead of slowing the server down.
+
+Captures are replayed with `python -m pyccs.replay`."""
+
+import asyncio
+import struct
+import time
+
+from typing import Dict, Iterator, NamedTuple, Optional
+
+import pyccs.server as server
+
+MAGIC = b"PYCCSCAP\x01"
+"""Start of every capture file, the last byte is the format version."""
+RECORD = struct.Struct("!BIQI")
+"""Header of each record: kind, connection number, microseconds since the capture started and payload length."""
+
+OPEN = 0
+"""Kind of record marking a new connection, the payload is the peer address."""
+INCOMING = 1
+"""Kind of record holding bytes received from a player."""
+OUTGOING = 2
+"""Kind of record holding bytes sent to a player."""
+CLOSE = 3
+"""Kind of record marking a closed connection."""
+
+recorder: Optional["Recorder"] = None
+"""The running Recorder, if capturing is enabled."""
+
+
+class Record(NamedTuple):
+    kind: int
+    connection: int
+    time: float
+    data: bytes
+
+
+class Recorder:
+    """Writes player traffic to a capture file. Outgoing traffic is only kept if *outgoing* is true, replays only
+    need what players sent."""
+
+    def __init__(self, file_name: str, outgoing: bool = False, max_buffer: int = 8 * 1024 * 1024,
+                 flush_size: int = 64 * 1024):
+        self.file_name = file_name
+        self.outgoing_enabled = outgoing
+        self.max_buffer = max_buffer
+        self.flush_size = flush_size
+        self.dropped = 0
+        """Number of records dropped because the disk could not keep up."""
+        self._file = open(file_name, "wb")
+        self._file.write(MAGIC)
+        self._started = time.perf_counter()
+        self._buffer = bytearray()
+        self._writing: Optional[asyncio.Future] = None
+        self._connections: Dict[object, int] = {}
+        self._next_connection = 0
+
+    def _record(self, kind: int, connection: int, data: bytes):
+        if len(self._buffer) > self.max_buffer:
+            self.dropped += 1
+            return
+        elapsed = int((time.perf_counter() - self._started) * 1000000)
+        self._buffer += RECORD.pack(kind, connection, elapsed, len(data))
+        self._buffer += data
+        if len(self._buffer) >= self.flush_size and not self._writing:
+            self._flush()
+
+    def _flush(self):
+        data, self._buffer = self._buffer, bytearray()
+        self._writing = asyncio.get_running_loop().run_in_executor(None, self._file.write, data)
+        self._writing.add_done_callback(self._written)
+
+    def _written(self, future: asyncio.Future):
+        self._writing = None
+        if len(self._buffer) >= self.flush_size:
+            self._flush()
+
+    def open(self, player, peer: str):
+        connection = self._connections[player] = self._next_connection
+        self._next_connection += 1
+        self._record(OPEN, connection, peer.encode("utf-8"))
+
+    def incoming(self, player, data: bytes):
+        if (connection := self._connections.get(player, None)) is not None:
+            self._record(INCOMING, connection, data)
+
+    def outgoing(self, player, data: bytes):
+        if self.outgoing_enabled and (connection := self._connections.get(player, None)) is not None:
+            self._record(OUTGOING, connection, data)
+
+    def close(self, player):
+        if (connection := self._connections.pop(player, None)) is not None:
+            self._record(CLOSE, connection, b"")
+
+    async def stop(self):
+        """Write out everything buffered and close the file."""
+        if self._writing:
+            await self._writing
+        if self._buffer:
+            self._file.write(self._buffer)
+        self._file.close()
+        if self.dropped:
+            server.logger.warning(f"Dropped {self.dropped} records from {self.file_name}, the disk was too slow")
+
+
+def read_capture(file_name: str) -> Iterator[Record]:
+    """Yield every record in a capture file, in the order they were recorded."""
+    with open(file_name, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file_name} is not a PyCCS capture file")
+        while header := file.read(RECORD.size):
+            if len(header) < RECORD.size:
+                return
+            kind, connection, elapsed, length = RECORD.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield Record(kind, connection, elapsed / 1000000, data)
+
+
+def enable(file_name: str, outgoing: bool = False):
+    """Record player traffic to *file_name* while the server is running."""
+
+    async def start():
+        global recorder
+        recorder = Recorder(file_name, outgoing)
+        server.logger.info(f"Capturing player traffic to {file_name}")
+
+    async def stop():
+        global recorder
+        if recorder:
+            running, recorder = recorder, None
+            await running.stop()
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
@@ -0,0 +1,424 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""This module runs PyCCS as several processes, so a multi-level server can use more than one core.
+
+A front-end process accepts connections and reads the player identification packet, then hands the socket itself to
+the worker process which hosts the level the player is going to. Workers are ordinary PyCCS servers without a
+listening socket. Front-end and workers talk over SOCK_SEQPACKET Unix sockets, one JSON message per packet, with
+sockets attached as SCM_RIGHTS. When a player moves to a level hosted elsewhere, their worker sends the socket back
+to the front-end, which forwards it to the new worker. This only works on platforms with Unix sockets."""
+
+import array
+import asyncio
+import base64
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import pyccs.server as server
+from pyccs import admission, metrics
+
+MAX_MESSAGE = 65536
+"""Largest control message in bytes."""
+PLUGINS = ("pyccs.protocol.cp7x", "pyccs.plugin.main")
+"""Plugin modules workers run unless the "plugins" option lists others, cp7x must be one of them."""
+IDENTIFICATION_SIZE = 131
+"""Size of the player identification packet, including its ID."""
+
+worker: Optional["Worker"] = None
+"""The Worker this process is running as, if it is a worker process."""
+_listeners: Dict[str, Callable[[dict], Awaitable]] = {}
+
+
+async def _wait_for(add, remove, sock: socket.socket):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    add(sock.fileno(), future.set_result, None)
+    try:
+        await future
+    finally:
+        remove(sock.fileno())
+
+
+async def send_message(sock: socket.socket, message: dict, fd: int = None):
+    """Send one control message, optionally passing the file descriptor *fd* along with it."""
+    loop = asyncio.get_running_loop()
+    data = json.dumps(message).encode("utf-8")
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))] if fd is not None else []
+    while True:
+        try:
+            sock.sendmsg([data], ancillary)
+            return
+        except BlockingIOError:
+            await _wait_for(loop.add_writer, loop.remove_writer, sock)
+
+
+async def receive_message(sock: socket.socket):
+    """Receive one control message, returns it with the file descriptor passed with it or None. Returns (None, None)
+    once the other end has closed."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            data, ancillary, _, _ = sock.recvmsg(MAX_MESSAGE, socket.CMSG_LEN(array.array("i").itemsize))
+            break
+        except BlockingIOError:
+            await _wait_for(loop.add_reader, loop.remove_reader, sock)
+    if not data:
+        return None, None
+    fd = None
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds = array.array("i")
+            fds.frombytes(payload[:len(payload) - (len(payload) % fds.itemsize)])
+            fd = fds[0]
+    return json.loads(data), fd
+
+
+def _encode(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def _decode(data: str) -> bytes:
+    return base64.b64decode(data)
+
+
+def _disconnect_packet(reason: str) -> bytes:
+    return b"\x0e" + bytes(reason[:64].ljust(64), encoding="ascii")
+
+
+class Frontend:
+    """Accepts connections and routes them to the worker hosting the level each player is on."""
+
+    def __init__(self, level_files: Dict[str, str], workers: int, options: dict):
+        self.level_files = level_files
+        self.worker_count = max(1, min(workers, len(level_files)))
+        self.options = options
+        self.owners: Dict[str, str] = {}
+        """Name of the worker hosting each level."""
+        self.last_level: Dict[str, str] = {}
+        """Level each player was last on, by name, new connections are routed back to it."""
+        self._workers: Dict[str, socket.socket] = {}
+        self._control: Optional[socket.socket] = None
+        self._processes: List[multiprocessing.Process] = []
+        self._directory = tempfile.mkdtemp(prefix="pyccs-")
+        self._control_path = os.path.join(self._directory, "control")
+
+    def _assignments(self) -> Dict[str, Dict[str, str]]:
+        assignments = {f"worker-{i}": {} for i in range(self.worker_count)}
+        for i, (level_name, file_name) in enumerate(self.level_files.items()):
+            assignments[f"worker-{i % self.worker_count}"][level_name] = file_name
+        return assignments
+
+    def start_workers(self):
+        """Open the control socket and start the worker processes. Call this before starting the event loop."""
+        self._control = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._control.bind(self._control_path)
+        self._control.listen()
+        self._control.setblocking(False)
+        for i, (worker_name, levels) in enumerate(self._assignments().items()):
+            options = dict(self.options)
+            if options.get("metrics_port", None):
+                options["metrics_port"] += i
+            # Workers are not daemonic so they can start level helper processes, run() stops them instead.
+            process = multiprocessing.Process(target=_worker_main, name=worker_name,
+                                              args=(worker_name, self._control_path, levels,
+                                                    list(self.level_files), options))
+            process.start()
+            self._processes.append(process)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while len(self._workers) < len(self._processes):
+            try:
+                connection, _ = await asyncio.wait_for(loop.sock_accept(self._control), 1)
+            except asyncio.TimeoutError:
+                if not all(process.is_alive() for process in self._processes):
+                    raise RuntimeError("A worker process exited while starting")
+                continue
+            connection.setblocking(False)
+            hello, _ = await receive_message(connection)
+            self._workers[hello["worker"]] = connection
+            for level_name in hello["levels"]:
+                self.owners[level_name] = hello["worker"]
+            asyncio.create_task(self._listen(hello["worker"], connection))
+            server.logger.info(f"{hello['worker']} is hosting {', '.join(hello['levels'])}")
+        tcp_server = await asyncio.start_server(self._accept, host=server.ip(), port=server.port())
+        server.logger.info(f"Accepting connections on {server.ip()}:{server.port()}")
+        while server.running():
+            await asyncio.sleep(1)
+        tcp_server.close()
+        await tcp_server.wait_closed()
+        for connection in list(self._workers.values()):
+            await send_message(connection, {"type": "stop"})
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        self._control.close()
+        os.unlink(self._control_path)
+        os.rmdir(self._directory)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if reason := admission.limits.check_rate(writer.get_extra_info("peername")[0]):
+            writer.write(_disconnect_packet(reason))
+            writer.close()
+            return
+        try:
+            prelude = await asyncio.wait_for(reader.readexactly(IDENTIFICATION_SIZE),
+                                             admission.limits.handshake_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        if prelude[0] != 0x00:
+            writer.write(_disconnect_packet("Expected player identification"))
+            writer.close()
+            return
+        name = str(prelude[2:66], encoding="ascii", errors="replace").rstrip()
+        level_name = self.last_level.get(name, "main")
+        if level_name not in self.owners:
+            level_name = "main"
+        prelude += await _take_unread(reader, writer.transport)
+        await self._hand_off(writer, prelude, name, level_name)
+
+    async def _hand_off(self, writer: asyncio.StreamWriter, prelude: bytes, name: str, level_name: str):
+        connection = self._workers.get(self.owners.get(level_name, None), None)
+        if not connection:
+            writer.write(_disconnect_packet("That level is not available"))
+            writer.close()
+            return
+        fd = os.dup(writer.get_extra_info("socket").fileno())
+        try:
+            await send_message(connection, {"type": "session", "level": level_name, "prelude": _encode(prelude)}, fd)
+        finally:
+            os.close(fd)
+        self.last_level[name] = level_name
+        writer.transport.abort()
+
+    async def _listen(self, worker_name: str, connection: socket.socket):
+        while True:
+            message, fd = await receive_message(connection)
+            if message is None:
+                if server.running():
+                    server.logger.error(f"{worker_name} has stopped")
+                del self._workers[worker_name]
+                return
+            kind = message["type"]
+            if kind == "migrate":
+                target = self._workers.get(self.owners.get(message["level"], None), None)
+                if target:
+                    await send_message(target, message, fd)
+                    self.last_level[message["name"]] = message["level"]
+                else:
+                    os.write(fd, _disconnect_packet("That level is not available"))
+                os.close(fd)
+            elif kind in ("chat", "broadcast"):
+                for name, other in self._workers.items():
+                    if name != worker_name:
+                        await send_message(other, message)
+
+
+async def _take_unread(reader: asyncio.StreamReader, transport: asyncio.Transport) -> bytes:
+    """Stop reading from *transport*, and return the data *reader* received which was not read yet. Anything sent
+    after that stays in the socket, for whoever gets it next."""
+    transport.pause_reading()
+    reader.feed_eof()
+    return await reader.read()
+
+
+class Worker:
+    """Hosts some levels in a worker process, taking connections from the front-end."""
+
+    def __init__(self, name: str, control_path: str, levels: List[str]):
+        self.name = name
+        self.control_path = control_path
+        self.all_levels = levels
+        self._control: Optional[socket.socket] = None
+
+    def hosts(self, level_name: str) -> bool:
+        """Return if *level_name* is hosted by any worker."""
+        return level_name in self.all_levels
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._control = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._control.setblocking(False)
+        await loop.sock_connect(self._control, self.control_path)
+        await send_message(self._control, {"type": "hello", "worker": self.name, "levels": list(server.levels)})
+        server.chat.connect(self._forward_chat)
+        metrics_server = await metrics.serve(server.metrics_port, server.metrics_ip) if server.metrics_port else None
+        await server.starting.fire()
+        server.warmed_up()
+        try:
+            while server.running():
+                message, fd = await receive_message(self._control)
+                if message is None or message["type"] == "stop":
+                    server.stop()
+                    return
+                if message["type"] in ("session", "migrate"):
+                    await self._open_session(message, fd)
+                elif message["type"] == "chat":
+                    for _, player in list(server._players.items()):
+                        await player.send_message(message["message"])
+                elif message["type"] == "broadcast" and (listener := _listeners.get(message["kind"], None)):
+                    try:
+                        await listener(message)
+                    except Exception:
+                        server.logger.exception(f"Could not handle {message['kind']} broadcast")
+        finally:
+            await server.shutdown.fire()
+            if metrics_server:
+                metrics_server.close()
+
+    async def _open_session(self, message: dict, fd: int):
+        loop = asyncio.get_running_loop()
+        level = server.get_level(message["level"])
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        reader = asyncio.StreamReader()
+        reader.feed_data(_decode(message["prelude"]))
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        asyncio.create_task(server._client_connection(reader, writer, level))
+
+    async def migrate(self, player, level_name: str):
+        """Move *player* to *level_name*, which is hosted by another worker. If their connection can not be handed
+        over, they stay where they are, or are removed once it is too late for that."""
+        writer = player.writer
+        transport = writer.transport
+        transport.pause_reading()
+        try:
+            await asyncio.wait_for(self._drain(player, transport), 10)
+        except (asyncio.TimeoutError, ConnectionError) as err:
+            transport.resume_reading()
+            server.logger.warning(f"Could not move {player} to {level_name}: {err!r}")
+            await player.send_message(f"&cCould not move you to {level_name}, try again later")
+            return
+        leftover = await _take_unread(player.reader, transport)
+        fd = os.dup(transport.get_extra_info("socket").fileno())
+        try:
+            await send_message(self._control, {
+                "type": "migrate",
+                "level": level_name,
+                "name": player.name,
+                "prelude": _encode(player.identification + leftover)
+            }, fd)
+        except OSError as err:
+            server.logger.error(f"Could not hand {player} over to {level_name}: {err!r}")
+            await server.remove_player(player, f"Could not move to {level_name}")
+            return
+        finally:
+            os.close(fd)
+        server.logger.info(f"Moved {player} to {level_name} on another worker")
+        transport.abort()
+        await server.remove_player(player, f"Moved to {level_name}")
+
+    @staticmethod
+    async def _drain(player, transport: asyncio.Transport):
+        await player.flush()
+        while transport.get_write_buffer_size():
+            await asyncio.sleep(0.01)
+
+    async def broadcast(self, kind: str, message: dict):
+        await send_message(self._control, {**message, "type": "broadcast", "kind": kind})
+
+    async def _forward_chat(self, player, message: str):
+        await send_message(self._control, {"type": "chat", "message": message})
+
+
+def listen(kind: str, listener: Callable[[dict], Awaitable]):
+    """Handle broadcasts of *kind* from other workers with the coroutine function *listener*."""
+    _listeners[kind] = listener
+
+
+async def broadcast(kind: str, message: dict = None):
+    """Send *message* to the listeners for *kind* in every other worker. Does nothing outside a worker process."""
+    if worker:
+        await worker.broadcast(kind, message or {})
+
+
+def _worker_main(name: str, control_path: str, levels: Dict[str, str], all_levels: List[str], options: dict):
+    global worker
+    from pyccs.protocol import cp7x
+    from pyccs import capture, entities, keepalive, logqueue, profiles, ratelimit, shared, watchdog
+    server.logger = logging.getLogger("PyCCS").getChild(name)
+    if not server.logger.handlers and not logging.getLogger("PyCCS").handlers:
+        logging.basicConfig(level=options.get("log_level", logging.INFO),
+                            format="[{asctime}-{name}/{levelname}] {message}", style="{")
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, server.stop)
+    server.name = options.get("name", server.name)
+    server.max_players = options.get("max_players", server.max_players)
+    server.salt = options.get("salt", server.salt)
+    server.sectioned_levels = options.get("sectioned_levels", server.sectioned_levels)
+    server.history_memory = options.get("history_memory", server.history_memory)
+    server.metrics_port = options.get("metrics_port", None)
+    metrics.time_listeners = options.get("metrics_listeners", False)
+    for option in ("max_connections", "max_per_ip", "handshake_timeout"):
+        if options.get(option, None) is not None:
+            setattr(admission.limits, option, options[option])
+    server.protocol = cp7x.PARSEABLES
+    first, *rest = levels.items()
+    server.level_file = first[1]
+    server.main_level = None
+    server.levels = {}
+    server.level_files = dict(rest)
+    server.load_levels()
+    server.levels[first[0]] = server.levels.pop("main")
+    for module_name in options.get("plugins", PLUGINS):
+        module = importlib.import_module(module_name)
+        if not server.get_plugin(module.PLUGIN.name, None):
+            server.add_plugin(module)
+            module.PLUGIN.config.set_file(f"./plugins/{module.PLUGIN.name}.json")
+    if helpers := options.get("level_helpers", 0):
+        shared.enable(helpers)
+    if threshold := options.get("watchdog", None):
+        watchdog.enable(threshold / 1000, options.get("watchdog_debug", False))
+    if interval := options.get("ping_interval", None):
+        keepalive.enable(interval, options.get("idle_timeout", 60.0))
+    if rules := options.get("rate_limits", None):
+        ratelimit.enable(rules)
+    if max_speed := options.get("max_speed", None):
+        entities.enable(max_speed)
+    if profiles_file := options.get("profiles", None):
+        profiles.enable(profiles_file)
+    if capture_file := options.get("capture", None):
+        capture.enable(f"{capture_file}.{name}", options.get("capture_outgoing", False))
+    worker = Worker(name, control_path, all_levels)
+    server._running = True
+    try:
+        asyncio.run(worker.run())
+    finally:
+        logqueue.stop()
+
+
+def run(level_files: Dict[str, str], workers: int, options: dict = None):
+    """Run the server as a front-end process and *workers* worker processes. *level_files* maps level names to
+    ClassicWorld files, and must include a level called main. Levels are assigned to workers round-robin."""
+    if "main" not in level_files:
+        raise ValueError("level_files must include a level called main")
+    options = dict(options or {})
+    options.setdefault("name", server.name)
+    options.setdefault("max_players", server.max_players)
+    options.setdefault("salt", server.salt)
+    options.setdefault("sectioned_levels", server.sectioned_levels)
+    options.setdefault("history_memory", server.history_memory)
+    frontend = Frontend(level_files, workers, options)
+    server.logger.info(f"Starting front-end with {frontend.worker_count} workers")
+    frontend.start_workers()
+    server._running = True
+    try:
+        asyncio.run(frontend.run())
+    finally:
+        for process in frontend._processes:
+            if process.is_alive():
+                process.terminate()
@@ -37,3 +37,56 @@ VERIFY_WARNING = """
             
 !!!ATTENTION!!!!!!ATTENTION!!!!!!ATTENTION!!!!!!ATTENTION!!!
 """
+
+
+class Block:
+    """Block IDs of the Classic block set."""
+    AIR = 0
+    STONE = 1
+    GRASS = 2
+    DIRT = 3
+    COBBLESTONE = 4
+    PLANKS = 5
+    SAPLING = 6
+    BEDROCK = 7
+    WATER = 8
+    STILL_WATER = 9
+    LAVA = 10
+    STILL_LAVA = 11
+    SAND = 12
+    GRAVEL = 13
+    GOLD_ORE = 14
+    IRON_ORE = 15
+    COAL_ORE = 16
+    LOG = 17
+    LEAVES = 18
+    SPONGE = 19
+    GLASS = 20
+    DANDELION = 37
+    ROSE = 38
+    BROWN_MUSHROOM = 39
+    RED_MUSHROOM = 40
+    GOLD = 41
+    IRON = 42
+    DOUBLE_SLAB = 43
+    SLAB = 44
+    BRICK = 45
+    TNT = 46
+    BOOKSHELF = 47
+    MOSSY_COBBLESTONE = 48
+    OBSIDIAN = 49
+
+
+NON_SOLID_BLOCKS = frozenset((
+    Block.AIR,
+    Block.SAPLING,
+    Block.WATER,
+    Block.STILL_WATER,
+    Block.LAVA,
+    Block.STILL_LAVA,
+    Block.DANDELION,
+    Block.ROSE,
+    Block.BROWN_MUSHROOM,
+    Block.RED_MUSHROOM,
+))
+"""Blocks players can not stand on."""
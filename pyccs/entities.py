@@ -0,0 +1,159 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Positions of every player in NumPy arrays, so passes over all of them are a few array operations.
+
+The EntityStore has one row per player ID in each of its columns, written whenever a player moves. A MovementCheck
+compares every player's position with the one it last accepted once per `interval`, and moves players which got
+further than `max_speed` allows back to where they were. Moving onto the level spawn is always allowed, which is
+how clients respawn."""
+
+import asyncio
+import time
+
+import numpy
+
+from typing import Optional
+
+import pyccs.server as server
+from pyccs import metrics
+from pyccs.protocol import Position
+
+LATENCY_ALLOWANCE = 1.0
+"""Seconds of movement at `max_speed` allowed on top of the time between checks, for packets arriving in bursts."""
+
+_REJECTED = metrics.Counter("pyccs_movements_rejected_total", "Players moved back for moving too fast")
+
+
+class EntityStore:
+    """Columns of entity state indexed by player ID, for up to *capacity* players. Players without an ID, which
+    were never added to the server, are ignored."""
+
+    def __init__(self, capacity: int = 128):
+        self.active = numpy.zeros(capacity, bool)
+        """Which rows belong to a player on a level."""
+        self.positions = numpy.zeros((capacity, 3), numpy.float32)
+        self.orientations = numpy.zeros((capacity, 2), numpy.float32)
+        """Yaw and pitch, in degrees."""
+        self.updated = numpy.zeros(capacity)
+        """When each player last moved, in `time.monotonic` seconds."""
+        self.velocities = numpy.zeros((capacity, 3), numpy.float32)
+        """Blocks per second each player moved between the last two checks."""
+        self.levels = numpy.empty(capacity, object)
+        self.spawns = numpy.zeros((capacity, 3), numpy.float32)
+        self.accepted = numpy.zeros((capacity, 3), numpy.float32)
+        """Positions which passed the last check."""
+        self.accepted_at = numpy.zeros(capacity)
+
+    def add(self, player):
+        """Start tracking *player* at their position on their level, which is accepted as it is."""
+        player_id = player.player_id
+        if player_id is None:
+            return
+        position = player.position
+        self.active[player_id] = True
+        self.positions[player_id] = self.accepted[player_id] = (position.x, position.y, position.z)
+        self.orientations[player_id] = (position.yaw, position.pitch)
+        self.updated[player_id] = self.accepted_at[player_id] = time.monotonic()
+        self.velocities[player_id] = 0
+        self.levels[player_id] = player.map
+        spawn = player.map.spawn
+        self.spawns[player_id] = (spawn.x, spawn.y, spawn.z)
+
+    def remove(self, player_id: Optional[int]):
+        if player_id is None:
+            return
+        self.active[player_id] = False
+        self.levels[player_id] = None
+
+    def update(self, player_id: Optional[int], position: Position):
+        if player_id is None:
+            return
+        self.positions[player_id] = (position.x, position.y, position.z)
+        self.orientations[player_id] = (position.yaw, position.pitch)
+        self.updated[player_id] = time.monotonic()
+
+    def near(self, level, x: float, y: float, z: float, radius: float) -> numpy.ndarray:
+        """IDs of the players on *level* within *radius* blocks of *x*, *y*, *z*."""
+        distances = ((self.positions - numpy.array((x, y, z), numpy.float32)) ** 2).sum(axis=1)
+        return numpy.flatnonzero(self.active & (self.levels == level) & (distances <= radius * radius))
+
+    def check(self, max_speed: float, now: Optional[float] = None) -> numpy.ndarray:
+        """Accept every player's position unless they moved further than *max_speed* blocks a second allows since
+        their last accepted position, and return the IDs of those which did. Their positions are set back to the
+        accepted ones."""
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.accepted_at
+        moved = self.positions - self.accepted
+        distances = (moved ** 2).sum(axis=1)
+        allowed = max_speed * (elapsed + LATENCY_ALLOWANCE)
+        respawned = ((self.positions - self.spawns) ** 2).sum(axis=1) < 1
+        flagged = self.active & (distances > allowed * allowed) & ~respawned
+        passed = self.active & ~flagged
+        self.velocities[passed] = moved[passed] / numpy.maximum(elapsed[passed], 1e-3)[:, None]
+        self.accepted[passed] = self.positions[passed]
+        self.positions[flagged] = self.accepted[flagged]
+        self.velocities[flagged] = 0
+        self.accepted_at[self.active] = now
+        return numpy.flatnonzero(flagged)
+
+
+store = EntityStore()
+"""Every player on this server process."""
+
+
+class MovementCheck:
+    """Checks every player's movement each *interval* seconds, moving players faster than *max_speed* back."""
+
+    def __init__(self, max_speed: float, interval: float = 0.5):
+        self.max_speed = max_speed
+        self.interval = interval
+        self.rejected = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        from pyccs.protocol.cp7x import PLAYER_POSITION_CHANGE  # cp7x imports this module
+        while True:
+            await asyncio.sleep(self.interval)
+            for player_id in store.check(self.max_speed).tolist():
+                player = server.get_player(player_id=player_id)
+                if player is None:
+                    continue
+                x, y, z = store.accepted[player_id].tolist()
+                yaw, pitch = store.orientations[player_id].tolist()
+                player.position = Position(x, y, z, yaw, pitch)
+                self.rejected += 1
+                _REJECTED.inc()
+                server.logger.debug(f"Moved {player} back to {player.position} for moving too fast")
+                await player.send_packet(PLAYER_POSITION_CHANGE.to_packet(player_id=-1, position=player.position))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+check: Optional[MovementCheck] = None
+"""The running MovementCheck, if enabled."""
+
+
+def enable(max_speed: float, interval: float = 0.5):
+    """Move players which move faster than *max_speed* blocks a second back while the server is running."""
+
+    async def start():
+        global check
+        check = MovementCheck(max_speed, interval)
+        check.start()
+
+    async def stop():
+        global check
+        if check:
+            check.stop()
+            check = None
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
@@ -0,0 +1,259 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""In-memory connections to the server, for benchmarking and profiling it without sockets.
+
+A Harness sets the server module up with a generated level and the Classic protocol, then connects MemoryClients by
+running `server._client_connection` over StreamReaders and StreamWriters backed by MemoryTransports. Bytes sent by a
+client are fed straight into the server's reader, and bytes the server writes are either kept for the client to read,
+or only counted when the client is a sink, which is what broadcast benchmarks want.
+
+The Harness takes over the server module's globals, so only use it in a process of its own. `python -m pyccs.harness`
+runs a join, packet and broadcast benchmark, optionally under cProfile."""
+
+import argparse
+import asyncio
+import cProfile
+import json
+import logging
+import pstats
+import sys
+import time
+
+from typing import Dict, List, Optional
+
+import pyccs.server as server
+from pyccs import mapgen
+from pyccs.protocol import Position, Packet
+from pyccs.protocol import cp7x
+
+
+class MemoryTransport(asyncio.Transport):
+    """Transport which hands everything written to it to a StreamReader, or counts it if the reader is None."""
+
+    def __init__(self, reader: Optional[asyncio.StreamReader], peer: str):
+        super().__init__()
+        self.reader = reader
+        self.peer = peer
+        self.bytes_written = 0
+        self.on_close = None
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return (self.peer, 0)
+        return default
+
+    def write(self, data):
+        if self._closing:
+            return
+        self.bytes_written += len(data)
+        if self.reader is not None:
+            self.reader.feed_data(data)
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        if self.reader is not None:
+            self.reader.feed_eof()
+        if self.on_close:
+            self.on_close()
+
+    def abort(self):
+        self.close()
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def can_write_eof(self) -> bool:
+        return False
+
+
+class MemoryClient:
+    """Client side of an in-memory connection."""
+
+    def __init__(self, name: str, server_reader: asyncio.StreamReader, transport: MemoryTransport,
+                 reader: Optional[asyncio.StreamReader]):
+        self.name = name
+        self.transport = transport
+        """Transport the server writes to, `transport.bytes_written` counts what the client received."""
+        self.reader = reader
+        """Bytes sent to the client, None if it is a sink."""
+        self.player: Optional[server.Player] = None
+        """The server's Player for this client, once it joined."""
+        self.task: Optional[asyncio.Task] = None
+        self._server_reader = server_reader
+
+    def send(self, packet: Packet):
+        """Hand a packet to the server."""
+        self._server_reader.feed_data(packet.to_bytes())
+
+    def send_raw(self, data: bytes):
+        self._server_reader.feed_data(data)
+
+    async def read_packet(self) -> Packet:
+        """Read and parse the next packet the server sent, only for clients which are not sinks."""
+        from pyccs.loadtest import CLIENT_BOUND
+        packet_id = (await self.reader.readexactly(1))[0]
+        info = CLIENT_BOUND[packet_id]
+        packet = info.to_packet()
+        packet.from_bytes(await self.reader.readexactly(info.size()))
+        return packet
+
+    async def close(self):
+        """Disconnect the client and wait for the server to finish with the connection."""
+        self._server_reader.feed_eof()
+        if self.task:
+            await self.task
+
+
+class Harness:
+    """Runs the server's connection handling over in-memory connections, on a generated level of *size*."""
+
+    def __init__(self, size: Position = None, generator: str = "flat", history: bool = False,
+                 log_level: int = logging.WARNING):
+        self.level = mapgen.generate(generator, size or Position(64, 32, 64))
+        self.clients: List[MemoryClient] = []
+        self.handled = 0
+        """Number of packets the server has handled so far."""
+        self._joining: Dict[str, asyncio.Future] = {}
+        self._connections = 0
+        server.logger = logging.getLogger("PyCCS").getChild("harness")
+        server.logger.setLevel(log_level)
+        server.protocol = cp7x.PARSEABLES
+        server.main_level = self.level
+        server.levels = {"main": self.level}
+        server._players = {}
+        server.max_players = server.PLAYER_IDS
+        if history:
+            self.level.enable_history(server.history_memory)
+        if not server.get_plugin(cp7x.PLUGIN.name, None):
+            server.add_plugin(cp7x)
+        self._listeners = [server.player_added.connect(self._player_added),
+                           server.incoming_packet.connect(self._count_packet)]
+        server._running = True
+
+    async def _player_added(self, player):
+        if future := self._joining.pop(player.name, None):
+            future.set_result(player)
+
+    async def _count_packet(self, player, packet):
+        self.handled += 1
+
+    async def connect(self, name: str, sink: bool = True, join: bool = True) -> MemoryClient:
+        """Connect a client called *name*. If *join* is true it sends the identification packet and waits until the
+        server has sent it the level and other players. If *sink* is true, what the server sends is only counted."""
+        loop = asyncio.get_running_loop()
+        self._connections += 1
+        server_reader = asyncio.StreamReader()
+        client_reader = None if sink else asyncio.StreamReader()
+        transport = MemoryTransport(client_reader, f"memory-{self._connections}")
+        protocol = asyncio.StreamReaderProtocol(server_reader)
+        protocol.connection_made(transport)
+        transport.on_close = server_reader.feed_eof
+        writer = asyncio.StreamWriter(transport, protocol, server_reader, loop)
+        client = MemoryClient(name, server_reader, transport, client_reader)
+        client.task = loop.create_task(server._client_connection(server_reader, writer))
+        self.clients.append(client)
+        if join:
+            future = self._joining[name] = loop.create_future()
+            client.send(cp7x.PLAYER_IDENTIFICATION.to_packet(version=7, username=name, mp_pass="", cpe_byte=0))
+            client.player = await future
+            await client.player.flush()
+        return client
+
+    async def wait_handled(self, count: int):
+        """Wait until the server has handled *count* packets in total, and every player's queue is sent."""
+        while self.handled < count:
+            await asyncio.sleep(0)
+        await self.settle()
+
+    async def settle(self):
+        """Wait until every queued packet has been written to the clients."""
+        await asyncio.gather(*(client.player.flush() for client in self.clients if client.player))
+
+    async def close(self):
+        """Disconnect every client and stop listening to the server's events."""
+        await asyncio.gather(*(client.close() for client in self.clients))
+        self.clients = []
+        for listener in self._listeners:
+            listener.disconnect()
+        self._listeners = []
+
+
+def _measure(function):
+    async def measured(*args):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        count = await function(*args)
+        return {"count": count, "wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu}
+    return measured
+
+
+async def benchmark(players: int = 50, packets: int = 5000, size: Position = None) -> dict:
+    """Join *players* clients, then have one of them send *packets* position updates, chat messages and block
+    changes. Returns the CPU and wall time per join and per packet, each of which is broadcast to every player."""
+    harness = Harness(size or Position(128, 64, 128))
+    results = {}
+
+    @_measure
+    async def joins():
+        for number in range(players):
+            await harness.connect(f"bench{number}")
+        return players
+
+    @_measure
+    async def send(make_packet):
+        sender = harness.clients[0]
+        target = harness.handled + packets
+        for number in range(packets):
+            sender.send(make_packet(number))
+            if number % 256 == 255:
+                await asyncio.sleep(0)
+        await harness.wait_handled(target)
+        return packets
+
+    results["join"] = await joins()
+    size = harness.level.size
+    results["position"] = await send(lambda number: cp7x.PLAYER_POSITION_CHANGE.to_packet(
+        player_id=-1, position=Position(number % size.x, size.y // 2, number // size.x % size.z)))
+    results["chat"] = await send(lambda number: cp7x.CHAT_MESSAGE.to_packet(player_id=-1, message=f"hello {number}"))
+    results["block"] = await send(lambda number: cp7x.CLIENT_SET_BLOCK.to_packet(
+        position=Position(number % size.x, size.y - 1, number // size.x % size.z), mode=1, block_id=1))
+    await harness.close()
+    for result in results.values():
+        result["cpu_per_item_us"] = result["cpu"] / result["count"] * 1000000
+    return {"players": players, "packets": packets, "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyccs.harness", description="Benchmark the server over memory")
+    parser.add_argument("-p", "--players", type=int, default=50, help="Number of clients to join")
+    parser.add_argument("-n", "--packets", type=int, default=5000, help="Packets of each kind to send")
+    parser.add_argument("--profile", metavar="FILE", help="Run under cProfile and write the stats to this file")
+    parser.add_argument("-o", "--output", help="File to write the results to as JSON")
+    options = parser.parse_args(argv)
+    profiler = cProfile.Profile() if options.profile else None
+    if profiler:
+        profiler.enable()
+    report = asyncio.run(benchmark(options.players, options.packets))
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    for name, result in report["results"].items():
+        print(f"{name}: {result['cpu_per_item_us']:.1f}us CPU each over {result['count']}, "
+              f"{result['wall']:.2f}s wall")
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,216 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Heartbeats to a server list, which is what makes `server.salt` valid for name verification.
+
+A Heartbeat sends the server's name, port, player count and salt to the list every `interval` seconds, give or take
+`jitter`, over one HttpConnection it keeps open between beats. Failed beats are retried sooner, backing off from
+`retry` seconds up to the normal interval. The URL the list answers with is where players can join the server."""
+
+import asyncio
+import json
+import random
+import ssl
+import urllib.parse
+
+from typing import Dict, Optional, Tuple
+
+import pyccs.server as server
+from pyccs import metrics
+from pyccs.constants import VERSION
+
+CLASSICUBE = "https://www.classicube.net/server/heartbeat/"
+"""Heartbeat URL of the ClassiCube server list."""
+
+_HEARTBEATS = metrics.Counter("pyccs_heartbeats_total", "Heartbeats sent to the server list", ["result"])
+
+heartbeat: Optional["Heartbeat"] = None
+"""The running Heartbeat, if enabled."""
+
+
+class HeartbeatError(Exception):
+    """The server list rejected a heartbeat."""
+
+
+class HttpConnection:
+    """A keep-alive HTTP/1.1 connection to the host of *url*, opened on first use and reopened whenever the other end
+    closed it. Only one request may be in flight at a time."""
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.tls = parts.scheme == "https"
+        self.port = parts.port or (443 if self.tls else 80)
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context() if self.tls else None), self.timeout)
+
+    async def close(self):
+        if self._writer:
+            writer, self._reader, self._writer = self._writer, None, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+    async def request(self, method: str, target: str, body: bytes = b"") -> Tuple[int, Dict[str, str], bytes]:
+        """Send a request for *target*, the path and query, and return the status, headers and body of the response.
+        A request on a reused connection which fails before any response is retried once on a new one."""
+        reused = self._writer is not None
+        while True:
+            if not self._writer:
+                await self._connect()
+            try:
+                return await asyncio.wait_for(self._exchange(method, target, body), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                if not reused:
+                    raise
+                reused = False
+            except BaseException:
+                await self.close()
+                raise
+
+    async def _exchange(self, method: str, target: str, body: bytes) -> Tuple[int, Dict[str, str], bytes]:
+        host = self.host if self.port in (80, 443) else f"{self.host}:{self.port}"
+        head = f"{method} {target} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: {VERSION}\r\nConnection: keep-alive\r\n"
+        if body or method in ("POST", "PUT"):
+            head += f"Content-Length: {len(body)}\r\n"
+        self._writer.write(f"{head}\r\n".encode("latin-1") + body)
+        await self._writer.drain()
+        status_line = (await self._reader.readuntil(b"\r\n")).decode("latin-1")
+        version, _, rest = status_line.partition(" ")
+        status = rest[:3]
+        if not version.startswith("HTTP/") or not status.isdigit():
+            raise HeartbeatError(f"Malformed status line {status_line.strip()[:100]!r}")
+        headers = {}
+        while (line := await self._reader.readuntil(b"\r\n")) != b"\r\n":
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            content = bytearray()
+            while size := int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16):
+                content += await self._reader.readexactly(size + 2)
+                del content[-2:]
+            while await self._reader.readuntil(b"\r\n") != b"\r\n":
+                pass
+            content = bytes(content)
+        elif "content-length" in headers:
+            content = await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await self._reader.read()
+            headers["connection"] = "close"
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return int(status), headers, content
+
+
+class Heartbeat:
+    """Sends heartbeats to the server list at *url* until stopped. The server is listed publicly if *public*."""
+
+    def __init__(self, url: str = CLASSICUBE, public: bool = True, interval: float = 45.0, jitter: float = 0.1,
+                 retry: float = 2.0):
+        self.url = url
+        self.public = public
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self.play_url: Optional[str] = None
+        """Where players can join the server, as reported by the server list."""
+        self.failures = 0
+        """Heartbeats which failed in a row."""
+        self._connection = HttpConnection(url)
+        self._task: Optional[asyncio.Task] = None
+
+    def parameters(self) -> Dict[str, str]:
+        return {
+            "name": server.name,
+            "port": str(server.port()),
+            "users": str(len(server.get_players())),
+            "max": str(server.max_players),
+            "public": "true" if self.public else "false",
+            "salt": server.salt,
+            "software": str(VERSION),
+        }
+
+    async def beat(self) -> str:
+        """Send one heartbeat, return the URL the server list answered with."""
+        parts = urllib.parse.urlsplit(self.url)
+        query = urllib.parse.urlencode(self.parameters())
+        status, headers, body = await self._connection.request("GET", f"{parts.path or '/'}?{query}")
+        text = body.decode("utf-8", "replace").strip()
+        if status != 200:
+            raise HeartbeatError(f"HTTP {status}: {text[:200]}")
+        if text.startswith("{"):
+            try:
+                errors = json.loads(text).get("errors", None)
+            except ValueError:
+                errors = None
+            raise HeartbeatError(f"{errors or text[:200]}")
+        return text
+
+    def _delay(self) -> float:
+        if self.failures:
+            delay = min(self.retry * 2 ** (self.failures - 1), self.interval)
+        else:
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def run(self):
+        while True:
+            try:
+                play_url = await self.beat()
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    ValueError, HeartbeatError) as err:
+                self.failures += 1
+                _HEARTBEATS.inc("failed")
+                server.logger.warning(f"Heartbeat to {self.url} failed ({self.failures} in a row): {err}")
+            except Exception:
+                self.failures += 1
+                _HEARTBEATS.inc("failed")
+                server.logger.exception(f"Heartbeat to {self.url} failed unexpectedly ({self.failures} in a row)")
+                await self._connection.close()
+            else:
+                self.failures = 0
+                _HEARTBEATS.inc("ok")
+                if play_url != self.play_url:
+                    self.play_url = play_url
+                    server.logger.info(f"Server list heartbeat accepted, play at {play_url}")
+            await asyncio.sleep(self._delay())
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._connection.close()
+
+
+def enable(url: str = CLASSICUBE, public: bool = True, interval: float = 45.0):
+    """Send heartbeats to the server list at *url* while the server is running."""
+
+    async def start():
+        global heartbeat
+        heartbeat = Heartbeat(url, public, interval)
+        heartbeat.start()
+
+    async def stop():
+        global heartbeat
+        if heartbeat:
+            running, heartbeat = heartbeat, None
+            await running.stop()
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
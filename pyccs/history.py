@@ -0,0 +1,160 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""This module records block changes made to a Map, so they can be looked up and reverted by moderators."""
+
+import json
+import time
+import numpy
+
+from array import array
+from typing import Optional, Tuple
+from pyccs.protocol import Position
+
+RECORD = numpy.dtype([
+    ("index", "<u4"),
+    ("old", "u1"),
+    ("new", "u1"),
+    ("player", "<u4"),
+    ("time", "<u4"),
+])
+"""Layout of one edit when spilled to disk. In memory every field is kept in its own column."""
+TIME_RESOLUTION = 10
+"""Edit times are stored in tenths of a second since the history was created."""
+
+
+class EditHistory:
+    """Bounded, columnar log of block edits.
+
+    Each edit costs 14 bytes spread over five preallocated arrays, used as a ring buffer. Once `max_bytes` is used up
+    the oldest `batch` edits are evicted at once, and appended to `spill_file` first if one was given. Queries and
+    reverts run over NumPy views of the arrays, without touching the edits one at a time."""
+
+    def __init__(self, size: Position, max_bytes: int = 16 * 1024 * 1024, spill_file: Optional[str] = None,
+                 batch: int = 4096):
+        self.size = size
+        self.batch = batch
+        self.capacity = max(batch, (max_bytes // RECORD.itemsize) // batch * batch)
+        """Number of edits kept in memory."""
+        self.spill_file = spill_file
+        self.epoch = time.time()
+        """Wall clock time the history's edit times count from."""
+        self.players = []
+        """Names of the players that made edits, edits refer to them by their position in this list."""
+        self._player_keys = {}
+        self._index = array("I", bytes(4 * self.capacity))
+        self._old = array("B", bytes(self.capacity))
+        self._new = array("B", bytes(self.capacity))
+        self._player = array("I", bytes(4 * self.capacity))
+        self._time = array("I", bytes(4 * self.capacity))
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def player_key(self, name: str) -> int:
+        """Return the number edits by the named player are stored under."""
+        if (key := self._player_keys.get(name, None)) is None:
+            key = self._player_keys[name] = len(self.players)
+            self.players.append(name)
+        return key
+
+    def now(self) -> int:
+        return int((time.time() - self.epoch) * TIME_RESOLUTION)
+
+    def record(self, index: int, old: int, new: int, player: str):
+        """Record that *player* changed the block at *index* from *old* to *new*."""
+        self._append(index, old, new, self.player_key(player), self.now())
+
+    def record_many(self, indices: numpy.ndarray, old: numpy.ndarray, new: numpy.ndarray, player: str):
+        """Record several edits made by *player* at once."""
+        key = self.player_key(player)
+        now = self.now()
+        for index, old_block, new_block in zip(indices.tolist(), old.tolist(), new.tolist()):
+            self._append(index, old_block, new_block, key, now)
+
+    def _append(self, index: int, old: int, new: int, key: int, now: int):
+        if not (0 <= index <= 0xFFFFFFFF and 0 <= old <= 0xFF and 0 <= new <= 0xFF):
+            raise ValueError(f"Can not record edit of block {index} from {old} to {new}")
+        head = self._head
+        if self._count == self.capacity:
+            if head % self.batch == 0:
+                self._evict(head)
+        else:
+            self._count += 1
+        self._index[head] = index
+        self._old[head] = old
+        self._new[head] = new
+        self._player[head] = key
+        self._time[head] = now
+        self._head = (head + 1) % self.capacity
+
+    def _evict(self, start: int):
+        if not self.spill_file:
+            return
+        end = start + self.batch
+        records = numpy.empty(self.batch, dtype=RECORD)
+        for name, column in self._views().items():
+            records[name] = column[start:end]
+        with open(self.spill_file, "ab") as file:
+            file.write(records.tobytes())
+        with open(f"{self.spill_file}.json", "w") as file:
+            json.dump({"epoch": self.epoch, "players": self.players, "size": self.size.to_list()}, file)
+
+    def _views(self) -> dict:
+        return {
+            "index": numpy.frombuffer(self._index, dtype=numpy.uint32),
+            "old": numpy.frombuffer(self._old, dtype=numpy.uint8),
+            "new": numpy.frombuffer(self._new, dtype=numpy.uint8),
+            "player": numpy.frombuffer(self._player, dtype=numpy.uint32),
+            "time": numpy.frombuffer(self._time, dtype=numpy.uint32),
+        }
+
+    def edits(self) -> dict:
+        """Return a copy of every edit in memory as columns of NumPy arrays, oldest first."""
+        views = self._views()
+        if self._count < self.capacity:
+            return {name: column[:self._count].copy() for name, column in views.items()}
+        return {name: numpy.concatenate((column[self._head:], column[:self._head]))
+                for name, column in views.items()}
+
+    def select(self, edits: dict, player: Optional[str] = None, region: Tuple[Position, Position] = None,
+               since: Optional[float] = None) -> numpy.ndarray:
+        """Return a mask of the *edits* made by *player*, inside the inclusive *region*, and in the last *since*
+        seconds. Filters left as None match every edit."""
+        mask = numpy.ones(len(edits["index"]), dtype=bool)
+        if player is not None:
+            if (key := self._player_keys.get(player, None)) is None:
+                return numpy.zeros_like(mask)
+            mask &= edits["player"] == key
+        if region is not None:
+            low, high = region
+            index = edits["index"]
+            layer = self.size.x * self.size.z
+            x = index % self.size.x
+            y = index // layer
+            z = (index % layer) // self.size.x
+            mask &= (x >= min(low.x, high.x)) & (x <= max(low.x, high.x))
+            mask &= (y >= min(low.y, high.y)) & (y <= max(low.y, high.y))
+            mask &= (z >= min(low.z, high.z)) & (z <= max(low.z, high.z))
+        if since is not None:
+            mask &= edits["time"] >= self.now() - int(since * TIME_RESOLUTION)
+        return mask
+
+    def revert(self, player: Optional[str] = None, region: Tuple[Position, Position] = None,
+               since: Optional[float] = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Work out how to undo the matching edits. Returns the block indices to change and the blocks to change them
+        to, which is what each block was before the earliest matching edit to it."""
+        edits = self.edits()
+        mask = self.select(edits, player, region, since)
+        indices, first = numpy.unique(edits["index"][mask], return_index=True)
+        return indices, edits["old"][mask][first]
+
+    def block_log(self, index: int) -> list:
+        """Return (player, time, old, new) for each edit in memory to the block at *index*, oldest first."""
+        edits = self.edits()
+        found = numpy.flatnonzero(edits["index"] == index)
+        return [(self.players[edits["player"][i]], self.epoch + float(edits["time"][i]) / TIME_RESOLUTION,
+                 int(edits["old"][i]), int(edits["new"][i])) for i in found]
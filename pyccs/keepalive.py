@@ -0,0 +1,178 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Pings for players, and removal of players whose connection died without closing.
+
+Every player gets one timer on a shared TimerWheel, which a single task advances once per tick. When a player's
+timer fires they are sent a ping, unless they have not sent anything for `idle_timeout` seconds or a write to them
+has been stuck for `stall_timeout` seconds, in which case they are removed.
+
+The TimerWheel is hierarchical: the first level has `size` slots of one tick each, and every further level has `size`
+slots covering a whole turn of the level below. Scheduling and cancelling a timer is O(1), and a tick only looks at
+the timers due in it, plus once per turn a slot of timers moving down a level, however many timers there are."""
+
+import asyncio
+import math
+import time
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import pyccs.server as server
+from pyccs import metrics
+from pyccs.protocol.cp7x import PING
+
+_REAPED = metrics.Counter("pyccs_players_reaped_total", "Players removed for not responding", ["reason"])
+
+keepalive: Optional["Keepalive"] = None
+"""The running Keepalive, if enabled."""
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline: int, callback: Callable[[], Optional[Awaitable]]):
+        self.deadline = deadline
+        """Tick the timer fires on."""
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Timers with a resolution of *tick* seconds, up to `size ** levels` ticks ahead."""
+
+    def __init__(self, tick: float = 1.0, size: int = 64, levels: int = 3):
+        self.tick = tick
+        self.size = size
+        self.ticks = 0
+        """Ticks advanced so far."""
+        self._spans = [size ** level for level in range(levels + 1)]
+        self._wheels: List[List[List[Timer]]] = [[[] for _ in range(size)] for _ in range(levels)]
+
+    def schedule(self, delay: float, callback: Callable[[], Optional[Awaitable]]) -> Timer:
+        """Call *callback* once at least *delay* seconds have passed. Delays beyond the wheel's range are cut short."""
+        ticks = min(max(1, math.ceil(delay / self.tick)), self._spans[-1] - 1)
+        timer = Timer(self.ticks + ticks, callback)
+        self._place(timer)
+        return timer
+
+    def _place(self, timer: Timer):
+        remaining = timer.deadline - self.ticks
+        for level, wheel in enumerate(self._wheels):
+            if remaining < self._spans[level + 1]:
+                wheel[timer.deadline // self._spans[level] % self.size].append(timer)
+                return
+
+    def advance(self) -> List[Timer]:
+        """Move forward one tick and return the timers due, which are not cancelled."""
+        self.ticks += 1
+        for level in range(1, len(self._wheels)):
+            if self.ticks % self._spans[level]:
+                break
+            wheel = self._wheels[level]
+            slot = self.ticks // self._spans[level] % self.size
+            moving, wheel[slot] = wheel[slot], []
+            for timer in moving:
+                if not timer.cancelled:
+                    self._place(timer)
+        wheel = self._wheels[0]
+        slot = self.ticks % self.size
+        due, wheel[slot] = wheel[slot], []
+        return [timer for timer in due if not timer.cancelled]
+
+    async def run(self):
+        """Advance the wheel in real time and run due callbacks, awaiting those which return awaitables. Ticks
+        missed while the event loop was busy are caught up on."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while True:
+            await asyncio.sleep(max(0.0, started + (self.ticks + 1) * self.tick - loop.time()))
+            while started + (self.ticks + 1) * self.tick <= loop.time():
+                for timer in self.advance():
+                    try:
+                        result = timer.callback()
+                        if result is not None:
+                            await result
+                    except Exception:
+                        server.logger.exception(f"Error in timer callback {timer.callback}")
+
+
+class Keepalive:
+    """Pings every player each *interval* seconds, and removes players which stopped responding."""
+
+    def __init__(self, interval: float = 5.0, idle_timeout: float = 60.0, stall_timeout: float = 30.0,
+                 tick: float = 1.0):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        """Seconds a player may go without sending anything."""
+        self.stall_timeout = stall_timeout
+        """Seconds a write to a player may take."""
+        self.wheel = TimerWheel(tick)
+        self._timers: Dict[server.Player, Timer] = {}
+        self._connections = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _schedule(self, player):
+        self._timers[player] = self.wheel.schedule(self.interval, lambda: self._check(player))
+
+    async def _player_added(self, player):
+        self._schedule(player)
+
+    async def _player_removing(self, player, reason):
+        if timer := self._timers.pop(player, None):
+            timer.cancel()
+
+    async def _check(self, player):
+        if self._timers.get(player, None) is None:
+            return
+        now = time.monotonic()
+        if now - player.last_received > self.idle_timeout:
+            reason = "Timed out"
+        elif player.draining_since and now - player.draining_since > self.stall_timeout:
+            reason = "Connection stalled"
+        else:
+            if not player.queued:
+                await player.send_packet(PING.to_packet())
+            self._schedule(player)
+            return
+        self._timers.pop(player, None)
+        _REAPED.inc(reason)
+        await server.remove_player(player, reason)
+
+    def start(self):
+        self._connections = [server.player_added.connect(self._player_added),
+                             server.player_removing.connect(self._player_removing)]
+        for player in server.get_players():
+            self._schedule(player)
+        self._task = asyncio.get_running_loop().create_task(self.wheel.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for connection in self._connections:
+            connection.disconnect()
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+
+def enable(interval: float = 5.0, idle_timeout: float = 60.0):
+    """Ping players and remove unresponsive ones while the server is running."""
+
+    async def start():
+        global keepalive
+        keepalive = Keepalive(interval, idle_timeout)
+        keepalive.start()
+
+    async def stop():
+        global keepalive
+        if keepalive:
+            running, keepalive = keepalive, None
+            await running.stop()
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
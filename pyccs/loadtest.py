@@ -0,0 +1,303 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Headless bots for load testing a PyCCS server.
+
+Run with `python -m pyccs.loadtest --bots 200 --duration 60`. Each bot joins like a Classic client, downloads the
+level, then walks, places blocks and chats at the configured rates. Bots tag their chat messages and remember the
+blocks they place, so when another bot receives them the time from send to receipt is recorded as broadcast latency.
+All bots run in one process, so they share a clock.
+
+The report is printed and can be written as JSON with `--output`, containing the settings, the software version and
+git revision, so results from different commits can be compared. Name verification must be off on the server, and
+its player limit, set with `-p`, at least the number of bots."""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import zlib
+
+from typing import Dict, List, Optional
+
+from pyccs.constants import VERSION
+from pyccs.protocol import Position, Packet
+from pyccs.protocol.cp7x import *
+
+CLIENT_BOUND = {
+    0x00: SERVER_IDENTIFICATION,
+    0x01: PING,
+    0x02: INITIALIZE_LEVEL,
+    0x03: LEVEL_DATA_CHUNK,
+    0x04: FINALIZE_LEVEL,
+    0x06: SERVER_SET_BLOCK,
+    0x07: SPAWN_PLAYER,
+    0x08: PLAYER_POSITION_CHANGE,
+    0x0c: DESPAWN_PLAYER,
+    0x0d: CHAT_MESSAGE,
+    0x0e: DISCONNECT,
+    0x0f: UPDATE_MODE,
+}
+"""Packets a client receives, by ID."""
+PARSED = {0x03, 0x04, 0x06, 0x0d, 0x0e}
+"""IDs of the packets bots look inside, everything else is only counted."""
+CHAT_TAG = "lt#"
+
+
+def percentiles(values: List[float]) -> dict:
+    """Summarize *values* as count, mean, p50, p90, p99 and max."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def at(quantile):
+        return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": ordered[-1],
+    }
+
+
+class LoadTest:
+    """Shared state of a load test run."""
+
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.join_latency: List[float] = []
+        self.chat_latency: List[float] = []
+        self.block_latency: List[float] = []
+        self.dropouts: Dict[str, int] = {}
+        self.failed_joins: Dict[str, int] = {}
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.chats: Dict[str, float] = {}
+        """Send time of each tagged chat message."""
+        self.blocks: Dict[tuple, tuple] = {}
+        """Send time and bot of each block placed, by position and block ID."""
+        self.stopping = False
+
+    def record_failure(self, table: Dict[str, int], reason: str):
+        table[reason] = table.get(reason, 0) + 1
+
+
+class Bot:
+    def __init__(self, test: LoadTest, number: int):
+        self.test = test
+        self.number = number
+        self.name = f"{test.options.prefix}{number}"
+        self.random = random.Random(test.random.random())
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.size: Optional[Position] = None
+        self.position: Optional[Position] = None
+        self.joined = asyncio.Event()
+        self.chat_count = 0
+
+    async def send(self, packet: Packet):
+        self.writer.write(packet.to_bytes())
+        self.test.packets_sent += 1
+        await self.writer.drain()
+
+    async def run(self):
+        test = self.test
+        started = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(test.options.host, test.options.port)
+            await self.send(PLAYER_IDENTIFICATION.to_packet(version=7, username=self.name, mp_pass="", cpe_byte=0))
+            receiving = asyncio.create_task(self.receive())
+            await asyncio.wait([receiving, asyncio.create_task(self.joined.wait())], timeout=test.options.timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not self.joined.is_set():
+                test.record_failure(test.failed_joins, "timed out" if not receiving.done() else "disconnected")
+                receiving.cancel()
+                return
+            test.join_latency.append(time.perf_counter() - started)
+            acting = asyncio.create_task(self.act())
+            await asyncio.wait([receiving, acting], return_when=asyncio.FIRST_COMPLETED)
+            acting.cancel()
+            receiving.cancel()
+        except (ConnectionError, OSError) as e:
+            test.record_failure(test.failed_joins if not self.joined.is_set() else test.dropouts, type(e).__name__)
+        finally:
+            if self.writer:
+                self.writer.close()
+
+    async def receive(self):
+        test = self.test
+        level_data = bytearray()
+        try:
+            while True:
+                packet_id = (await self.reader.readexactly(1))[0]
+                info = CLIENT_BOUND[packet_id]
+                data = await self.reader.readexactly(info.size())
+                test.packets_received += 1
+                test.bytes_received += len(data) + 1
+                if packet_id not in PARSED:
+                    continue
+                packet = info.to_packet()
+                packet.from_bytes(data)
+                if packet_id == 0x03:
+                    level_data += packet.data[:packet.length]
+                elif packet_id == 0x04:
+                    self.size = packet.map_size
+                    if test.options.verify_level:
+                        zlib.decompress(bytes(level_data), 31)
+                    level_data = bytearray()
+                    self.joined.set()
+                elif packet_id == 0x06:
+                    self.received_block(packet)
+                elif packet_id == 0x0d:
+                    self.received_chat(packet)
+                elif packet_id == 0x0e:
+                    test.record_failure(test.dropouts if self.joined.is_set() else test.failed_joins, packet.reason)
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if not test.stopping:
+                test.record_failure(test.dropouts if self.joined.is_set() else test.failed_joins, "connection lost")
+
+    def received_block(self, packet):
+        position = packet.position
+        sent = self.test.blocks.get((position.x, position.y, position.z, packet.block_id), None)
+        if sent and sent[1] != self.number:
+            self.test.block_latency.append(time.perf_counter() - sent[0])
+
+    def received_chat(self, packet):
+        _, _, message = packet.message.partition(": ")
+        if message.startswith(CHAT_TAG) and (sent := self.test.chats.get(message, None)):
+            if not message.startswith(f"{CHAT_TAG}{self.number}."):
+                self.test.chat_latency.append(time.perf_counter() - sent)
+
+    async def act(self):
+        options = self.test.options
+        size = self.size
+        self.position = Position(self.random.uniform(0, size.x), size.y * 0.75, self.random.uniform(0, size.z))
+        actions = [(self.move, options.move_rate), (self.place_block, options.block_rate),
+                   (self.chat, options.chat_rate)]
+        await asyncio.gather(*(self.repeat(action, rate) for action, rate in actions if rate > 0))
+
+    async def repeat(self, action, rate: float):
+        await asyncio.sleep(self.random.uniform(0, 1 / rate))
+        while True:
+            await action()
+            await asyncio.sleep(1 / rate)
+
+    async def move(self):
+        position = self.position
+        position.x = min(max(position.x + self.random.uniform(-1, 1), 0), self.size.x - 1)
+        position.z = min(max(position.z + self.random.uniform(-1, 1), 0), self.size.z - 1)
+        position.yaw = self.random.uniform(0, 255)
+        await self.send(PLAYER_POSITION_CHANGE.to_packet(player_id=-1, position=position))
+
+    async def place_block(self):
+        position = Position(self.random.randrange(self.size.x), self.random.randrange(self.size.y),
+                            self.random.randrange(self.size.z))
+        block_id = self.random.randrange(1, 50)
+        self.test.blocks[(position.x, position.y, position.z, block_id)] = (time.perf_counter(), self.number)
+        await self.send(CLIENT_SET_BLOCK.to_packet(position=position, mode=1, block_id=block_id))
+
+    async def chat(self):
+        self.chat_count += 1
+        message = f"{CHAT_TAG}{self.number}.{self.chat_count}"
+        self.test.chats[message] = time.perf_counter()
+        await self.send(CHAT_MESSAGE.to_packet(player_id=-1, message=message))
+
+
+def _revision() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(options: argparse.Namespace) -> dict:
+    """Run a load test and return its report."""
+    test = LoadTest(options)
+    bots = [Bot(test, number) for number in range(options.bots)]
+    tasks = []
+    started = time.perf_counter()
+    for bot in bots:
+        tasks.append(asyncio.create_task(bot.run()))
+        if options.join_rate > 0:
+            await asyncio.sleep(1 / options.join_rate)
+    remaining = options.duration - (time.perf_counter() - started)
+    await asyncio.wait(tasks, timeout=max(remaining, 0))
+    elapsed = time.perf_counter() - started
+    test.stopping = True
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        "software": str(VERSION),
+        "revision": _revision(),
+        "settings": {key: value for key, value in vars(options).items() if key != "output"},
+        "elapsed": elapsed,
+        "joined": len(test.join_latency),
+        "failed_joins": test.failed_joins,
+        "dropouts": test.dropouts,
+        "join_latency": percentiles(test.join_latency),
+        "packets_sent": test.packets_sent,
+        "packets_received": test.packets_received,
+        "sent_per_second": test.packets_sent / elapsed,
+        "received_per_second": test.packets_received / elapsed,
+        "received_bytes_per_second": test.bytes_received / elapsed,
+        "chat_latency": percentiles(test.chat_latency),
+        "block_latency": percentiles(test.block_latency),
+    }
+
+
+def _format_latency(name: str, summary: dict) -> str:
+    if not summary["count"]:
+        return f"{name}: no samples"
+    return (f"{name}: p50 {summary['p50'] * 1000:.1f}ms, p90 {summary['p90'] * 1000:.1f}ms, "
+            f"p99 {summary['p99'] * 1000:.1f}ms, max {summary['max'] * 1000:.1f}ms ({summary['count']} samples)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyccs.loadtest", description="Load test a PyCCS server with bots")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the server")
+    parser.add_argument("-P", "--port", type=int, default=25565, help="Port of the server")
+    parser.add_argument("-b", "--bots", type=int, default=50, help="Number of bots to connect")
+    parser.add_argument("--join-rate", type=float, default=20, help="Bots connected per second, 0 for all at once")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="Seconds to run for, including joining")
+    parser.add_argument("--move-rate", type=float, default=5, help="Position updates per second per bot")
+    parser.add_argument("--block-rate", type=float, default=0.5, help="Blocks placed per second per bot")
+    parser.add_argument("--chat-rate", type=float, default=0.1, help="Chat messages per second per bot")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds a bot may take to join")
+    parser.add_argument("--prefix", default="bot", help="Start of the bots' names")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the bots' behaviour")
+    parser.add_argument("--verify-level", action="store_true", help="Decompress the level each bot downloads")
+    parser.add_argument("-o", "--output", help="File to write the report to as JSON")
+    options = parser.parse_args(argv)
+    report = asyncio.run(run(options))
+    print(f"{report['joined']}/{options.bots} bots joined in {report['elapsed']:.1f}s "
+          f"({report['revision'] or 'unknown revision'})")
+    print(_format_latency("Join latency", report["join_latency"]))
+    print(_format_latency("Chat broadcast latency", report["chat_latency"]))
+    print(_format_latency("Block broadcast latency", report["block_latency"]))
+    print(f"Packets: {report['sent_per_second']:.0f}/s sent, {report['received_per_second']:.0f}/s received")
+    if report["failed_joins"]:
+        print(f"Failed joins: {report['failed_joins']}")
+    if report["dropouts"]:
+        print(f"Dropouts: {report['dropouts']}")
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,181 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Logging which never blocks the event loop.
+
+Loggers get a DroppingQueueHandler, which only formats records and puts them on a bounded queue. A LogListener
+thread takes them off and hands them to the real handlers, flushing them when it runs out of records or at least every
+`flush_interval` seconds. BatchedFileHandler buffers writes in between, and rotates the file once it gets too large.
+
+When records arrive faster than they can be written, records below WARNING are sampled once more than `burst` of
+them arrived in the same second, and dropped entirely once the queue is mostly full. How many were dropped is
+logged once a second while it happens."""
+
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+from typing import List, Optional
+
+_listener: Optional["LogListener"] = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler which sheds low priority records instead of blocking or failing when the queue fills up."""
+
+    def __init__(self, log_queue: queue.Queue, burst: int = 200, sample_every: int = 10):
+        super().__init__(log_queue)
+        self.burst = burst
+        """Records below WARNING let through per second before sampling starts."""
+        self.sample_every = sample_every
+        """While sampling, one in this many records below WARNING is kept."""
+        self.dropped = 0
+        self._second = 0
+        self._seen = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            if self.queue.maxsize and self.queue.qsize() > self.queue.maxsize * 3 // 4:
+                self.dropped += 1
+                return False
+            second = int(time.monotonic())
+            if second != self._second:
+                self._second = second
+                self._seen = 0
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.enqueue(logging.makeLogRecord({"name": record.name, "levelno": logging.WARNING,
+                                                        "levelname": "WARNING",
+                                                        "msg": f"Dropped {dropped} log records"}))
+            self._seen += 1
+            if self._seen > self.burst and self._seen % self.sample_every:
+                self.dropped += 1
+                return False
+        return super().handle(record)
+
+
+class BatchedFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler which buffers writes, and only flushes when asked to by the LogListener or when an error
+    is logged. Flushing after every record is what makes plain FileHandlers slow under load."""
+
+    def __init__(self, file_name: str, max_bytes: int = 16 * 1024 * 1024, backup_count: int = 5,
+                 buffer_size: int = 64 * 1024):
+        self.buffer_size = buffer_size
+        self.size = 0
+        """Characters in the current file, counted as they are written. RotatingFileHandler seeks to the end of the
+        file to find out instead, which flushes the buffer on every record."""
+        super().__init__(file_name, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding)
+        self.size = stream.seek(0, 2)
+        return stream
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        return 0 < self.maxBytes <= self.size
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            message = self.format(record) + self.terminator
+            self.stream.write(message)
+            self.size += len(message)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+        if record.levelno >= logging.ERROR:
+            self.flush_now()
+
+    def flush(self):
+        pass
+
+    def flush_now(self):
+        self.acquire()
+        try:
+            if self.stream and not self.stream.closed:
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush_now()
+        super().close()
+
+
+class LogListener(logging.handlers.QueueListener):
+    """QueueListener which flushes its handlers whenever the queue runs dry, and at least every *flush_interval*."""
+
+    def __init__(self, log_queue: queue.Queue, *handlers: logging.Handler, flush_interval: float = 1.0):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            if time.monotonic() - self._last_flush > self.flush_interval:
+                self.flush()
+            try:
+                return self.queue.get(block=block, timeout=self.flush_interval)
+            except queue.Empty:
+                self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        for handler in self.handlers:
+            if isinstance(handler, BatchedFileHandler):
+                handler.flush_now()
+            else:
+                handler.flush()
+
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
+def start(logger: logging.Logger, handlers: List[logging.Handler], max_queue: int = 10000) -> LogListener:
+    """Route *logger* through a bounded queue to *handlers*, which are run on a background thread."""
+    global _listener
+    log_queue = queue.Queue(max_queue)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    _listener = LogListener(log_queue, *handlers)
+    _listener.start()
+    return _listener
+
+
+def stop():
+    """Write out every queued record and stop the background thread."""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_in_child():
+    # The listener thread does not survive a fork, give the child a queue and thread of its own.
+    global _listener
+    if not _listener:
+        return
+    log_queue = queue.Queue(_listener.queue.maxsize)
+    for logger in [logging.getLogger()] + list(logging.Logger.manager.loggerDict.values()):
+        for handler in getattr(logger, "handlers", ()):
+            if isinstance(handler, DroppingQueueHandler):
+                handler.queue = log_queue
+    _listener = LogListener(log_queue, *_listener.handlers, flush_interval=_listener.flush_interval)
+    _listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_in_child)
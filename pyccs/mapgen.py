@@ -0,0 +1,138 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""This module generates new Maps in memory. Generators build the block array one Y layer at a time with NumPy, so
+even 1024x256x1024 levels only need a few seconds and little memory beyond the level itself. Layers can also be
+fed straight into SectionedBlocks, for levels too large to hold densely."""
+
+import asyncio
+import numpy
+
+from functools import partial
+from typing import Optional, Iterator
+from pyccs.constants import Block
+from pyccs.protocol import Position
+from pyccs.server import Map
+from pyccs.storage import SectionedBlocks
+
+
+def _build(size: Position, layers: Iterator[numpy.ndarray], spawn: Position, sectioned: bool) -> Map:
+    """Build a Map from an iterator of (Z, X) block layers, from the bottom of the level up."""
+    if sectioned:
+        return Map(size, SectionedBlocks.from_chunks(size.x * size.y * size.z, layers), spawn)
+    data = bytearray(size.x * size.y * size.z)
+    view = numpy.frombuffer(data, dtype=numpy.uint8).reshape((size.y, size.z, size.x))
+    for y, layer in enumerate(layers):
+        view[y] = layer
+    return Map(size, data, spawn)
+
+
+def _value_noise(width: int, length: int, scale: int, rng: numpy.random.Generator) -> numpy.ndarray:
+    """Return a (length, width) array of smoothly interpolated value noise in [0, 1)."""
+    lattice = rng.random(((length - 1) // scale + 2, (width - 1) // scale + 2), dtype=numpy.float32)
+    xs = numpy.arange(width, dtype=numpy.float32) / scale
+    zs = numpy.arange(length, dtype=numpy.float32) / scale
+    x0 = xs.astype(numpy.intp)
+    z0 = zs.astype(numpy.intp)
+    tx = xs - x0
+    tz = zs - z0
+    tx = tx * tx * (3 - 2 * tx)
+    tz = (tz * tz * (3 - 2 * tz))[:, None]
+    north = lattice[z0[:, None], x0] * (1 - tx) + lattice[z0[:, None], x0 + 1] * tx
+    south = lattice[z0[:, None] + 1, x0] * (1 - tx) + lattice[z0[:, None] + 1, x0 + 1] * tx
+    return north * (1 - tz) + south * tz
+
+
+def empty(size: Position, seed: Optional[int] = None, sectioned: bool = False) -> Map:
+    """Generate a Map made entirely of air."""
+    spawn = Position(size.x // 2, size.y // 2, size.z // 2)
+    if sectioned:
+        return Map(size, SectionedBlocks(size.x * size.y * size.z), spawn)
+    return Map(size, spawn=spawn)
+
+
+def flatgrass(size: Position, seed: Optional[int] = None, sectioned: bool = False) -> Map:
+    """Generate a flat Map of dirt topped with grass, filling the lower half of the level."""
+    ground = size.y // 2
+
+    def layers():
+        layer = numpy.empty((size.z, size.x), dtype=numpy.uint8)
+        for y in range(size.y):
+            layer.fill(Block.DIRT if y < ground - 1 else Block.GRASS if y == ground - 1 else Block.AIR)
+            yield layer
+
+    return _build(size, layers(), Position(size.x // 2, ground + 1, size.z // 2), sectioned)
+
+
+def terrain(size: Position, seed: Optional[int] = None, sectioned: bool = False, octaves: int = 5) -> Map:
+    """Generate rolling hills and lakes from a fractal value noise heightmap."""
+    rng = numpy.random.default_rng(seed)
+    noise = numpy.zeros((size.z, size.x), dtype=numpy.float32)
+    scale = max(min(size.x, size.z) // 2, 2)
+    amplitude = 1.0
+    total = 0.0
+    for _ in range(octaves):
+        noise += _value_noise(size.x, size.z, scale, rng) * amplitude
+        total += amplitude
+        amplitude /= 2
+        scale = max(scale // 2, 1)
+    noise /= total
+    heights = (size.y * (0.25 + noise * 0.5)).astype(numpy.int16)
+    numpy.clip(heights, 1, size.y - 2, out=heights)
+    water = int(size.y * 0.45)
+    surface = numpy.where(heights < water + 2, Block.SAND, Block.GRASS).astype(numpy.uint8)
+
+    def layers():
+        layer = numpy.empty((size.z, size.x), dtype=numpy.uint8)
+        for y in range(size.y):
+            if y == 0:
+                layer.fill(Block.BEDROCK)
+                yield layer
+                continue
+            layer.fill(Block.AIR)
+            depth = heights - y
+            layer[depth > 3] = Block.STONE
+            layer[(depth > 0) & (depth <= 3)] = Block.DIRT
+            numpy.copyto(layer, surface, where=depth == 0)
+            if y <= water:
+                layer[depth < 0] = Block.STILL_WATER
+            yield layer
+
+    center = max(int(heights[size.z // 2, size.x // 2]), water)
+    return _build(size, layers(), Position(size.x // 2, center + 2, size.z // 2), sectioned)
+
+
+GENERATORS = {
+    "empty": empty,
+    "void": empty,
+    "flat": flatgrass,
+    "flatgrass": flatgrass,
+    "terrain": terrain,
+}
+"""Map of generator names to functions which take a size, seed and sectioned flag and return a new Map."""
+
+
+def parse_size(text: str) -> Position:
+    """Parse a level size written as XxYxZ, e.g. 256x64x256."""
+    try:
+        x, y, z = (int(part) for part in text.lower().split("x"))
+    except ValueError as e:
+        raise ValueError(f"Expected a level size like 256x64x256, got '{text}'") from e
+    if min(x, y, z) < 1 or max(x, y, z) > 32767:
+        raise ValueError(f"Level size {text} is out of range")
+    return Position(x, y, z)
+
+
+def generate(generator: str, size: Position, seed: Optional[int] = None, sectioned: bool = False) -> Map:
+    """Generate a new Map using the named generator. If *sectioned* is true, blocks are kept in SectionedBlocks."""
+    if function := GENERATORS.get(generator, None):
+        return function(size, seed, sectioned)
+    raise ValueError(f"Unknown generator '{generator}', expected one of {', '.join(GENERATORS)}")
+
+
+async def generate_async(generator: str, size: Position, seed: Optional[int] = None,
+                         sectioned: bool = False) -> Map:
+    """Generate a new Map in the default executor, so the event loop keeps running while it is built."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(generate, generator, size, seed, sectioned))
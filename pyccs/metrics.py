@@ -0,0 +1,215 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""This module keeps counters, gauges and histograms about the running server, and serves them over HTTP in the
+Prometheus text format.
+
+Metrics are plain Python objects updated in place, with label values passed positionally. Instrumented code checks
+`enabled` first, so a server without a metrics port only pays for that check."""
+
+import asyncio
+import logging
+
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+"""Default histogram buckets, in seconds."""
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+"""Histogram buckets for counts of things, like packets per write."""
+
+enabled: bool = False
+"""Whether instrumented code should update metrics. Set by `serve`."""
+time_listeners: bool = False
+"""Whether events also time each of their listeners, which costs a few microseconds per listener. For finding out
+which listener makes an event slow."""
+logger: logging.Logger = logging.getLogger("PyCCS").getChild("metrics")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """Base class of metrics. Each distinct tuple of label values is kept as its own series."""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), registry: "Registry" = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _label_text(self, values: Tuple, extra: str = None) -> str:
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        """Yield (name suffix, label text, value) for every sample of the metric."""
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {value!r}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Value which only goes up."""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), registry: "Registry" = None):
+        super().__init__(name, documentation, labels, registry)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        """Add *amount* to the series for the given label values."""
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield "", self._label_text(labels), value
+
+
+class Gauge(Counter):
+    """Value which can go up and down. If *function* is given, it is called for the value of an unlabelled gauge
+    whenever metrics are collected."""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), registry: "Registry" = None,
+                 function: Callable[[], float] = None):
+        super().__init__(name, documentation, labels, registry)
+        self.function = function
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.function:
+            try:
+                yield "", "", self.function()
+            except Exception:
+                logger.exception(f"Error occurred while collecting {self.name}")
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted into cumulative buckets."""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), registry: "Registry" = None,
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Tuple, list] = {}
+        self._sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        """Record *value* in the series for the given label values."""
+        counts = self._counts.get(labels, None)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def series(self, *labels) -> "HistogramSeries":
+        """Return the series for the given label values, for hot paths which observe the same labels repeatedly."""
+        return HistogramSeries(self, labels)
+
+    def count(self, *labels) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    def samples(self):
+        for labels, counts in list(self._counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield "_bucket", self._label_text(labels, f'le="{bound!r}"'), total
+            total += counts[-1]
+            yield "_bucket", self._label_text(labels, 'le="+Inf"'), total
+            yield "_sum", self._label_text(labels), self._sums[labels]
+            yield "_count", self._label_text(labels), total
+
+
+class HistogramSeries:
+    """One series of a Histogram, bound to its label values so observing skips looking them up."""
+    __slots__ = ("histogram", "labels", "_counts")
+
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self.histogram = histogram
+        self.labels = labels
+        self._counts = None
+
+    def observe(self, value: float):
+        if self._counts is None:
+            self.histogram.observe(value, *self.labels)
+            self._counts = self.histogram._counts[self.labels]
+            return
+        self._counts[bisect_left(self.histogram.buckets, value)] += 1
+        self.histogram._sums[self.labels] += value
+
+
+class Registry:
+    """Collection of metrics which are exposed together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"A metric called {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name, None)
+
+    def expose(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        return "\n".join(metric.expose() for metric in list(self._metrics.values())) + "\n"
+
+
+REGISTRY = Registry()
+"""Registry metrics are added to unless another is given."""
+
+
+async def serve(port: int, host: str = "127.0.0.1", registry: Registry = None) -> asyncio.AbstractServer:
+    """Serve *registry* on http://host:port/metrics, and enable instrumentation. Close the returned server to stop."""
+    global enabled
+    registry = registry if registry is not None else REGISTRY
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, path, _ = request.split(b"\r\n", 1)[0].split(b" ", 2)
+            if method == b"GET" and path.split(b"?", 1)[0] in (b"/", b"/metrics"):
+                status = b"200 OK"
+                body = registry.expose().encode("utf-8")
+            else:
+                status = b"404 Not Found"
+                body = b"Not Found\n"
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError,
+                ValueError):
+            pass
+        finally:
+            writer.close()
+
+    http_server = await asyncio.start_server(handle, host=host, port=port)
+    enabled = True
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return http_server
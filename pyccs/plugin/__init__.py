@@ -3,35 +3,107 @@
 #  If the LICENSE file was not provided, you can find the full text of the license here:
 #  https://opensource.org/licenses/ISC
 
+import asyncio
+import inspect
+import time
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, wraps
+from typing import Optional
+from pyccs import metrics
 from pyccs.protocol import Position
 from pyccs.util import Configuration, wrap_coroutine
 import pyccs.server as server
 
+_PLUGIN_SECONDS = metrics.Histogram("pyccs_plugin_seconds", "Time spent in plugin handlers", ["plugin"])
+_PLUGIN_TIMEOUTS = metrics.Counter("pyccs_plugin_timeouts_total", "Plugin handlers which timed out", ["plugin"])
+_PLUGIN_SKIPPED = metrics.Counter("pyccs_plugin_skipped_total", "Plugin handlers skipped by an open circuit breaker",
+                                  ["plugin"])
+
+
+class CircuitBreaker:
+    """Stops a plugin's handlers from running once *threshold* of them timed out in a row. After *cooldown* seconds
+    a single call is let through again, and the breaker closes if it finishes in time."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        """Handlers which timed out in a row."""
+        self.opened: Optional[float] = None
+        """Monotonic time the breaker last opened or let a trial call through, None while closed."""
+
+    def allow(self) -> bool:
+        """Return if a handler may run now."""
+        if self.opened is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened >= self.cooldown:
+            self.opened = now
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self) -> bool:
+        """Count a timeout, return True if the breaker opened because of it."""
+        self.failures += 1
+        if self.failures < self.threshold:
+            return False
+        opening = self.opened is None
+        self.opened = time.monotonic()
+        return opening
+
 
 class Command:
-    def __init__(self, plugin, func, *names, op_only):
+    def __init__(self, plugin, func, *names, op_only, blocking=False, timeout=None):
         self.plugin = plugin
         self.names = names
         self._func = func
         self.op_only = op_only
+        self.blocking = blocking
+        self.timeout = timeout
         self.__doc__ = func.__doc__
 
     def __str__(self):
         return f"Command {self.names[0]} from {self.plugin}"
 
-    async def __call__(self, server, player, *args):
+    async def __call__(self, player, *args):
         if self.op_only and not player.is_op:
             await player.send_message("&cOnly operators can run this command.")
             return
-        await self._func(server, player, *args)
+        await self.plugin.run_handler(self._func, (server, player, *args), self.blocking, self.timeout)
 
 
 class Plugin:
-    def __init__(self, name, config_defaults: dict = {}):
+    """A set of handlers and commands. Handlers are coroutine functions run on the event loop, unless they are
+    declared blocking, in which case they are plain functions run on a thread pool of *max_concurrent* threads. A
+    blocking handler may return an awaitable, which is then awaited on the event loop, to send the result of its work
+    to players for example. Blocking handlers time out after *timeout* seconds, other handlers only if given a
+    timeout. Timed out handlers count towards the plugin's circuit breaker."""
+
+    def __init__(self, name, config_defaults: dict = {}, max_concurrent: int = 4, timeout: float = 5.0):
         self.name = name
         self.config = Configuration(config_defaults)
+        self.commands = {}
+        self.module = None
+        self.max_concurrent = max_concurrent
+        """Blocking calls of this plugin which may run at once."""
+        self.timeout = timeout
+        """Seconds blocking handlers may take unless they declare a timeout of their own."""
+        self.breaker = CircuitBreaker()
+        self.time_spent = 0.0
+        """Seconds spent in this plugin's handlers and commands."""
+        self.timeouts = 0
         self.__connections = []
-        self.on_shutdown(wrap_coroutine(self.config.save))
+        self.__semaphore = None
+        self.__threads = None
+        self.__processes = None
+        self.on_start(wrap_coroutine(self.config.start_watching))
+        self.on_shutdown(self.config.close)
+        self.on_shutdown(self._shutdown_executors)
 
     def __str__(self):
         return f"{self.name} from {self.module if self.module else 'unknown module'}"
@@ -42,17 +114,105 @@ class Plugin:
     def logger(self):
         return server.logger.getChild(self.name)
 
-    def on_packet(self, packet_id):
+    def _executor(self, process: bool) -> Executor:
+        if process:
+            if self.__processes is None:
+                self.__processes = ProcessPoolExecutor(self.max_concurrent)
+            return self.__processes
+        if self.__threads is None:
+            self.__threads = ThreadPoolExecutor(self.max_concurrent, thread_name_prefix=f"plugin-{self.name}")
+        return self.__threads
+
+    async def _shutdown_executors(self):
+        for executor in (self.__threads, self.__processes):
+            if executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self.__threads = self.__processes = None
+
+    async def run_blocking(self, func, *args, timeout: Optional[float] = None, process: bool = False):
+        """Run the plain function *func* on this plugin's thread pool, or process pool if *process* is true, and
+        return its result. Raises asyncio.TimeoutError if it does not finish within *timeout* seconds, including the
+        time spent waiting for one of the plugin's `max_concurrent` slots. The slot stays taken until *func* really
+        returns, since threads cannot be interrupted."""
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrent)
+        semaphore = self.__semaphore
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        await asyncio.wait_for(semaphore.acquire(), timeout)
+
+        abandoned = False
+
+        def finished(done: asyncio.Future):
+            semaphore.release()
+            error = None if done.cancelled() else done.exception()
+            if error and abandoned:
+                self.logger().error(f"Error in timed out call {func.__qualname__}", exc_info=error)
+
+        try:
+            future = loop.run_in_executor(self._executor(process), partial(func, *args))
+        except BaseException:
+            semaphore.release()
+            raise
+        future.add_done_callback(finished)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), deadline and max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            abandoned = True
+            raise
+
+    async def run_handler(self, func, args: tuple, blocking: bool = False, timeout: Optional[float] = None):
+        """Run a handler of this plugin with *args*, unless its circuit breaker is open. Records the time spent and
+        counts timeouts, which are logged instead of raised."""
+        if not self.breaker.allow():
+            _PLUGIN_SKIPPED.inc(self.name)
+            return
+        started = time.perf_counter()
+        try:
+            if blocking:
+                result = await self.run_blocking(func, *args, timeout=timeout or self.timeout)
+                if inspect.isawaitable(result):
+                    await result
+            elif timeout:
+                await asyncio.wait_for(func(*args), timeout)
+            else:
+                await func(*args)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            _PLUGIN_TIMEOUTS.inc(self.name)
+            if self.breaker.failure():
+                self.logger().error(f"{self} timed out {self.breaker.failures} times in a row, "
+                                    f"skipping its handlers for {self.breaker.cooldown:g}s")
+            else:
+                self.logger().warning(f"{func.__qualname__} from {self} timed out")
+        else:
+            if self.breaker.failures:
+                self.breaker.success()
+        finally:
+            elapsed = time.perf_counter() - started
+            self.time_spent += elapsed
+            if metrics.enabled:
+                _PLUGIN_SECONDS.observe(elapsed, self.name)
+
+    def _guard(self, func, blocking: bool, timeout: Optional[float]):
+        @wraps(func)
+        async def guarded(*args):
+            await self.run_handler(func, args, blocking, timeout)
+        return guarded
+
+    def on_packet(self, packet_id, blocking=False, timeout=None):
         def inner(func):
+            @wraps(func)
             async def check(player, packet):
                 if packet.packet_id() == packet_id:
-                    await func(player, packet)
+                    await self.run_handler(func, (player, packet), blocking, timeout)
             self._bind_connection(server.incoming_packet, check)
+            return func
         return inner
 
-    def on_command(self, *names, op_only=False):
+    def on_command(self, *names, op_only=False, blocking=False, timeout=None):
         def inner(func):
-            command = Command(self, func, *names, op_only=op_only)
+            command = Command(self, func, *names, op_only=op_only, blocking=blocking, timeout=timeout)
             for name in names:
                 self.commands[name] = command
             return command
@@ -61,12 +221,20 @@ class Plugin:
 
     def on_start(self, func):
         self._bind_connection(server.starting, func)
+        return func
 
     def on_shutdown(self, func):
         self._bind_connection(server.shutdown, func)
+        return func
 
-    def on_player_added(self, func):
-        self._bind_connection(server.player_added, func)
+    def on_player_added(self, func=None, *, blocking=False, timeout=None):
+        def inner(func):
+            self._bind_connection(server.player_added, self._guard(func, blocking, timeout))
+            return func
+        return inner(func) if func else inner
 
-    def on_player_removing(self, func):
-        self._bind_connection(server.player_removing, func)
+    def on_player_removing(self, func=None, *, blocking=False, timeout=None):
+        def inner(func):
+            self._bind_connection(server.player_removing, self._guard(func, blocking, timeout))
+            return func
+        return inner(func) if func else inner
@@ -3,36 +3,83 @@
 #  If the LICENSE file was not provided, you can find the full text of the license here:
 #  https://opensource.org/licenses/ISC
 
+import pyccs.server as server
+
+from typing import Optional
+from pyccs import cluster
+from pyccs.access import AccessStore, parse_network
 from . import Plugin
 
 PLUGIN = Plugin("Autocracy", {
     "operators": [],
     "bans": [],
-    "loopback_op": False
+    "loopback_op": False,
+    "database": "autocracy.db"
 })
+store: Optional[AccessStore] = None
+"""Operators and bans, open while the server is running."""
+server.operators_by_default = False
+
+
+@PLUGIN.on_start
+async def open_store():
+    global store
+    store = AccessStore(PLUGIN.config.get("database"))
+    operators, bans = PLUGIN.config.get("operators"), PLUGIN.config.get("bans")
+    if operators or bans:
+        store.import_lists(operators, bans)
+        PLUGIN.config.set("operators", [])
+        PLUGIN.config.set("bans", [])
+        await PLUGIN.config.flush()
+        PLUGIN.logger().info(f"Moved operators and bans from the configuration to {store.file_name}")
+    cluster.listen("access", _access_changed)
+    if not store.operators:
+        PLUGIN.logger().warning("There are no operators yet, players connecting from this machine are operators until "
+                                "someone is made one with /op, or listed under operators in the configuration.")
+
+
+async def _share_changes():
+    """Tell the other cluster workers to read the store again, once the change is written."""
+    if cluster.worker:
+        await store.flush()
+        await cluster.broadcast("access")
+
+
+async def _access_changed(message):
+    await store.reload()
+    for online in server.get_players():
+        if ban := store.is_banned(online.name, online.ip):
+            await server.remove_player(online, f"Banned: {ban.reason}" if ban.reason else "Banned")
+
+
+@PLUGIN.on_shutdown
+async def close_store():
+    global store
+    if store:
+        closing, store = store, None
+        await closing.close()
 
 
 @PLUGIN.on_player_added
-async def init_player(server, player):
-    logger = PLUGIN.logger(server)
-    if PLUGIN.config.get("loopback_op"):
+async def init_player(player):
+    logger = PLUGIN.logger()
+    if PLUGIN.config.get("loopback_op") or not store.operators:
         if player.ip != "127.0.0.1":
             logger.debug(f"Player {player} is not from loopback.")
             return
-    else:
-        if player.name not in PLUGIN.config.get("operators"):
-            logger.debug(f"Player {player} is not an operator.")
-            return
+    elif not store.is_operator(player.name):
+        logger.debug(f"Player {player} is not an operator.")
+        return
     logger.info(f"Granted {player} operator status.")
-    await player.set_op(True)
+    player.is_op = True
     await player.send_message("Granted operator status")
 
 
 @PLUGIN.on_player_added
-async def check_bans(server, player):
-    if player.name in PLUGIN.config.get("bans"):
-        PLUGIN.logger(server).info(f"Player {player} is on the ban list.")
-        await server.remove_player(player, "Banned")
+async def check_bans(player):
+    if ban := store.is_banned(player.name, player.ip):
+        PLUGIN.logger().info(f"Player {player} is banned by {ban.target}.")
+        await server.remove_player(player, f"Banned: {ban.reason}" if ban.reason else "Banned")
 
 
 @PLUGIN.on_command("op", op_only=True)
@@ -41,11 +88,12 @@ async def op_player(server, player, *args):
     Grants a player operator powers. Requires operator."""
     if len(args) == 1:
         if target := server.get_player(name=args[0]):
-            await target.set_op(True)
+            target.is_op = True
             await player.send_message(f"Made {target} an operator!")
             await target.send_message(f"Granted operator status by {player}")
-            PLUGIN.config.get("operators").append(target.name)
-            PLUGIN.logger(server).info(f"{player} gave op to {target}")
+            store.add_operator(target.name, player.name)
+            await _share_changes()
+            PLUGIN.logger().info(f"{player} gave op to {target}")
         else:
             await player.send_message("&cCan't find that player.")
     else:
@@ -58,13 +106,12 @@ async def deop_player(server, player, *args):
     Removes operator powers from a player. Requires operator."""
     if len(args) == 1:
         if target := server.get_player(name=args[0]):
-            ops = PLUGIN.config.get("operators")
-            await target.set_op(False)
+            target.is_op = False
             await player.send_message(f"Deoped {target}")
             await target.send_message(f"You were deoped by {player}")
-            if target.name in ops:
-                ops.remove(target.name)
-            PLUGIN.logger(server).info(f"{player} deoped {target}")
+            store.remove_operator(target.name)
+            await _share_changes()
+            PLUGIN.logger().info(f"{player} deoped {target}")
         else:
             await player.send_message("&cCan't find that player.")
     else:
@@ -72,32 +119,37 @@ async def deop_player(server, player, *args):
 
 
 @PLUGIN.on_command("ban", op_only=True)
-async def ban_player(server, player, *args):
-    """ban [player]
-    Banishes someone. Requires operator."""
-    if len(args) == 1:
-        if target := server.get_player(name=args[0]):
-            await player.send_message(f"Banished {target}")
-            PLUGIN.config.get("bans").append(target.name)
-            PLUGIN.logger(server).info(f"{player} banished {target}")
-            await server.remove_player(target, "Banned")
-        else:
-            await player.send_message("&cCan't find that player.")
+async def ban_player(server, player, target=None, *reason):
+    """ban [player|address|range] [reason]
+    Banishes someone, or every address in a range like 10.0.0.0/8. Requires operator."""
+    if not target:
+        await player.send_message("&cExpected at least 1 argument")
+        return
+    if parse_network(target):
+        ban = store.ban(target, " ".join(reason), player.name)
+        matches = [online for online in server.get_players() if store.is_banned(ip=online.ip) is ban]
+    elif online := server.get_player(name=target):
+        ban = store.ban(online.name, " ".join(reason), player.name)
+        matches = [online]
     else:
-        await player.send_message("&cExpected 1 argument")
+        ban = store.ban(target, " ".join(reason), player.name)
+        matches = []
+    await player.send_message(f"Banished {ban.target}")
+    await _share_changes()
+    PLUGIN.logger().info(f"{player} banished {ban.target}")
+    for online in matches:
+        await server.remove_player(online, f"Banned: {ban.reason}" if ban.reason else "Banned")
 
 
 @PLUGIN.on_command("unban", op_only=True)
 async def unban_player(server, player, *args):
-    """unban [player]
-    Removes any banishment from a player. Requires operator."""
+    """unban [player|address|range]
+    Removes a banishment. Requires operator."""
     if len(args) == 1:
-        target = args[0]
-        bans = PLUGIN.config.get("bans")
-        if target in bans:
-            await player.send_message(f"Unbanned {target}")
-            bans.remove(target)
-            PLUGIN.logger(server).info(f"{player} unbanned {target}")
+        if store.unban(args[0]):
+            await _share_changes()
+            await player.send_message(f"Unbanned {args[0]}")
+            PLUGIN.logger().info(f"{player} unbanned {args[0]}")
         else:
             await player.send_message("&cNo bans on that player.")
     else:
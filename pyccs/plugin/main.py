@@ -3,8 +3,172 @@
 #  If the LICENSE file was not provided, you can find the full text of the license here:
 #  https://opensource.org/licenses/ISC
 
+import asyncio
+import os
+import time
+
+from pyccs import cluster, mapgen, profiles, shared, watchdog
 from pyccs.plugin import Plugin
+from pyccs.protocol import Position
+from pyccs.protocol import cp7x
 from pyccs.util import Configuration
 
 PLUGIN = Plugin("PyCCS", {})
 
+
+@PLUGIN.on_command("newlvl", op_only=True)
+async def new_level(server, player, file_name=None, generator="flat", size="256x64x256", seed=None, *args):
+    """newlvl [file] [generator] [XxYxZ] [seed]
+    Generates a new level and saves it to the given file. Requires operator."""
+    if not file_name:
+        await player.send_message("&cRequires at least 1 argument")
+        return
+    if not file_name.endswith(".cw"):
+        file_name += ".cw"
+    if os.path.exists(file_name):
+        await player.send_message(f"&c{file_name} already exists")
+        return
+    try:
+        size = mapgen.parse_size(size)
+        seed = int(seed) if seed is not None else None
+        await player.send_message(f"Generating {file_name}...")
+        level = await mapgen.generate_async(generator, size, seed)
+    except ValueError as e:
+        await player.send_message(f"&c{e}")
+        return
+    await asyncio.get_running_loop().run_in_executor(None, level.save, file_name)
+    PLUGIN.logger().info(f"{player} generated {file_name} ({generator} {size})")
+    await player.send_message(f"Saved new level to {file_name}")
+
+
+@PLUGIN.on_command("save", op_only=True)
+async def save_level(server, player, *args):
+    """save
+    Saves the level you are on to its file. Requires operator."""
+    level = player.map
+    if not level.file_name:
+        await player.send_message("&cThis level has no file to save to")
+        return
+    await shared.save_level(level)
+    PLUGIN.logger().info(f"{player} saved {level.file_name}")
+    await player.send_message(f"Saved level to {level.file_name}")
+
+
+async def _revert(server, player, **query):
+    level = player.map
+    if level.history is None:
+        await player.send_message("&cBlock history is disabled")
+        return 0
+    indices, blocks = level.history.revert(**query)
+    old_blocks = level.get_blocks(indices)
+    level.set_blocks(indices, blocks)
+    level.history.record_many(indices, old_blocks, blocks, player.name)
+    await cp7x.send_blocks(player, level, indices, blocks)
+    return len(indices)
+
+
+@PLUGIN.on_command("undo", op_only=True)
+async def undo_player(server, player, target=None, seconds=None, *args):
+    """undo [player] [seconds]
+    Reverts the block changes a player made, optionally only in the last few seconds. Requires operator."""
+    if not target:
+        await player.send_message("&cRequires at least 1 argument")
+        return
+    try:
+        since = float(seconds) if seconds is not None else None
+    except ValueError:
+        await player.send_message("&cExpected a number of seconds")
+        return
+    count = await _revert(server, player, player=target, since=since)
+    PLUGIN.logger().info(f"{player} reverted {count} blocks changed by {target}")
+    await player.send_message(f"Reverted {count} blocks changed by {target}")
+
+
+@PLUGIN.on_command("undoarea", op_only=True)
+async def undo_area(server, player, *args):
+    """undoarea [x1 y1 z1 x2 y2 z2] [seconds]
+    Reverts every block change inside an area, optionally only in the last few seconds. Requires operator."""
+    try:
+        numbers = [int(arg) for arg in args[:6]]
+        since = float(args[6]) if len(args) > 6 else None
+    except ValueError:
+        await player.send_message("&cExpected numbers as arguments")
+        return
+    if len(numbers) != 6:
+        await player.send_message("&cExpected at least 6 arguments")
+        return
+    region = (Position(*numbers[:3]), Position(*numbers[3:]))
+    count = await _revert(server, player, region=region, since=since)
+    PLUGIN.logger().info(f"{player} reverted {count} blocks between {region[0]} and {region[1]}")
+    await player.send_message(f"Reverted {count} blocks")
+
+
+@PLUGIN.on_command("blockinfo", "bi")
+async def block_info(server, player, *args):
+    """blockinfo [x y z]
+    Shows who changed a block recently."""
+    level = player.map
+    try:
+        position = Position(*(int(arg) for arg in args[:3]))
+    except (TypeError, ValueError):
+        await player.send_message("&cExpected 3 numbers as arguments")
+        return
+    if level.history is None:
+        await player.send_message("&cBlock history is disabled")
+        return
+    log = level.history.block_log(level.index(position))
+    if not log:
+        await player.send_message("No changes recorded for that block")
+    for name, when, old, new in log[-5:]:
+        await player.send_message(f"{name} changed {old} to {new} at {time.strftime('%H:%M:%S', time.localtime(when))}")
+
+
+@PLUGIN.on_command("stats")
+async def show_stats(server, player, name=None, *args):
+    """stats [player]
+    Shows how long you or another player played, and how many blocks they changed."""
+    if not profiles.store:
+        await player.send_message("&cPlayer profiles are disabled")
+        return
+    profile = await profiles.store.get(name or player.name)
+    await player.send_message(f"{profile.name} played for {profile.play_time / 3600:.1f} hours, placed "
+                              f"{profile.blocks_placed} and broke {profile.blocks_broken} blocks")
+
+
+@PLUGIN.on_command("lag")
+async def show_lag(server, player, *args):
+    """lag
+    Shows how far behind the server has been recently."""
+    if not watchdog.monitor:
+        await player.send_message("&cThe watchdog is not running")
+        return
+    lag = watchdog.monitor.percentiles(0.5, 0.99, 1)
+    await player.send_message(f"Event loop lag: median {lag[0.5] * 1000:.1f}ms, 99th {lag[0.99] * 1000:.1f}ms, "
+                              f"worst {lag[1] * 1000:.1f}ms, {watchdog.monitor.stalls} stalls")
+
+
+@PLUGIN.on_command("plugins")
+async def show_plugins(server, player, *args):
+    """plugins
+    Lists plugins and how much time the server spent in each."""
+    for plugin in server.get_plugins():
+        state = "&cdisabled" if plugin.breaker.opened is not None else "&aok"
+        await player.send_message(f"{plugin.name}: {plugin.time_spent * 1000:.0f}ms, {plugin.timeouts} timeouts, "
+                                  f"{state}")
+
+
+@PLUGIN.on_command("goto", "g")
+async def goto_level(server, player, level_name=None, *args):
+    """goto [level]
+    Moves you to another level."""
+    if not level_name:
+        await player.send_message("&cRequires at least 1 argument")
+    elif level := server.get_level(level_name):
+        if level is player.map:
+            await player.send_message("&cYou are already there")
+        else:
+            await cp7x.change_level(player, level)
+    elif cluster.worker and cluster.worker.hosts(level_name):
+        await cluster.worker.migrate(player, level_name)
+    else:
+        await player.send_message("&cCould not find that level")
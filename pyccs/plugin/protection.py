@@ -0,0 +1,108 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+
+import pyccs.server as server
+
+from typing import Optional
+from pyccs import regions
+from pyccs.regions import Region, RegionStore
+from . import Plugin
+
+PLUGIN = Plugin("Protection", {
+    "database": "regions.db"
+})
+store: Optional[RegionStore] = None
+"""Regions of every level, open while the server is running."""
+
+
+@PLUGIN.on_start
+async def open_store():
+    global store
+    if server.operators_by_default:
+        PLUGIN.logger().error("Every player is an operator, so regions would not stop anyone. Not protecting any "
+                              "regions, load a plugin which decides who is an operator, like Autocracy.")
+        return
+    store = RegionStore(PLUGIN.config.get("database"))
+    stored = store.load()
+    for name, level in server.levels.items():
+        if name in stored:
+            regions.index(level).load(stored[name])
+    PLUGIN.logger().info(f"Loaded {sum(map(len, stored.values()))} regions from {store.file_name}")
+
+
+@PLUGIN.on_shutdown
+async def close_store():
+    global store
+    if store:
+        closing, store = store, None
+        await closing.close()
+
+
+async def _add(player, level_name, name=None, *args):
+    try:
+        corners = [int(arg) for arg in args[:6]]
+    except ValueError:
+        await player.send_message("&cExpected numbers as corners")
+        return
+    if not name or len(corners) != 6:
+        await player.send_message("&cExpected a name and 6 numbers")
+        return
+    region = Region.between(name.lower(), corners[:3], corners[3:], args[6:])
+    replaced = regions.index(player.map).add(region)
+    store.put(level_name, region)
+    await player.send_message(f"{'Replaced' if replaced else 'Added'} region {region.name}")
+    PLUGIN.logger().info(f"{player} protected {region.name} on {level_name}")
+
+
+async def _remove(player, level_name, name=None, *args):
+    if name and (region := regions.index(player.map).remove(name)):
+        store.delete(level_name, region.name)
+        await player.send_message(f"Removed region {region.name}")
+        PLUGIN.logger().info(f"{player} removed {region.name} on {level_name}")
+    else:
+        await player.send_message("&cNo region by that name")
+
+
+async def _change_builders(player, level_name, name=None, builder=None, allow=True):
+    index = regions.index(player.map)
+    if not name or not builder:
+        await player.send_message("&cExpected a region and a player")
+    elif region := index.regions.get(name.lower(), None):
+        builders = region.builders | {builder.lower()} if allow else region.builders - {builder.lower()}
+        region = region._replace(builders=builders)
+        index.add(region)
+        store.put(level_name, region)
+        await player.send_message(f"{builder} may {'now' if allow else 'no longer'} build in {region.name}")
+    else:
+        await player.send_message("&cNo region by that name")
+
+
+@PLUGIN.on_command("region", "rg")
+async def region_command(server, player, action=None, *args):
+    """region [here|list|add|remove|allow|deny] ...
+    Shows the protected regions where you stand or on your level. Operators can add one with
+    /region add [name] [x1 y1 z1 x2 y2 z2] [builders], remove one, or allow and deny a player building in one."""
+    level_name = server.level_name(player.map)
+    if action in (None, "here"):
+        position = player.position
+        found = regions.index(player.map).at(int(position.x), int(position.y), int(position.z))
+        await player.send_message(f"Regions here: {', '.join(region.name for region in found) or 'none'}")
+    elif action == "list":
+        names = sorted(regions.index(player.map).regions)
+        await player.send_message(f"{len(names)} regions: {', '.join(names[:40]) or 'none'}")
+    elif not player.is_op:
+        await player.send_message("&cOnly operators can change regions")
+    elif store is None:
+        await player.send_message("&cRegions are not being protected")
+    elif level_name is None:
+        await player.send_message("&cThis level can not have regions")
+    elif action == "add":
+        await _add(player, level_name, *args)
+    elif action == "remove":
+        await _remove(player, level_name, *args)
+    elif action in ("allow", "deny"):
+        await _change_builders(player, level_name, *args[:2], allow=action == "allow")
+    else:
+        await player.send_message("&cUnknown action, see /help region")
@@ -0,0 +1,215 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Player profiles kept between sessions: where players left, how long they played, how many blocks they changed,
+and their settings.
+
+A ProfileStore reads and writes profiles in a SQLite database on a single background thread, and keeps the profiles
+of online players in memory. Changes only mark a profile as dirty; every `flush_interval` seconds, and at shutdown,
+all dirty profiles are written in one transaction, so a crowd disconnecting at once costs one write. A joining
+player's profile is read while their level is still being sent, and is usually ready by the time they are added."""
+
+import asyncio
+import dataclasses
+import json
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import pyccs.server as server
+from pyccs import metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (name TEXT PRIMARY KEY, level TEXT, x REAL, y REAL, z REAL, yaw REAL, pitch REAL,
+                                     play_time REAL, blocks_placed INTEGER, blocks_broken INTEGER, settings TEXT,
+                                     first_seen REAL, last_seen REAL);
+"""
+
+_WRITTEN = metrics.Counter("pyccs_profiles_written_total", "Player profiles written to the database")
+_FLUSH_SECONDS = metrics.Histogram("pyccs_profile_flush_seconds", "Time taken to write a batch of profiles")
+
+store: Optional["ProfileStore"] = None
+"""The open ProfileStore, if profiles are enabled."""
+
+
+@dataclasses.dataclass
+class Profile:
+    name: str
+    level: Optional[str] = None
+    """Name of the level the player was last on."""
+    position: Optional[Tuple[float, float, float, float, float]] = None
+    """Where the player was last, and their yaw and pitch."""
+    play_time: float = 0.0
+    """Seconds spent on the server."""
+    blocks_placed: int = 0
+    blocks_broken: int = 0
+    settings: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    first_seen: float = dataclasses.field(default_factory=time.time)
+    last_seen: float = dataclasses.field(default_factory=time.time)
+
+    def row(self) -> tuple:
+        return (self.name.lower(), self.level, *(self.position or (None,) * 5), self.play_time, self.blocks_placed,
+                self.blocks_broken, json.dumps(self.settings), self.first_seen, self.last_seen)
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "Profile":
+        name, level, x, y, z, yaw, pitch, play_time, placed, broken, settings, first_seen, last_seen = row
+        return cls(name, level, None if x is None else (x, y, z, yaw, pitch), play_time, placed, broken,
+                   json.loads(settings), first_seen, last_seen)
+
+
+class ProfileStore:
+    """Profiles stored in the SQLite database *file_name*, written back every *flush_interval* seconds."""
+
+    def __init__(self, file_name: str, flush_interval: float = 10.0):
+        self.file_name = file_name
+        self.flush_interval = flush_interval
+        self._profiles: Dict[str, Profile] = {}
+        """Profiles in memory, by lowercase name."""
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._dirty: Set[str] = set()
+        self._online: Dict[server.Player, Profile] = {}
+        self._accounted: Dict[server.Player, float] = {}
+        """When each online player's play time was last added to their profile."""
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="profile-store")
+        self._db = sqlite3.connect(file_name, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._connections = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _read(self, key: str) -> Profile:
+        row = self._db.execute("SELECT * FROM profiles WHERE name = ?", (key,)).fetchone()
+        return Profile.from_row(row) if row else Profile(key)
+
+    def prefetch(self, name: str):
+        """Start reading the profile of *name* from the database, if it is not in memory yet."""
+        key = name.lower()
+        if key not in self._profiles and key not in self._loading:
+            self._loading[key] = asyncio.ensure_future(self._load(key))
+
+    async def _load(self, key: str) -> Profile:
+        try:
+            profile = await asyncio.wrap_future(self._writer.submit(self._read, key))
+            return self._profiles.setdefault(key, profile)
+        finally:
+            self._loading.pop(key, None)
+
+    async def get(self, name: str) -> Profile:
+        """Return the profile of *name*, a new one if they never played before."""
+        key = name.lower()
+        if profile := self._profiles.get(key, None):
+            return profile
+        self.prefetch(key)
+        return await self._loading[key]
+
+    def profile(self, player) -> Optional[Profile]:
+        """Return the profile of *player*, once they were added."""
+        return self._online.get(player, None)
+
+    def changed(self, profile: Profile):
+        """Mark *profile* to be written with the next flush."""
+        self._dirty.add(profile.name.lower())
+
+    def block_changed(self, player, block_id: int):
+        if profile := self._online.get(player, None):
+            if block_id:
+                profile.blocks_placed += 1
+            else:
+                profile.blocks_broken += 1
+            self._dirty.add(profile.name.lower())
+
+    def _account(self, player, profile: Profile, now: float):
+        profile.play_time += now - self._accounted.get(player, now)
+        self._accounted[player] = now
+        if (level_name := server.level_name(player.map)) is not None:
+            position = player.position
+            profile.level = level_name
+            profile.position = (position.x, position.y, position.z, position.yaw, position.pitch)
+        profile.last_seen = time.time()
+        self._dirty.add(profile.name.lower())
+
+    async def _player_added(self, player):
+        profile = await self.get(player.name)
+        if server.get_player(player_id=player.player_id) is not player:
+            return
+        self._online[player] = profile
+        self._accounted[player] = time.monotonic()
+        if profile.position and profile.level == server.level_name(player.map):
+            from pyccs.protocol import Position, cp7x  # cp7x imports this module
+            await cp7x.teleport(player, Position(*profile.position))
+        profile.last_seen = time.time()
+        self._dirty.add(profile.name.lower())
+
+    async def _player_removing(self, player, reason):
+        if profile := self._online.pop(player, None):
+            self._account(player, profile, time.monotonic())
+            self._accounted.pop(player, None)
+
+    def _write(self, rows: List[tuple]):
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(f"INSERT OR REPLACE INTO profiles VALUES ({', '.join('?' * 13)})", rows)
+
+    async def flush(self):
+        """Write every dirty profile in one transaction, and forget the profiles of players which are offline."""
+        now = time.monotonic()
+        for player, profile in self._online.items():
+            self._account(player, profile, now)
+        dirty, self._dirty = self._dirty, set()
+        if dirty:
+            rows = [self._profiles[key].row() for key in dirty if key in self._profiles]
+            started = time.perf_counter()
+            try:
+                await asyncio.wrap_future(self._writer.submit(self._write, rows))
+            except Exception:
+                server.logger.exception(f"Could not write {len(rows)} profiles to {self.file_name}")
+                self._dirty |= dirty
+                return
+            _FLUSH_SECONDS.observe(time.perf_counter() - started)
+            _WRITTEN.inc(amount=len(rows))
+        online = {profile.name.lower() for profile in self._online.values()}
+        for key in [key for key in self._profiles if key not in online and key not in self._dirty]:
+            del self._profiles[key]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._connections = [server.player_added.connect(self._player_added),
+                             server.player_removing.connect(self._player_removing)]
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        """Write every dirty profile and close the database."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for connection in self._connections:
+            connection.disconnect()
+        await self.flush()
+        await asyncio.wrap_future(self._writer.submit(self._db.close))
+        self._writer.shutdown()
+
+
+def enable(file_name: str, flush_interval: float = 10.0):
+    """Keep player profiles in *file_name* while the server is running."""
+
+    async def start():
+        global store
+        store = ProfileStore(file_name, flush_interval)
+        store.start()
+
+    async def stop():
+        global store
+        if store:
+            closing, store = store, None
+            await closing.close()
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
@@ -261,3 +261,20 @@ class Packet:
         for mapping in self.__packet_info.byte_map:
             packer.add(mapping[0], getattr(self, mapping[1]))
         return packer.data
+
+
+class EncodedPacket:
+    """One or more packets encoded ahead of time, sent as they are. The same EncodedPacket can be sent to any number
+    of players without encoding it again."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __str__(self):
+        return f"Encoded packet {self.packet_id()} ({len(self.data)} bytes)"
+
+    def packet_id(self):
+        return self.data[0]
+
+    def to_bytes(self) -> bytes:
+        return self.data
@@ -4,10 +4,13 @@
 #  https://opensource.org/licenses/ISC
 """Protocol definition for Classic Protocol v7/CPE"""
 
-import gzip
 import hashlib
+import weakref
 import pyccs.server as server
+import pyccs.shared as shared
 
+from typing import Dict, NamedTuple, Optional
+from pyccs import entities, metrics, profiles, regions
 from pyccs.protocol import *
 from pyccs.plugin import Plugin
 
@@ -115,6 +118,9 @@ PARSEABLES = {
 }
 """A dictionary containing a list of parseable packets, where the key is the ID and the value is the PacketInfo."""
 
+_LEVELS_SENT = metrics.Counter("pyccs_levels_sent_total", "Levels sent to joining players")
+_LEVEL_BYTES_SENT = metrics.Counter("pyccs_level_sent_bytes_total", "Bytes of compressed level data sent")
+
 PLUGIN = Plugin("ClassicServer7x", {
     "default_motd": "github.com/jshtab/pyccs",
     "verify_names": False,
@@ -122,6 +128,11 @@ PLUGIN = Plugin("ClassicServer7x", {
 })
 
 
+class Settings(NamedTuple):
+    default_motd: str = ""
+    verify_names: bool = False
+
+
 @PLUGIN.on_packet(0x0d)
 async def handle_chat(player, packet):
     formatted_message = f"{player.name}: {packet.message}"
@@ -134,30 +145,63 @@ async def handle_chat(player, packet):
             message=formatted_message
         )
         await server.relay_to_all(player, message_packet)
+        await server.chat.fire(player, formatted_message)
 
 
 @PLUGIN.on_packet(0x05)
 async def update_block(player, packet):
     block_id = packet.block_id if packet.mode == 1 else 0
     position = packet.position
-    server.main_level.set_block(position, block_id)
+    level = player.map
+    if not level.contains(position):
+        return
+    old_block = level.get_block(position)
+    if region := regions.check(player, level, position):
+        await player.send_packet(SERVER_SET_BLOCK.to_packet(position=position, block_id=old_block))
+        await player.send_message(f"&c{region.name} is protected")
+        return
+    level.set_block(position, block_id)
+    if level.history is not None and old_block != block_id:
+        level.history.record(level.index(position), old_block, block_id, player.name)
+    if profiles.store:
+        profiles.store.block_changed(player, block_id)
     set_packet = SERVER_SET_BLOCK.to_packet(
         position=position,
         block_id=block_id
     )
-    await server.relay_to_all(player, set_packet)
+    await server.relay_to_all(player, set_packet, level)
+
+
+async def send_blocks(sender, level, indices, blocks):
+    """Tell every player on *level* about blocks changed by *sender*, given by their index in the level."""
+    for index, block_id in zip(indices, blocks):
+        set_packet = SERVER_SET_BLOCK.to_packet(
+            position=level.position(int(index)),
+            block_id=int(block_id)
+        )
+        await server.relay_to_all(sender, set_packet, level)
 
 
 @PLUGIN.on_packet(0x08)
 async def update_player_position(player, packet):
     player.position = packet.position
-    await server.relay_to_others(player, packet)
+    entities.store.update(player.player_id, packet.position)
+    snapshot(player.map).moved(player)
+    await server.relay_to_others(player, packet, player.map)
 
 
 @PLUGIN.on_packet(0x00)
 async def player_handshake(player, packet):
     player.name = packet.username
     player.mp_pass = packet.mp_pass
+    player.identification = packet.to_bytes()
+    if server.is_full():
+        await player.send_packet(DISCONNECT.to_packet(reason="Server is full"))
+        await player.flush()
+        player.drop("Server is full")
+        return
+    if profiles.store:
+        profiles.store.prefetch(player.name)
     success = await _begin_handshake(player)
     if success:
         await server.add_player(player)
@@ -170,13 +214,14 @@ def authenticated(self, salt: str) -> bool:
 
 
 async def _begin_handshake(player) -> bool:
-    if PLUGIN.config.get("verify_names") and not authenticated(player, server.salt):
+    settings = PLUGIN.config.snapshot(Settings)
+    if settings.verify_names and not authenticated(player, server.salt):
         player.drop("Could not authenticate user.")
         return False
     ident_packet = SERVER_IDENTIFICATION.to_packet(
             version=7,
             name=server.name,
-            motd=PLUGIN.config.get("default_motd"),
+            motd=settings.default_motd,
             user_type=0x64 if player.is_op else 0x00
         )
     await player.send_packet(ident_packet)
@@ -185,26 +230,83 @@ async def _begin_handshake(player) -> bool:
     return True
 
 
+class EntitySnapshot:
+    """Encoded spawn packets of every player on a level, kept up to date as players join, move and leave, so a
+    player joining the level is sent all of them at once. A player's packet is only encoded again once they moved
+    more than `SNAPSHOT_DISTANCE` blocks from the position in it, their own position updates correct the rest."""
+
+    def __init__(self):
+        self._spawns: Dict[int, bytes] = {}
+        self._positions: Dict[int, Position] = {}
+        self._encoded: Optional[bytes] = None
+
+    def __len__(self):
+        return len(self._spawns)
+
+    def put(self, player) -> bytes:
+        """Encode the spawn packet of *player* at their current position, and return it."""
+        spawn = SPAWN_PLAYER.to_packet(player_id=player.player_id, name=player.name,
+                                       position=player.position).to_bytes()
+        self._spawns[player.player_id] = spawn
+        self._positions[player.player_id] = player.position
+        self._encoded = None
+        return spawn
+
+    def moved(self, player):
+        last = self._positions.get(player.player_id, None)
+        if last is None:
+            return
+        position = player.position
+        if (position.x - last.x) ** 2 + (position.y - last.y) ** 2 + (position.z - last.z) ** 2 > \
+                SNAPSHOT_DISTANCE ** 2:
+            self.put(player)
+
+    def remove(self, player):
+        if self._spawns.pop(player.player_id, None) is not None:
+            self._positions.pop(player.player_id, None)
+            self._encoded = None
+
+    def encoded(self, exclude=None) -> bytes:
+        """Spawn packets of every player on the level except *exclude*, joined together."""
+        if exclude is not None and exclude.player_id in self._spawns:
+            return b"".join(spawn for player_id, spawn in self._spawns.items() if player_id != exclude.player_id)
+        if self._encoded is None:
+            self._encoded = b"".join(self._spawns.values())
+        return self._encoded
+
+
+SNAPSHOT_DISTANCE = 2.0
+"""Blocks a player may move before their entry in the level's EntitySnapshot is encoded again."""
+_snapshots: "weakref.WeakKeyDictionary[server.Map, EntitySnapshot]" = weakref.WeakKeyDictionary()
+
+
+def snapshot(level) -> EntitySnapshot:
+    """The EntitySnapshot of *level*."""
+    entities = _snapshots.get(level, None)
+    if entities is None:
+        entities = _snapshots[level] = EntitySnapshot()
+    return entities
+
+
 async def _relay_players(to):
-    for _, player in server._players.items():
-        if player:
-            spawn_packet = SPAWN_PLAYER.to_packet(player_id=player.player_id, name=player.name,
-                                                  position=player.position)
-            await to.send_packet(spawn_packet)
+    if spawns := snapshot(to.map).encoded(exclude=to):
+        await to.send_packet(EncodedPacket(spawns))
 
 
 async def _send_level(player):
-    level = server.main_level
+    level = player.map
     await player.send_signal(INITIALIZE_LEVEL)
-    data = level.volume.to_bytes(4, byteorder="big") + bytes(level.data)
-    compressed = gzip.compress(data, 4)
+    compressed = await shared.level_payload(level)
     compressed_size = len(compressed)
+    if metrics.enabled:
+        _LEVELS_SENT.inc()
+        _LEVEL_BYTES_SENT.inc(amount=compressed_size)
     for i in range(0, compressed_size, 1024):
         data = compressed[i:i + 1024]
         packet = LEVEL_DATA_CHUNK.to_packet(
             data=data,
             length=len(data),
-            percent_complete=int((i / compressed_size) * 100)
+            percent_complete=int((min(i + 1024, compressed_size) / compressed_size) * 100)
         )
         await player.send_packet(packet)
     finalize = FINALIZE_LEVEL.to_packet(map_size=level.size)
@@ -213,13 +315,35 @@ async def _send_level(player):
 
 @PLUGIN.on_player_added
 async def init_player(player):
-    spawn_packet = SPAWN_PLAYER.to_packet(player_id=player.player_id, name=player.name, position=player.position)
-    await server.relay_to_others(player, spawn_packet)
-    own_packet = SPAWN_PLAYER.to_packet(player_id=-1, name=player.name, position=server.main_level.spawn)
+    player.position = player.map.spawn
+    entities.store.add(player)
+    spawn_packet = EncodedPacket(snapshot(player.map).put(player))
+    await server.relay_to_others(player, spawn_packet, player.map)
+    own_packet = SPAWN_PLAYER.to_packet(player_id=-1, name=player.name, position=player.map.spawn)
     await player.send_packet(own_packet)
 
 
 @PLUGIN.on_player_removing
 async def rem_player(player, reason):
+    snapshot(player.map).remove(player)
+    entities.store.remove(player.player_id)
     packet = DESPAWN_PLAYER.to_packet(player_id=player.player_id)
-    await server.relay_to_others(player, packet)
\ No newline at end of file
+    await server.relay_to_others(player, packet, player.map)
+
+
+async def teleport(player, position: Position):
+    """Move *player* to *position* on their level, for them and everyone else."""
+    player.position = position
+    entities.store.add(player)
+    snapshot(player.map).put(player)
+    await player.send_packet(PLAYER_POSITION_CHANGE.to_packet(player_id=-1, position=position))
+    await server.relay_to_others(player, PLAYER_POSITION_CHANGE.to_packet(position=position), player.map)
+
+
+async def change_level(player, level):
+    """Move *player* to another level hosted by this server."""
+    await rem_player(player, "Changed level")
+    player.map = level
+    await _send_level(player)
+    await _relay_players(player)
+    await init_player(player)
\ No newline at end of file
@@ -0,0 +1,183 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Per-player rate limits on incoming packets, checked before any handler sees them.
+
+Each player has a token bucket per limited packet ID, which refills at `Rule.rate` tokens a second up to `Rule.burst`.
+A packet which finds its bucket empty is not handled, and its Rule's action is taken instead:
+
+- drop: ignore the packet
+- coalesce: keep only the newest such packet, for movement. The player's read loop handles it once a token is
+  available, unless a newer one arrives and is allowed first
+- revert: send the client the block which is really at the position it tried to change
+- kick: remove the player"""
+
+import asyncio
+import time
+
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import pyccs.server as server
+from pyccs import metrics
+from pyccs.protocol import Packet
+
+DROP = "drop"
+COALESCE = "coalesce"
+REVERT = "revert"
+KICK = "kick"
+ACTIONS = (DROP, COALESCE, REVERT, KICK)
+
+_LIMITED = metrics.Counter("pyccs_rate_limited_packets_total", "Packets over a rate limit", ["packet_id", "action"])
+
+limiter: Optional["RateLimiter"] = None
+"""The running RateLimiter, if rate limits are enabled."""
+
+
+class Rule(NamedTuple):
+    rate: float
+    """Packets a second allowed on average."""
+    burst: float
+    """Packets allowed at once after a quiet period."""
+    action: str = DROP
+
+
+DEFAULT_RULES: Dict[int, Rule] = {
+    0x05: Rule(30, 60, REVERT),
+    0x08: Rule(40, 80, COALESCE),
+    0x0d: Rule(3, 10, DROP),
+}
+"""Limits on block changes, movement and chat. Clients send movement 20 times a second."""
+
+
+class Bucket:
+    __slots__ = ("tokens", "updated", "pending")
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.pending: Optional[Packet] = None
+        """Newest coalesced packet waiting to be handled."""
+
+
+def parse_rule(text: str) -> (int, Rule):
+    """Parse a rule given as ID=RATE/BURST:ACTION, like 0x05=30/60:revert."""
+    packet_id, _, rest = text.partition("=")
+    limits, _, action = rest.partition(":")
+    rate, _, burst = limits.partition("/")
+    action = action or DROP
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown action {action}, expected one of {', '.join(ACTIONS)}")
+    return int(packet_id, 0), Rule(float(rate), float(burst or rate), action)
+
+
+class RateLimiter:
+    """Applies *rules*, by packet ID, to every player."""
+
+    def __init__(self, rules: Dict[int, Rule] = None):
+        self.rules = dict(DEFAULT_RULES if rules is None else rules)
+        self.limited: Dict[int, int] = {}
+        """Packets over their limit so far, by packet ID."""
+        self._buckets: Dict[server.Player, Dict[int, Bucket]] = {}
+        self._pending: Dict[server.Player, Dict[int, Bucket]] = {}
+        """Buckets holding a coalesced packet, by player."""
+        self._connection = None
+
+    def allow(self, player, packet_id: int, packet: Packet) -> bool:
+        """Return if *packet* from *player* may be handled now, taking the rule's action if it may not."""
+        rule = self.rules.get(packet_id, None)
+        if rule is None:
+            return True
+        buckets = self._buckets.get(player, None)
+        if buckets is None:
+            buckets = self._buckets[player] = {}
+        bucket = buckets.get(packet_id, None)
+        if bucket is None:
+            bucket = buckets[packet_id] = Bucket(rule.burst)
+        now = time.monotonic()
+        bucket.tokens = min(rule.burst, bucket.tokens + (now - bucket.updated) * rule.rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            if bucket.pending is not None:
+                self._take_pending(player, packet_id)
+            return True
+        self.limited[packet_id] = self.limited.get(packet_id, 0) + 1
+        _LIMITED.inc(packet_id, rule.action)
+        if rule.action == COALESCE:
+            bucket.pending = packet
+            pending = self._pending.get(player, None)
+            if pending is None:
+                pending = self._pending[player] = {}
+            pending[packet_id] = bucket
+        elif rule.action == REVERT:
+            asyncio.get_running_loop().create_task(self._revert(player, packet))
+        elif rule.action == KICK:
+            asyncio.get_running_loop().create_task(server.remove_player(player, "Sending packets too fast"))
+        return False
+
+    def _due(self, packet_id: int, bucket: Bucket) -> float:
+        return bucket.updated + (1 - bucket.tokens) / self.rules[packet_id].rate
+
+    def pending_delay(self, player) -> Optional[float]:
+        """Seconds until a coalesced packet of *player* may be handled, or None if none is waiting."""
+        pending = self._pending.get(player, None)
+        if pending is None:
+            return None
+        return max(0.0, min(self._due(packet_id, bucket) for packet_id, bucket in pending.items()) - time.monotonic())
+
+    def _take_pending(self, player, packet_id: int) -> Packet:
+        pending = self._pending[player]
+        bucket = pending.pop(packet_id)
+        if not pending:
+            del self._pending[player]
+        packet, bucket.pending = bucket.pending, None
+        return packet
+
+    def release(self, player) -> Tuple[int, Packet]:
+        """Take the coalesced packet of *player* which is due first and spend its token. Called by the player's read
+        loop once `pending_delay` passed, so the packet is handled like any other."""
+        pending = self._pending[player]
+        packet_id = min(pending, key=lambda key: self._due(key, pending[key]))
+        bucket, rule = pending[packet_id], self.rules[packet_id]
+        now = time.monotonic()
+        bucket.tokens = max(0.0, min(rule.burst, bucket.tokens + (now - bucket.updated) * rule.rate) - 1)
+        bucket.updated = now
+        return packet_id, self._take_pending(player, packet_id)
+
+    async def _revert(self, player, packet: Packet):
+        from pyccs.protocol.cp7x import SERVER_SET_BLOCK  # cp7x imports the server, which imports this module
+        if player.map is not None:
+            await player.send_packet(SERVER_SET_BLOCK.to_packet(position=packet.position,
+                                                                block_id=player.map.get_block(packet.position)))
+
+    async def _player_removing(self, player, reason):
+        self._buckets.pop(player, None)
+        self._pending.pop(player, None)
+
+    def start(self):
+        self._connection = server.player_removing.connect(self._player_removing)
+
+    def stop(self):
+        if self._connection:
+            self._connection.disconnect()
+        self._buckets.clear()
+        self._pending.clear()
+
+
+def enable(rules: Dict[int, Rule] = None):
+    """Apply *rules*, or the default rules, while the server is running."""
+
+    async def start():
+        global limiter
+        limiter = RateLimiter(rules)
+        limiter.start()
+
+    async def stop():
+        global limiter
+        if limiter:
+            limiter.stop()
+            limiter = None
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
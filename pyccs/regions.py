@@ -0,0 +1,210 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Protected regions of levels, and who may build in them.
+
+Every level with regions has a RegionIndex, a grid of columns `2 ** CELL_BITS` blocks wide listing the regions which
+overlap each column. Finding the regions around a block is one dictionary lookup and a check of the few regions in
+its column, however many regions the level has. Regions covering more than `MAX_CELLS` columns are kept in a separate
+list which every lookup checks, there should only be a handful of those.
+
+Regions are stored per level name by a RegionStore, which like the AccessStore keeps a SQLite database and writes
+changes to it one row at a time on a background thread."""
+
+import asyncio
+import sqlite3
+import weakref
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+
+import pyccs.server as server
+
+CELL_BITS = 5
+"""Columns of the grid are 32 blocks wide."""
+MAX_CELLS = 256
+"""Regions covering more columns than this are not put in the grid."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS regions (level TEXT, name TEXT, x1 INTEGER, y1 INTEGER, z1 INTEGER, x2 INTEGER,
+                                    y2 INTEGER, z2 INTEGER, builders TEXT, PRIMARY KEY (level, name));
+"""
+
+
+class Region(NamedTuple):
+    name: str
+    low: Tuple[int, int, int]
+    """Lowest corner, inside the region."""
+    high: Tuple[int, int, int]
+    """Highest corner, inside the region."""
+    builders: FrozenSet[str] = frozenset()
+    """Lowercase names of the players who may change blocks in the region, besides operators."""
+
+    @classmethod
+    def between(cls, name: str, first: Iterable[int], second: Iterable[int], builders: Iterable[str] = ()) -> "Region":
+        """The region with corners *first* and *second*, in any order."""
+        first, second = tuple(first), tuple(second)
+        return cls(name, tuple(map(min, first, second)), tuple(map(max, first, second)),
+                   frozenset(builder.lower() for builder in builders))
+
+    def contains(self, x: int, y: int, z: int) -> bool:
+        low, high = self.low, self.high
+        return low[0] <= x <= high[0] and low[1] <= y <= high[1] and low[2] <= z <= high[2]
+
+    def allows(self, player) -> bool:
+        """Return if *player* may change blocks in the region."""
+        return player.is_op or player.name.lower() in self.builders
+
+    def cells(self) -> Iterable[Tuple[int, int]]:
+        for cell_x in range(self.low[0] >> CELL_BITS, (self.high[0] >> CELL_BITS) + 1):
+            for cell_z in range(self.low[2] >> CELL_BITS, (self.high[2] >> CELL_BITS) + 1):
+                yield cell_x, cell_z
+
+    def cell_count(self) -> int:
+        return (((self.high[0] >> CELL_BITS) - (self.low[0] >> CELL_BITS) + 1) *
+                ((self.high[2] >> CELL_BITS) - (self.low[2] >> CELL_BITS) + 1))
+
+
+class RegionIndex:
+    """The regions of one level, by name and by the columns they overlap."""
+
+    def __init__(self, regions: Iterable[Region] = ()):
+        self.regions: Dict[str, Region] = {}
+        """Every region by its lowercase name."""
+        self._cells: Dict[Tuple[int, int], List[Region]] = {}
+        self._large: List[Region] = []
+        self.load(regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def _insert(self, region: Region):
+        if region.cell_count() > MAX_CELLS:
+            self._large.append(region)
+        else:
+            cells = self._cells
+            for cell in region.cells():
+                bucket = cells.get(cell, None)
+                if bucket is None:
+                    cells[cell] = [region]
+                else:
+                    bucket.append(region)
+
+    def load(self, regions: Iterable[Region]):
+        """Replace every region with *regions*."""
+        self.regions = {region.name.lower(): region for region in regions}
+        self._cells = {}
+        self._large = []
+        for region in self.regions.values():
+            self._insert(region)
+
+    def add(self, region: Region) -> Optional[Region]:
+        """Add *region*, replacing and returning the region with the same name if there is one."""
+        replaced = self.remove(region.name)
+        self.regions[region.name.lower()] = region
+        self._insert(region)
+        return replaced
+
+    def remove(self, name: str) -> Optional[Region]:
+        region = self.regions.pop(name.lower(), None)
+        if region is None:
+            return None
+        if region in self._large:
+            self._large.remove(region)
+        else:
+            for cell in region.cells():
+                bucket = self._cells[cell]
+                bucket.remove(region)
+                if not bucket:
+                    del self._cells[cell]
+        return region
+
+    def at(self, x: int, y: int, z: int) -> List[Region]:
+        """Every region containing the block at *x*, *y*, *z*."""
+        found = [region for region in self._cells.get((x >> CELL_BITS, z >> CELL_BITS), ()) if
+                 region.contains(x, y, z)]
+        if self._large:
+            found += [region for region in self._large if region.contains(x, y, z)]
+        return found
+
+    def blocking(self, player, x: int, y: int, z: int) -> Optional[Region]:
+        """Return a region containing the block at *x*, *y*, *z* which *player* may not build in, if there is one."""
+        for region in self._cells.get((x >> CELL_BITS, z >> CELL_BITS), ()):
+            if region.contains(x, y, z) and not region.allows(player):
+                return region
+        for region in self._large:
+            if region.contains(x, y, z) and not region.allows(player):
+                return region
+        return None
+
+
+_indexes: "weakref.WeakKeyDictionary[server.Map, RegionIndex]" = weakref.WeakKeyDictionary()
+
+
+def index(level) -> RegionIndex:
+    """The RegionIndex of *level*, created empty if it has none."""
+    regions = _indexes.get(level, None)
+    if regions is None:
+        regions = _indexes[level] = RegionIndex()
+    return regions
+
+
+def check(player, level, position) -> Optional[Region]:
+    """Return the region stopping *player* from changing the block at *position* of *level*, if there is one."""
+    regions = _indexes.get(level, None)
+    if regions is None or player.is_op:
+        return None
+    return regions.blocking(player, int(position.x), int(position.y), int(position.z))
+
+
+class RegionStore:
+    """Regions of every level stored in the SQLite database *file_name*."""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="region-store")
+        self._db = sqlite3.connect(file_name, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    @staticmethod
+    def _row(level_name: str, region: Region) -> tuple:
+        return (level_name, region.name, *region.low, *region.high, " ".join(sorted(region.builders)))
+
+    def load(self) -> Dict[str, List[Region]]:
+        """Read every region, by level name."""
+        levels: Dict[str, List[Region]] = {}
+        for level_name, name, *corners, builders in self._db.execute("SELECT * FROM regions"):
+            levels.setdefault(level_name, []).append(
+                Region(name, tuple(corners[:3]), tuple(corners[3:]), frozenset(builders.split())))
+        return levels
+
+    def _write(self, statement: str, parameters: tuple):
+        self._writer.submit(self._db.execute, statement, parameters).add_done_callback(self._written)
+
+    def _written(self, future: Future):
+        if error := future.exception():
+            server.logger.error(f"Could not write to {self.file_name}", exc_info=error)
+
+    def put(self, level_name: str, region: Region):
+        self._write("INSERT OR REPLACE INTO regions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._row(level_name, region))
+
+    def delete(self, level_name: str, name: str):
+        self._write("DELETE FROM regions WHERE level = ? AND name = ? COLLATE NOCASE", (level_name, name))
+
+    def import_regions(self, level_name: str, regions: Iterable[Region]):
+        """Store many regions of one level in a single transaction, on the background thread."""
+        rows = [self._row(level_name, region) for region in regions]
+
+        def write():
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO regions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        self._writer.submit(write).add_done_callback(self._written)
+
+    async def close(self):
+        """Wait for pending writes and close the database."""
+        await asyncio.wrap_future(self._writer.submit(self._db.close))
+        self._writer.shutdown()
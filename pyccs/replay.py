@@ -0,0 +1,167 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""Replays captures made with `--capture` against a server.
+
+Run with `python -m pyccs.replay replay FILE`. Every captured connection is opened again and sent what the player
+sent, at the recorded pace or scaled with `--speed`, where 0 sends everything as fast as possible. This makes it
+possible to benchmark different versions and configurations with the same traffic. Name verification must be off
+on the server being replayed against. `python -m pyccs.replay info FILE` summarizes a capture."""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from typing import Dict, Optional
+
+from pyccs.capture import read_capture, OPEN, INCOMING, OUTGOING, CLOSE
+
+
+def _rename(data: bytes, name: str) -> bytes:
+    """Replace the username in a player identification packet at the start of *data*."""
+    from pyccs.protocol.cp7x import PLAYER_IDENTIFICATION
+    if not data or data[0] != PLAYER_IDENTIFICATION.packet_id or len(data) < PLAYER_IDENTIFICATION.size() + 1:
+        return data
+    return data[:2] + name.encode("ascii").ljust(64) + data[66:]
+
+
+class Replay:
+    """Sends the incoming traffic of a capture to a server, one connection per captured connection."""
+
+    def __init__(self, file_name: str, host: str, port: int, speed: float = 1.0, rename: Optional[str] = None,
+                 linger: float = 1.0):
+        self.file_name = file_name
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.rename = rename
+        self.linger = linger
+        """Seconds to keep each connection open after its last frame, so the server can finish handling it."""
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connections = 0
+        self.errors: Dict[str, int] = {}
+
+    async def run(self) -> dict:
+        sessions: Dict[int, list] = {}
+        for record in read_capture(self.file_name):
+            if record.kind != OUTGOING:
+                sessions.setdefault(record.connection, []).append(record)
+        started = time.perf_counter()
+        await asyncio.gather(*(self._session(number, records, started) for number, records in sessions.items()))
+        elapsed = time.perf_counter() - started
+        return {
+            "capture": self.file_name,
+            "speed": self.speed,
+            "elapsed": elapsed,
+            "connections": self.connections,
+            "frames_sent": self.frames_sent,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "frames_per_second": self.frames_sent / elapsed if elapsed else 0,
+            "errors": self.errors,
+        }
+
+    async def _wait_until(self, started: float, when: float):
+        if self.speed > 0:
+            delay = started + when / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _drain(self, reader: asyncio.StreamReader):
+        try:
+            while data := await reader.read(65536):
+                self.bytes_received += len(data)
+        except ConnectionError:
+            pass
+
+    async def _session(self, number: int, records: list, started: float):
+        await self._wait_until(started, records[0].time)
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+            return
+        self.connections += 1
+        draining = asyncio.create_task(self._drain(reader))
+        first = True
+        try:
+            for record in records:
+                if record.kind == CLOSE:
+                    await self._wait_until(started, record.time)
+                    break
+                if record.kind != INCOMING:
+                    continue
+                await self._wait_until(started, record.time)
+                data = record.data
+                if first and self.rename:
+                    data = _rename(data, f"{self.rename}{number}")
+                first = False
+                writer.write(data)
+                await writer.drain()
+                self.frames_sent += 1
+                self.bytes_sent += len(data)
+            await asyncio.wait([draining], timeout=self.linger)
+        except ConnectionError as e:
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+        finally:
+            draining.cancel()
+            writer.close()
+
+
+def _info(file_name: str) -> dict:
+    connections = set()
+    counts = {OPEN: 0, INCOMING: 0, OUTGOING: 0, CLOSE: 0}
+    sizes = {INCOMING: 0, OUTGOING: 0}
+    duration = 0.0
+    for record in read_capture(file_name):
+        connections.add(record.connection)
+        counts[record.kind] += 1
+        if record.kind in sizes:
+            sizes[record.kind] += len(record.data)
+        duration = record.time
+    return {
+        "capture": file_name,
+        "duration": duration,
+        "connections": len(connections),
+        "incoming_frames": counts[INCOMING],
+        "incoming_bytes": sizes[INCOMING],
+        "outgoing_frames": counts[OUTGOING],
+        "outgoing_bytes": sizes[OUTGOING],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyccs.replay", description="Inspect and replay PyCCS capture files")
+    commands = parser.add_subparsers(dest="command", required=True)
+    info = commands.add_parser("info", help="Summarize a capture file")
+    info.add_argument("file")
+    replay = commands.add_parser("replay", help="Replay the player traffic in a capture file against a server")
+    replay.add_argument("file")
+    replay.add_argument("--host", default="127.0.0.1", help="Address of the server")
+    replay.add_argument("-P", "--port", type=int, default=25565, help="Port of the server")
+    replay.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Multiple of the recorded pace to replay at, 0 replays as fast as possible")
+    replay.add_argument("--rename", metavar="PREFIX", help="Give replayed players numbered names with this prefix")
+    replay.add_argument("--linger", type=float, default=1.0,
+                        help="Seconds to keep connections open after their last frame")
+    replay.add_argument("-o", "--output", help="File to write the replay report to as JSON")
+    options = parser.parse_args(argv)
+    if options.command == "info":
+        report = _info(options.file)
+    else:
+        report = asyncio.run(Replay(options.file, options.host, options.port, options.speed, options.rename,
+                                      options.linger).run())
+    print(json.dumps(report, indent=4))
+    if getattr(options, "output", None):
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,25 +4,46 @@
 #  https://opensource.org/licenses/ISC
 
 import asyncio
+import gc
 import hashlib
-import nbtlib
+import numpy
 import random
 import string
 import logging
 import textwrap
+import time
+import os
 
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, Iterator, Optional, Sequence
+
+from pyccs import admission, capture, metrics, ratelimit, watchdog
 from pyccs.util import Event
+from pyccs.constants import NON_SOLID_BLOCKS
+from pyccs.storage import SectionedBlocks, iter_blocks, write_classicworld
+from pyccs.history import EditHistory
 from pyccs.protocol import *
 
 
+_SOLID = numpy.ones(256, dtype=bool)
+_SOLID[list(NON_SOLID_BLOCKS)] = False
+
+
 class Player:
     def __init__(self, ip, outgoing_queue):
         self.name = None
         self.player_id = None
         self.map = None
         self.position = Position()
-        self.is_op = True  # TODO: replace with permission system later.
+        self.is_op = operators_by_default
         self.part_buff = ""
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.last_received = time.monotonic()
+        """Monotonic time the last packet from the player arrived."""
+        self.draining_since = 0.0
+        """Monotonic time the write to the player in progress started, 0 if none is."""
         self.__ip = ip
         self.__outgoing_queue = outgoing_queue
         self.__drop = asyncio.Event()
@@ -31,12 +52,31 @@ class Player:
     def __str__(self):
         return f'{"#" if self.is_op else ""}{self.name}@{self.__ip}'
 
+    @property
+    def ip(self) -> str:
+        return self.__ip
+
     async def outgoing_queue(self) -> asyncio.Queue:
         return self.__outgoing_queue
 
+    @property
+    def queued(self) -> int:
+        """Number of packets waiting to be sent to the player."""
+        return self.__outgoing_queue.qsize()
+
     async def send_packet(self, packet: Packet):
         await self.__outgoing_queue.put(packet)
 
+    async def flush(self):
+        """Wait until every queued packet has been handed to the connection."""
+        await self.__outgoing_queue.join()
+
+    async def send_message(self, message: str):
+        from pyccs.protocol.cp7x import CHAT_MESSAGE
+        for line in message.splitlines():
+            for part in textwrap.wrap(line, 64) or [""]:
+                await self.send_packet(CHAT_MESSAGE.to_packet(player_id=0, message=part))
+
     async def send_signal(self, packet_data: PacketInfo):
         packet = packet_data.to_packet()
         await self.__outgoing_queue.put(packet)
@@ -51,29 +91,196 @@ class Player:
 
 
 class Map:
-    def __init__(self, file_name: str):
-        with nbtlib.load(file_name) as level:
-            root = level.get("ClassicWorld")
-            self.data = bytearray(root.get("BlockArray"))
-            self.size = Position(
-                root.get("X"),
-                root.get("Y"),
-                root.get("Z")
-            )
-            spawn = root.get("Spawn")
-            self.spawn = Position(
-                spawn.get("X"),
-                spawn.get("Y"),
-                spawn.get("Z"),
-                spawn.get("H"),
-                spawn.get("P")
-            )
-            self.volume = self.size.x * self.size.y * self.size.z
+    def __init__(self, size: Position, data: bytearray = None, spawn: Position = None):
+        self.size = size
+        self.volume = self.size.x * self.size.y * self.size.z
+        self.data = data if data is not None else bytearray(self.volume)
+        if len(self.data) != self.volume:
+            raise ValueError(f"Block data is {len(self.data)} bytes, expected {self.volume} for {self.size}")
+        self.heightmap = self._build_heightmap()
+        """(Z, X) array of the Y of the highest solid block in each column, -1 for columns with none."""
+        self.spawn = self.fix_spawn(spawn if spawn else Position(self.size.x // 2, self.size.y, self.size.z // 2))
+        self.history: Optional[EditHistory] = None
+        """Log of block edits made by players, None unless enabled with `enable_history`."""
+        self.file_name: Optional[str] = None
+        """ClassicWorld file the Map was loaded from, if any."""
+        self.shared_memory: Optional[shared_memory.SharedMemory] = None
+        """Shared memory holding the block array, after `share` was called."""
+        self._version = memoryview(bytearray(8)).cast("Q")
+
+    @classmethod
+    def from_file(cls, file_name: str, sectioned: bool = False) -> "Map":
+        """Load a Map from a ClassicWorld (.cw) file. If *sectioned* is true, blocks are kept in SectionedBlocks."""
+        import nbtlib
+        root = nbtlib.load(file_name).get("ClassicWorld")
+        size = Position(
+            root.get("X"),
+            root.get("Y"),
+            root.get("Z")
+        )
+        spawn = root.get("Spawn")
+        spawn = Position(
+            spawn.get("X"),
+            spawn.get("Y"),
+            spawn.get("Z"),
+            spawn.get("H"),
+            spawn.get("P")
+        )
+        blocks = root.get("BlockArray")
+        if sectioned:
+            data = SectionedBlocks.from_chunks(len(blocks), iter_blocks(blocks.view("uint8")))
+        else:
+            data = bytearray(blocks)
+        level = cls(size, data, spawn)
+        level.file_name = file_name
+        return level
+
+    def save(self, file_name: str):
+        """Write the Map to a ClassicWorld (.cw) file. This blocks, run it in an executor from the event loop."""
+        name = os.path.splitext(os.path.basename(file_name))[0]
+        write_classicworld(file_name, name, self.size, self.spawn, self.volume, self.chunks())
+
+    @property
+    def version(self) -> int:
+        """Counter which goes up whenever a block changes, to tell when copies of the level are out of date."""
+        return self._version[0]
+
+    def share(self):
+        """Move the block array into shared memory, so other processes can read it without it being copied. The
+        first 8 bytes of the shared memory hold `version`, the block array follows."""
+        if self.shared_memory or isinstance(self.data, SectionedBlocks):
+            raise ValueError("Only unshared, dense Maps can be shared")
+        memory = shared_memory.SharedMemory(create=True, size=8 + self.volume)
+        memory.buf[8:8 + self.volume] = self.data
+        header = memory.buf[:8].cast("Q")
+        header[0] = self.version
+        self._version = header
+        self.data = memory.buf[8:8 + self.volume]
+        self.shared_memory = memory
+
+    def unshare(self):
+        """Copy the block array out of shared memory and release it."""
+        if not self.shared_memory:
+            return
+        version = self.version
+        data = bytearray(self.data)
+        self.data.release()
+        self._version.release()
+        self.data = data
+        self._version = memoryview(bytearray(8)).cast("Q")
+        self._version[0] = version
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+        self.shared_memory = None
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yield the block array in consecutive pieces, without building a copy of it."""
+        return iter_blocks(self.data)
+
+    def _layer(self, y: int) -> numpy.ndarray:
+        layer = self.size.x * self.size.z
+        if not isinstance(self.data, SectionedBlocks):
+            data = memoryview(self.data)[y * layer:(y + 1) * layer]
+        else:
+            data = self.data.read(y * layer, layer)
+        return numpy.frombuffer(data, dtype=numpy.uint8).reshape((self.size.z, self.size.x))
+
+    def _build_heightmap(self) -> numpy.ndarray:
+        heights = numpy.full((self.size.z, self.size.x), -1, dtype=numpy.int16)
+        unset = numpy.ones(heights.shape, dtype=bool)
+        for y in range(self.size.y - 1, -1, -1):
+            found = unset & _SOLID[self._layer(y)]
+            heights[found] = y
+            unset &= ~found
+            if not unset.any():
+                break
+        return heights
+
+    def height(self, x: int, z: int) -> int:
+        """Return the Y of the highest solid block at *x*, *z*, or -1 if there is none."""
+        if 0 <= x < self.size.x and 0 <= z < self.size.z:
+            return int(self.heightmap[z, x])
+        return -1
+
+    def fix_spawn(self, spawn: Position) -> Position:
+        """Return *spawn*, moved on top of the highest solid block in its column if it is inside a block or out of
+        the level. Spawns left in the open are kept, even if they are beneath an overhang."""
+        x, y, z = int(spawn.x), int(spawn.y), int(spawn.z)
+        if not (0 <= x < self.size.x and 0 <= z < self.size.z):
+            x, z = self.size.x // 2, self.size.z // 2
+        top = self.height(x, z)
+        feet = self.get_block(Position(x, y, z))
+        head = self.get_block(Position(x, y + 1, z))
+        if top >= 0 and (y < 0 or feet not in NON_SOLID_BLOCKS or head not in NON_SOLID_BLOCKS):
+            y = top + 1
+        return Position(x, y, z, spawn.yaw, spawn.pitch)
+
+    def enable_history(self, max_bytes: int, spill_file: str = None):
+        """Start recording block edits, using at most *max_bytes* of memory for them."""
+        self.history = EditHistory(self.size, max_bytes, spill_file)
+
+    def index(self, position: Position) -> int:
+        return position.x + (position.z * self.size.x) + ((self.size.x * self.size.z) * position.y)
+
+    def position(self, index: int) -> Position:
+        """Inverse of `index`, return the position of the block at *index*."""
+        layer, rest = divmod(index, self.size.x * self.size.z)
+        z, x = divmod(rest, self.size.x)
+        return Position(x, layer, z)
+
+    def contains(self, position: Position) -> bool:
+        return 0 <= position.x < self.size.x and 0 <= position.y < self.size.y and 0 <= position.z < self.size.z
+
+    def get_block(self, position: Position) -> int:
+        if self.contains(position):
+            return self.data[self.index(position)]
+        return 0
 
     def set_block(self, position: Position, block_id: int):
-        index = position.x + (position.z * self.size.x) + ((self.size.x * self.size.z) * position.y)
-        if index < len(self.data):
-            self.data[index] = block_id
+        if not self.contains(position):
+            return
+        index = self.index(position)
+        self.data[index] = block_id
+        self._version[0] += 1
+        x, y, z = position.x, position.y, position.z
+        top = self.heightmap[z, x]
+        if block_id not in NON_SOLID_BLOCKS:
+            if y > top:
+                self.heightmap[z, x] = y
+        elif y == top:
+            layer = self.size.x * self.size.z
+            while y > 0:
+                y -= 1
+                index -= layer
+                if self.data[index] not in NON_SOLID_BLOCKS:
+                    break
+            else:
+                y = -1
+            self.heightmap[z, x] = y
+
+    def get_blocks(self, indices: Sequence[int]) -> numpy.ndarray:
+        """Get many blocks at once by their index."""
+        if not isinstance(self.data, SectionedBlocks):
+            return numpy.frombuffer(self.data, dtype=numpy.uint8)[indices]
+        return numpy.fromiter((self.data[int(index)] for index in indices), dtype=numpy.uint8, count=len(indices))
+
+    def set_blocks(self, indices: Sequence[int], blocks: Sequence[int]):
+        """Set many blocks at once by their index."""
+        self._version[0] += 1
+        if not isinstance(self.data, SectionedBlocks):
+            numpy.frombuffer(self.data, dtype=numpy.uint8)[indices] = blocks
+            columns = numpy.unique(numpy.asarray(indices) % (self.size.x * self.size.z))
+            self._update_columns(columns % self.size.x, columns // self.size.x)
+        else:
+            for index, block_id in zip(indices, blocks):
+                self.set_block(self.position(int(index)), int(block_id))
+
+    def _update_columns(self, xs: numpy.ndarray, zs: numpy.ndarray):
+        """Recompute the heightmap for the given columns of a dense level."""
+        view = numpy.frombuffer(self.data, dtype=numpy.uint8).reshape((self.size.y, self.size.z, self.size.x))
+        solid = _SOLID[view[:, zs, xs]]
+        top = self.size.y - 1 - numpy.argmax(solid[::-1], axis=0)
+        self.heightmap[zs, xs] = numpy.where(solid.any(axis=0), top, -1)
 
 
 name: str = "PyCCS Server"
@@ -81,29 +288,63 @@ name: str = "PyCCS Server"
 protocol = {}
 max_players: int = 9
 """Maximum number of players allowed on the server."""
+PLAYER_IDS = 128
+"""Player IDs there are, and so the most players one server process can hold."""
+operators_by_default: bool = True
+"""If every player joins as an operator. Plugins which decide who is one, like Autocracy, turn this off."""
 logger: logging.Logger = logging.getLogger(__name__)
 """Logger the server will output to"""
-player_added: Event = Event()
+player_added: Event = Event("player_added")
 """Event: Player joined the server"""
-player_removing: Event = Event()
+player_removing: Event = Event("player_removing")
 """Event: Player is leaving the server"""
-chat: Event = Event()
+chat: Event = Event("chat")
 """Event: Chat message sent"""
-starting: Event = Event()
+starting: Event = Event("starting")
 """Event: Server start-up"""
-shutdown: Event = Event()
+shutdown: Event = Event("shutdown")
 """Event: Server shut-down"""
-incoming_packet = Event()
-"""Event: Incoming packet from client"""
+incoming_packet = Event("incoming_packet", timed=False)
+"""Event: Incoming packet from client. Timed by packet ID in `_handle_incoming` instead."""
 salt: str = ''.join(random.choice(string.ascii_letters + string.digits) for x in range(32))
 """Shared secret used for username authentication."""
-main_level = Map("level.cw")
+main_level: Map = None
+"""The Map players join into. Loaded from `level_file` on start if not set beforehand."""
+level_file: str = "level.cw"
+"""Path of the ClassicWorld file the main level is loaded from."""
+levels: Dict[str, Map] = {}
+"""Every level hosted by this server by name, the main level is called main."""
+level_files: Dict[str, str] = {}
+"""Paths of ClassicWorld files to load as extra levels on start, by level name."""
+sectioned_levels: bool = False
+"""Keep loaded levels in SectionedBlocks instead of one dense bytearray, for very large, mostly empty levels."""
+history_memory: int = 16 * 1024 * 1024
+"""Bytes of memory the main level may use to record block edits, 0 disables the edit history."""
+history_spill: Optional[str] = None
+"""File edits evicted from the edit history are appended to, if set."""
+metrics_port: Optional[int] = None
+"""Local port metrics are served on in the Prometheus text format, None disables metrics."""
+metrics_ip: str = "127.0.0.1"
+"""Address metrics are served on. Keep this local, metrics are not authenticated."""
 _ip = "0.0.0.0"
 _port = 25565
 _plugins = {}
 _commands = {}
 _running = False
 _players = {}
+_started = 0.0
+
+_PACKETS_RECEIVED = metrics.Counter("pyccs_packets_received_total", "Packets received from players", ["packet_id"])
+_BYTES_RECEIVED = metrics.Counter("pyccs_received_bytes_total", "Bytes of packets received from players")
+_PACKET_SECONDS = metrics.Histogram("pyccs_packet_handle_seconds", "Time spent handling received packets",
+                                    ["packet_id"])
+_BYTES_SENT = metrics.Counter("pyccs_sent_bytes_total", "Bytes written to players")
+_SEND_BATCH = metrics.Histogram("pyccs_send_batch_packets", "Packets written to a player at once",
+                                buckets=metrics.SIZE_BUCKETS)
+_DRAIN_SECONDS = metrics.Histogram("pyccs_send_drain_seconds", "Time spent waiting for writes to players to drain")
+metrics.Gauge("pyccs_players", "Players connected", function=lambda: len(_players))
+metrics.Gauge("pyccs_outgoing_queued_packets", "Packets queued to be sent to all players",
+              function=lambda: sum(player.queued for player in list(_players.values())))
 
 
 def ip(value: str = None) -> str:
@@ -134,6 +375,10 @@ def get_plugin(name: str, default):
     return _plugins.get(name, default)
 
 
+def get_plugins() -> list:
+    return list(_plugins.values())
+
+
 def add_plugin(module):
     plugin = module.PLUGIN
     plugin.module = module
@@ -141,15 +386,52 @@ def add_plugin(module):
         raise ValueError(f"{plugin} has a name conflict with {conflict}")
     else:
         _plugins[plugin.name] = plugin
+        _commands.update(plugin.commands)
 
 
 def start():
-    global _running
+    global _running, _started
     logger.info("Starting server")
+    _started = time.perf_counter()
+    load_levels()
     _running = True
     asyncio.run(_bootstrap())
 
 
+def load_levels():
+    """Load the main level and every level in `level_files` that is not loaded yet, several at once."""
+    global main_level
+    started = time.perf_counter()
+    to_load = {level_name: file_name for level_name, file_name in level_files.items() if level_name not in levels}
+    if main_level is None:
+        to_load["main"] = level_file
+    if to_load:
+        for level_name, file_name in to_load.items():
+            logger.info(f"Loading level {level_name} from {file_name}")
+        with ThreadPoolExecutor(min(len(to_load), os.cpu_count() or 1)) as executor:
+            loaded = dict(zip(to_load, executor.map(Map.from_file, to_load.values(),
+                                                    [sectioned_levels] * len(to_load))))
+        main_level = loaded.pop("main", main_level)
+        levels.update(loaded)
+        logger.info(f"Loaded {len(to_load)} levels in {time.perf_counter() - started:.2f}s")
+    levels.setdefault("main", main_level)
+    for level in levels.values():
+        if history_memory and level.history is None:
+            level.enable_history(history_memory, history_spill)
+
+
+def get_level(level_name: str) -> Optional[Map]:
+    return levels.get(level_name, None)
+
+
+def level_name(level: Map) -> Optional[str]:
+    """Return the name *level* is loaded under, if it is loaded."""
+    for name, loaded in levels.items():
+        if loaded is level:
+            return name
+    return None
+
+
 def stop(*args, **kwargs):
     global _running
     logger.info("Stopping server")
@@ -173,8 +455,21 @@ def get_player(*, name: str = None, player_id: int = None):
         return _players.get(player_id, None)
 
 
+def get_players() -> list:
+    return list(_players.values())
+
+
+def is_full() -> bool:
+    """Return if no other player may join, because `max_players` are online or every player ID is taken."""
+    return len(_players) >= min(max_players, PLAYER_IDS)
+
+
 async def add_player(player: Player):
-    for player_id in range(0, 128):
+    if is_full():
+        logger.info(f"Turned {player} away, the server is full")
+        await remove_player(player, "Server is full")
+        return
+    for player_id in range(0, PLAYER_IDS):
         if not _players.get(player_id):
             _players[player_id] = player
             player.player_id = player_id
@@ -183,73 +478,144 @@ async def add_player(player: Player):
     await player_added.fire(player)
 
 
-async def relay_to_all(sender: Player, packet: Packet):
+async def relay_to_all(sender: Player, packet: Packet, level: Map = None):
+    """Send *packet* from *sender* to every player, or only to the players on *level* if given."""
     packet.player_id = sender.player_id
     for _, player in _players.items():
-        if player:
+        if player and (level is None or player.map is level):
             await player.send_packet(packet)
 
 
-async def relay_to_others(sender: Player, packet: Packet):
+async def relay_to_others(sender: Player, packet: Packet, level: Map = None):
+    """Send *packet* from *sender* to every other player, or only to the other players on *level* if given."""
     packet.player_id = sender.player_id
     for _, player in _players.items():
-        if player != sender and player:
+        if player != sender and player and (level is None or player.map is level):
             await player.send_packet(packet)
 
 
 async def remove_player(player: Player, reason: str = "Kicked from server"):
-    player.drop(reason)
-    if player.player_id is not None:
+    if player.player_id is not None and _players.get(player.player_id, None) is player:
         await player_removing.fire(player, reason)
         _players.pop(player.player_id, None)
-    logger.info(f"Removed player {player} ({reason})")
+        logger.info(f"Removed player {player} ({reason})")
+    player.drop(reason)
 
 
 async def _bootstrap():
     logger.debug("Starting TCP Server")
     tcp_server = await _start_server()
+    metrics_server = await metrics.serve(metrics_port, metrics_ip) if metrics_port else None
+    await starting.fire()
+    warmed_up()
     while _running:
         await asyncio.sleep(1)
     logger.debug("Shutdown signal detected")
+    await shutdown.fire()
     logger.debug("Closing TCP Server")
     tcp_server.close()
     await tcp_server.wait_closed()
+    if metrics_server:
+        metrics_server.close()
     logger.debug("TCP Server Closed")
 
 
+def warmed_up():
+    """Move everything allocated so far, levels and plugins mostly, out of the garbage collector's way. They live as
+    long as the server, scanning them on every full collection is wasted time."""
+    gc.collect()
+    gc.freeze()
+    if _started:
+        logger.info(f"Accepting connections {time.perf_counter() - _started:.2f}s after starting")
+
+
 async def _handle_outgoing(player: Player, writer: asyncio.StreamWriter):
     queue = await player.outgoing_queue()
     loop_condition = False
     packet = None
     while not loop_condition:
+        batch = []
         try:
-            packet = await queue.get()
-            packet_bytes = packet.to_bytes()
-            writer.write(packet_bytes)
+            batch.append(await queue.get())
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            data = bytearray()
+            for packet in batch:
+                data += packet.to_bytes()
+            writer.write(data)
+            if capture.recorder:
+                capture.recorder.outgoing(player, data)
+            started = time.perf_counter()
+            player.draining_since = time.monotonic()
             await writer.drain()
-            queue.task_done()
+            player.draining_since = 0.0
+            if metrics.enabled:
+                _DRAIN_SECONDS.observe(time.perf_counter() - started)
+                _BYTES_SENT.inc(amount=len(data))
+                _SEND_BATCH.observe(len(batch))
         except asyncio.exceptions.CancelledError as e:
             loop_condition = queue.empty()
         except ConnectionError as e:
             return
         except Exception as e:
             logger.exception(f"Exception occurred while sending {packet} to {player}")
+        finally:
+            for _ in batch:
+                queue.task_done()
     return
 
 
-async def _handle_incoming(player: Player, reader: asyncio.StreamReader):
+async def _dispatch(player: Player, task: asyncio.Task, packet_id: int, packet, size: int):
+    if watchdog.monitor:
+        watchdog.handling[task] = (player, packet)
+    try:
+        if metrics.enabled:
+            started = time.perf_counter()
+            await incoming_packet.fire(player, packet)
+            _PACKET_SECONDS.observe(time.perf_counter() - started, packet_id)
+            _PACKETS_RECEIVED.inc(packet_id)
+            _BYTES_RECEIVED.inc(amount=size)
+        else:
+            await incoming_packet.fire(player, packet)
+    finally:
+        if watchdog.handling:
+            watchdog.handling.pop(task, None)
+
+
+async def _handle_incoming(player: Player, reader: asyncio.StreamReader, first: Optional[bytes] = None):
     packet_id = None
     packet_info = None
     packet = None
+    task = asyncio.current_task()
     while True:
         try:
-            id_byte = await reader.readexactly(1)
-            packet_id = int.from_bytes(id_byte, "big")
-            packet_info = protocol[packet_id]
+            if first:
+                id_byte, packet_bytes, first = first[:1], first[1:], None
+                packet_id = id_byte[0]
+                packet_info = protocol[packet_id]
+            else:
+                delay = ratelimit.limiter.pending_delay(player) if ratelimit.limiter else None
+                if delay is None:
+                    id_byte = await reader.readexactly(1)
+                else:
+                    try:
+                        id_byte = await asyncio.wait_for(reader.readexactly(1), delay)
+                    except asyncio.TimeoutError:
+                        packet_id, packet = ratelimit.limiter.release(player)
+                        packet_info = protocol[packet_id]
+                        await _dispatch(player, task, packet_id, packet, packet_info.size() + 1)
+                        continue
+                packet_id = int.from_bytes(id_byte, "big")
+                packet_info = protocol[packet_id]
+                packet_bytes = await reader.readexactly(packet_info.size())
             packet = packet_info.to_packet()
-            packet_bytes = await reader.readexactly(packet_info.size())
             packet.from_bytes(packet_bytes)
-            await incoming_packet.fire(player, packet)
+            player.last_received = time.monotonic()
+            if capture.recorder:
+                capture.recorder.incoming(player, id_byte + packet_bytes)
+            if ratelimit.limiter and not ratelimit.limiter.allow(player, packet_id, packet):
+                continue
+            await _dispatch(player, task, packet_id, packet, len(packet_bytes) + 1)
         except (asyncio.exceptions.IncompleteReadError, ConnectionError):
             await remove_player(player, "Disconnected")
             return
@@ -262,16 +628,58 @@ async def _handle_incoming(player: Player, reader: asyncio.StreamReader):
             return
 
 
-async def _client_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    outgoing_queue = asyncio.Queue()
+async def _read_identification(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[bytes]:
+    try:
+        first = await asyncio.wait_for(reader.readexactly(1), admission.limits.handshake_timeout)
+        if first != b"\x00":
+            writer.write(admission.disconnect_packet("Expected player identification"))
+            return None
+        return first + await asyncio.wait_for(reader.readexactly(protocol[0x00].size()),
+                                              admission.limits.handshake_timeout)
+    except asyncio.TimeoutError:
+        admission.limits.timed_out()
+        writer.write(admission.disconnect_packet("Timed out"))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    return None
+
+
+async def _client_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, level: Map = None):
     addr = writer.get_extra_info('peername')[0]
+    if reason := admission.limits.admit(addr):
+        logger.debug(f"Turned away connection from {addr}: {reason}")
+        writer.write(admission.disconnect_packet(reason))
+        writer.close()
+        return
+    try:
+        identification = await _read_identification(reader, writer)
+        if identification is None:
+            writer.close()
+            return
+        await _run_connection(reader, writer, addr, level, identification)
+    finally:
+        admission.limits.release(addr)
+
+
+async def _run_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, addr: str, level: Map,
+                          identification: bytes):
+    outgoing_queue = asyncio.Queue()
     connection = Player(addr, outgoing_queue)
+    connection.map = level if level else main_level
+    connection.reader = reader
+    connection.writer = writer
     logger.debug(f"Incoming connection from {connection}")
-    incoming = asyncio.create_task(_handle_incoming(connection, reader))
+    if capture.recorder:
+        capture.recorder.open(connection, addr)
+    incoming = asyncio.create_task(_handle_incoming(connection, reader, identification))
     outgoing = asyncio.create_task(_handle_outgoing(connection, writer))
     await connection.wait_for_drop()
     incoming.cancel()
     outgoing.cancel()
+    await asyncio.wait([outgoing], timeout=5)
+    writer.close()
+    if capture.recorder:
+        capture.recorder.close(connection)
     logger.debug(f"Connection task terminated for {connection}")
 
 
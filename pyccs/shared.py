@@ -0,0 +1,167 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""This module compresses and saves levels away from the event loop.
+
+Compressed level data is cached per Map and reused until `Map.version` changes, so joining players usually cost
+nothing but the sends. When helper processes are enabled, levels are moved into shared memory and the helpers read
+the live block array from there, without it being pickled or copied between processes. Otherwise the work is done
+in the default thread pool, where zlib runs without holding the GIL."""
+
+import asyncio
+import os
+import struct
+import time
+import weakref
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Optional, Iterable, Tuple
+
+import pyccs.server as server
+from pyccs import metrics
+from pyccs.protocol import Position
+from pyccs.storage import iter_blocks, write_classicworld
+
+COMPRESSION_LEVEL = 4
+"""zlib compression level for level data sent to clients."""
+
+pool: Optional["LevelPool"] = None
+"""Helper processes used for shared levels, if enabled."""
+_payloads = weakref.WeakKeyDictionary()
+_pending = weakref.WeakKeyDictionary()
+_attached = {}
+
+_COMPRESS_SECONDS = metrics.Histogram("pyccs_level_compress_seconds", "Time taken to compress level data")
+_PAYLOAD_HITS = metrics.Counter("pyccs_level_payload_cache_hits_total", "Level sends served from compressed data")
+
+
+def compress_level(volume: int, chunks: Iterable[bytes]) -> bytes:
+    """Return the gzipped level data clients expect: the volume as 4 bytes followed by the block array."""
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    result = [compressor.compress(volume.to_bytes(4, byteorder="big"))]
+    for chunk in chunks:
+        result.append(compressor.compress(chunk))
+    result.append(compressor.flush())
+    return b"".join(result)
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    if not (memory := _attached.get(name, None)):
+        memory = _attached[name] = shared_memory.SharedMemory(name=name)
+    return memory
+
+
+def _version(memory: shared_memory.SharedMemory) -> int:
+    return struct.unpack_from("Q", memory.buf, 0)[0]
+
+
+def _compress_shared(name: str, volume: int) -> Tuple[int, int, bytes]:
+    memory = _attach(name)
+    before = _version(memory)
+    payload = compress_level(volume, iter_blocks(memory.buf[8:8 + volume]))
+    return before, _version(memory), payload
+
+
+def _save_shared(name: str, volume: int, size: list, spawn: list, file_name: str, level_name: str) -> int:
+    memory = _attach(name)
+    before = _version(memory)
+    write_classicworld(file_name, level_name, Position(*size), Position(*spawn), volume,
+                       iter_blocks(memory.buf[8:8 + volume]))
+    return before
+
+
+class LevelPool:
+    """Pool of helper processes which compress and save shared levels."""
+
+    def __init__(self, processes: int):
+        self._executor = ProcessPoolExecutor(processes)
+
+    async def compress(self, level: server.Map) -> Tuple[int, int, bytes]:
+        """Compress a shared level, returns its version before and after along with the data."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _compress_shared, level.shared_memory.name, level.volume)
+
+    async def save(self, level: server.Map, file_name: str, level_name: str):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, _save_shared, level.shared_memory.name, level.volume,
+                                   level.size.to_list(), level.spawn.to_list(True), file_name, level_name)
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+async def _compress(level: server.Map) -> bytes:
+    started = time.perf_counter()
+    if pool and level.shared_memory:
+        before, after, payload = await pool.compress(level)
+    else:
+        before = level.version
+        loop = asyncio.get_running_loop()
+        payload = await loop.run_in_executor(None, compress_level, level.volume, level.chunks())
+        after = level.version
+    if metrics.enabled:
+        _COMPRESS_SECONDS.observe(time.perf_counter() - started)
+    if before == after:
+        _payloads[level] = (after, payload)
+    return payload
+
+
+async def level_payload(level: server.Map) -> bytes:
+    """Return the compressed level data for *level*, reusing the last result if no block changed since."""
+    version = level.version
+    cached = _payloads.get(level, None)
+    if cached and cached[0] == version:
+        if metrics.enabled:
+            _PAYLOAD_HITS.inc()
+        return cached[1]
+    pending = _pending.get(level, None)
+    if not pending or pending[0] != version:
+        future = asyncio.ensure_future(_compress(level))
+        pending = _pending[level] = (version, future)
+        future.add_done_callback(lambda done: _forget_failed(level, done))
+    return await asyncio.shield(pending[1])
+
+
+def _forget_failed(level: server.Map, future: asyncio.Future):
+    """Drop a compression which failed, so the next join tries again instead of getting the same error."""
+    if (future.cancelled() or future.exception()) and _pending.get(level, (None, None))[1] is future:
+        del _pending[level]
+
+
+async def save_level(level: server.Map, file_name: str = None):
+    """Save *level* to *file_name*, or the file it was loaded from, without blocking the event loop."""
+    file_name = file_name or level.file_name
+    if not file_name:
+        raise ValueError("Level has no file to save to")
+    level_name = os.path.splitext(os.path.basename(file_name))[0]
+    if pool and level.shared_memory:
+        await pool.save(level, file_name, level_name)
+    else:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, level.save, file_name)
+
+
+def enable(processes: int):
+    """Move levels into shared memory when the server starts, and use *processes* helper processes for them."""
+
+    async def start():
+        global pool
+        for level in server.levels.values():
+            if not level.shared_memory and not isinstance(level.data, server.SectionedBlocks):
+                level.share()
+        pool = LevelPool(processes)
+        server.logger.info(f"Started {processes} level helper processes")
+
+    async def stop():
+        global pool
+        if pool:
+            pool.shutdown()
+            pool = None
+        for level in server.levels.values():
+            level.unshare()
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
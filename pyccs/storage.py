@@ -0,0 +1,217 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""This module provides block storage for Maps, and streaming serialization of block arrays."""
+
+import gzip
+import os
+import struct
+import uuid
+
+from typing import Iterable, Iterator
+
+SECTION_SIZE = 4096
+"""Number of blocks in a section of SectionedBlocks. Sections are runs of consecutive block indices."""
+SECTION_SHIFT = 12
+SECTION_MASK = SECTION_SIZE - 1
+PALETTE_LIMIT = 16
+"""Most distinct blocks a palette section holds before it is promoted to a dense section."""
+
+
+class PaletteSection:
+    """A section with at most 16 distinct blocks, stored as a palette and 4-bit indices into it."""
+    __slots__ = ("palette", "indices")
+
+    def __init__(self, block_id: int, size: int):
+        self.palette = bytearray((block_id,))
+        """Block IDs present in the section, in order of first appearance."""
+        self.indices = bytearray((size + 1) // 2)
+        """Palette indices, packed two per byte with the even block in the low nibble."""
+
+    def get(self, offset: int) -> int:
+        return self.palette[(self.indices[offset >> 1] >> ((offset & 1) << 2)) & 0xF]
+
+    def set(self, offset: int, block_id: int) -> bool:
+        """Set a block in the section, returns False if the palette is full and the section must be promoted."""
+        entry = self.palette.find(block_id)
+        if entry < 0:
+            if len(self.palette) >= PALETTE_LIMIT:
+                return False
+            entry = len(self.palette)
+            self.palette.append(block_id)
+        shift = (offset & 1) << 2
+        packed = offset >> 1
+        self.indices[packed] = (self.indices[packed] & (0xF0 >> shift)) | (entry << shift)
+        return True
+
+    def to_bytes(self, size: int) -> bytearray:
+        palette = bytes(self.palette).ljust(PALETTE_LIMIT, b"\0")
+        low = bytes(palette[i & 0xF] for i in range(256))
+        high = bytes(palette[i >> 4] for i in range(256))
+        result = bytearray(len(self.indices) * 2)
+        result[0::2] = self.indices.translate(low)
+        result[1::2] = self.indices.translate(high)
+        del result[size:]
+        return result
+
+
+class SectionedBlocks:
+    """Sparse block array which can stand in for the bytearray of a Map.
+
+    Blocks are split into sections of `SECTION_SIZE` consecutive indices. Each section is an int when every block in
+    it is the same, a PaletteSection when it holds a few distinct blocks, or a bytearray otherwise. Sections are
+    promoted in that order when written to, so reads and writes stay O(1)."""
+
+    def __init__(self, volume: int, fill: int = 0):
+        self.volume = volume
+        self.sections = [fill] * ((volume + SECTION_MASK) >> SECTION_SHIFT)
+        self._uniform = {}
+
+    @classmethod
+    def from_chunks(cls, volume: int, chunks: Iterable[bytes]) -> "SectionedBlocks":
+        """Build SectionedBlocks from the block array given in consecutive pieces of any size."""
+        blocks = cls(volume)
+        buffer = bytearray()
+        section = 0
+        for chunk in chunks:
+            buffer += memoryview(chunk).cast("B")
+            while len(buffer) >= SECTION_SIZE:
+                blocks._store(section, buffer[:SECTION_SIZE])
+                del buffer[:SECTION_SIZE]
+                section += 1
+        if buffer:
+            blocks._store(section, buffer)
+        return blocks
+
+    def _store(self, section: int, data: bytearray):
+        if data.count(data[0]) == len(data):
+            self.sections[section] = data[0]
+        else:
+            self.sections[section] = bytearray(data)
+
+    def _section_size(self, section: int) -> int:
+        return min(SECTION_SIZE, self.volume - (section << SECTION_SHIFT))
+
+    def __len__(self):
+        return self.volume
+
+    def __getitem__(self, index: int) -> int:
+        if index < 0 or index >= self.volume:
+            raise IndexError("block index out of range")
+        section = self.sections[index >> SECTION_SHIFT]
+        if section.__class__ is int:
+            return section
+        if section.__class__ is bytearray:
+            return section[index & SECTION_MASK]
+        return section.get(index & SECTION_MASK)
+
+    def __setitem__(self, index: int, block_id: int):
+        if index < 0 or index >= self.volume:
+            raise IndexError("block index out of range")
+        number = index >> SECTION_SHIFT
+        offset = index & SECTION_MASK
+        section = self.sections[number]
+        if section.__class__ is int:
+            if section == block_id:
+                return
+            section = PaletteSection(section, self._section_size(number))
+            self.sections[number] = section
+        elif section.__class__ is bytearray:
+            section[offset] = block_id
+            return
+        if not section.set(offset, block_id):
+            dense = section.to_bytes(self._section_size(number))
+            dense[offset] = block_id
+            self.sections[number] = dense
+
+    def read(self, start: int, length: int) -> bytes:
+        """Return *length* consecutive blocks starting at the index *start*."""
+        result = bytearray()
+        end = start + length
+        while start < end:
+            number = start >> SECTION_SHIFT
+            offset = start & SECTION_MASK
+            count = min(end - start, self._section_size(number) - offset)
+            section = self.sections[number]
+            if section.__class__ is int:
+                result += bytes((section,)) * count
+            elif section.__class__ is bytearray:
+                result += section[offset:offset + count]
+            else:
+                result += section.to_bytes(self._section_size(number))[offset:offset + count]
+            start += count
+        return bytes(result)
+
+    def __bytes__(self):
+        return b"".join(self.chunks())
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yield the block array section by section, without building it in full."""
+        for number, section in enumerate(self.sections):
+            size = self._section_size(number)
+            if section.__class__ is int:
+                yield self._uniform_bytes(section, size)
+            elif section.__class__ is bytearray:
+                yield section
+            else:
+                yield section.to_bytes(size)
+
+    def _uniform_bytes(self, block_id: int, size: int) -> bytes:
+        if size != SECTION_SIZE:
+            return bytes((block_id,)) * size
+        if not (data := self._uniform.get(block_id, None)):
+            data = self._uniform[block_id] = bytes((block_id,)) * SECTION_SIZE
+        return data
+
+    def memory_usage(self) -> int:
+        """Approximate number of bytes used by the stored sections."""
+        total = len(self.sections) * 8
+        for section in self.sections:
+            if section.__class__ is bytearray:
+                total += len(section)
+            elif section.__class__ is PaletteSection:
+                total += len(section.indices) + len(section.palette)
+        return total
+
+
+def iter_blocks(data, chunk_size: int = SECTION_SIZE * 16) -> Iterator[bytes]:
+    """Yield a block array (a bytearray or SectionedBlocks) in consecutive pieces, without copying it."""
+    if chunks := getattr(data, "chunks", None):
+        yield from chunks()
+    else:
+        view = memoryview(data)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+
+
+def _tag(tag_id: int, name: str) -> bytes:
+    encoded = name.encode("utf-8")
+    return struct.pack("!bH", tag_id, len(encoded)) + encoded
+
+
+def write_classicworld(file_name: str, name: str, size, spawn, volume: int, chunks: Iterable[bytes]):
+    """Stream a ClassicWorld (.cw) file to disk, reading the block array from *chunks*. The file is written next to
+    its destination and then moved into place, so a crash will never leave a partial level behind."""
+    encoded_name = name.encode("utf-8")
+    temp_name = f"{file_name}.tmp"
+    with gzip.open(temp_name, "wb", compresslevel=4) as file:
+        file.write(_tag(10, "ClassicWorld"))
+        file.write(_tag(1, "FormatVersion") + struct.pack("!b", 1))
+        file.write(_tag(8, "Name") + struct.pack("!H", len(encoded_name)) + encoded_name)
+        file.write(_tag(7, "UUID") + struct.pack("!i", 16) + uuid.uuid4().bytes)
+        file.write(_tag(2, "X") + struct.pack("!h", size.x))
+        file.write(_tag(2, "Y") + struct.pack("!h", size.y))
+        file.write(_tag(2, "Z") + struct.pack("!h", size.z))
+        file.write(_tag(10, "Spawn"))
+        file.write(_tag(2, "X") + struct.pack("!h", int(spawn.x)))
+        file.write(_tag(2, "Y") + struct.pack("!h", int(spawn.y)))
+        file.write(_tag(2, "Z") + struct.pack("!h", int(spawn.z)))
+        file.write(_tag(1, "H") + struct.pack("!B", int(spawn.yaw) & 0xFF))
+        file.write(_tag(1, "P") + struct.pack("!B", int(spawn.pitch) & 0xFF))
+        file.write(b"\0")
+        file.write(_tag(7, "BlockArray") + struct.pack("!i", volume))
+        for chunk in chunks:
+            file.write(chunk)
+        file.write(b"\0")
+    os.replace(temp_name, file_name)
@@ -3,12 +3,21 @@
 #  If the LICENSE file was not provided, you can find the full text of the license here:
 #  https://opensource.org/licenses/ISC
 
+import copy
+import dataclasses
 import json
 import os
 import asyncio
 import logging
+import time
 
-from typing import Any
+from typing import Any, Dict, Optional
+from pyccs import metrics
+
+_EVENT_SECONDS = metrics.Histogram("pyccs_event_seconds", "Time spent firing events", ["event"])
+_LISTENER_SECONDS = metrics.Histogram("pyccs_event_listener_seconds", "Time spent in event listeners, if "
+                                      "metrics.time_listeners is set", ["listener"])
+_PATHS: Dict[str, tuple] = {}
 
 
 def wrap_except(exception, msg: str):
@@ -28,7 +37,7 @@ def deep_update(old: dict, new: dict) -> None:
     for key, value in new.items():
         if isinstance(value, dict):
             node = old.setdefault(key, {})
-            deep_update(value, node)
+            deep_update(node, value)
         else:
             old[key] = value
 
@@ -51,10 +60,28 @@ def wrap_coroutine(f):
 
 
 class Configuration:
-    def __init__(self, defaults: dict):
-        self._defaults = defaults.copy()
-        self._config = defaults
+    """Nested JSON settings, read with dotted keys like "a.b". Values read with `get` are cached per key until the
+    configuration changes, and `snapshot` builds typed, read-only views which are cached the same way.
+
+    With a file set, changes made while the event loop runs are saved after `save_delay` seconds of quiet, by writing
+    a temporary file on the default executor and moving it over the old one. `watch` reloads the file when it is
+    edited, keeping the old settings if it is not valid JSON, and fires `changed` afterwards. Settings merged with
+    `override`, like those given on the command line, are applied again on top of every reload."""
+
+    def __init__(self, defaults: dict, save_delay: float = 1.0):
+        self._defaults = copy.deepcopy(defaults)
+        self._config = copy.deepcopy(defaults)
+        self._overrides = []
         self._file = None
+        self._cache = {}
+        self._snapshots = {}
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        self._saving: Optional[asyncio.Future] = None
+        self._file_stamp = None
+        self._watcher: Optional[asyncio.Task] = None
+        self.save_delay = save_delay
+        self.changed = Event("configuration_changed")
+        """Fired after the file was reloaded."""
 
     def __dict__(self):
         return self._config.copy()
@@ -72,35 +99,157 @@ class Configuration:
         self._file = path
         self.save()
 
+    def _stamp(self):
+        try:
+            stat = os.stat(self._file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _write(self, data: str):
+        temporary = f"{self._file}.{os.getpid()}.tmp"
+        with open(temporary, mode="w") as file:
+            file.write(data)
+        os.replace(temporary, self._file)
+        self._file_stamp = self._stamp()
+
     def save(self, *args):
+        """Write the configuration to its file right away."""
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
         if self._file:
-            with open(self._file, mode="w+") as file:
-                json.dump(self._config, file, indent=4)
+            self._write(json.dumps(self._config, indent=4))
+
+    def _changed(self):
+        self._cache.clear()
+        self._snapshots.clear()
+        if not self._file or self._save_handle:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._save_handle = loop.call_later(self.save_delay, self._save_later)
+
+    def _save_later(self):
+        self._save_handle = None
+        if self._saving and not self._saving.done():
+            self._save_handle = asyncio.get_running_loop().call_later(self.save_delay, self._save_later)
+            return
+        self._saving = asyncio.get_running_loop().run_in_executor(None, self._write,
+                                                                  json.dumps(self._config, indent=4))
+
+    async def flush(self):
+        """Write out any pending change and wait until it is saved."""
+        if self._saving:
+            await self._saving
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+            await asyncio.get_running_loop().run_in_executor(None, self._write, json.dumps(self._config, indent=4))
 
     def merge(self, new: dict, ignore_none=False):
         if ignore_none:
             new = deep_clean(new)
         deep_update(self._config, new)
+        self._changed()
+
+    def override(self, new: dict, ignore_none=False):
+        """Merge *new* and keep it over the file's settings when the file is reloaded."""
+        if ignore_none:
+            new = deep_clean(new)
+        self._overrides.append(copy.deepcopy(new))
+        self.merge(new)
 
     def set(self, key, value):
-        parts = key.split(".")
+        parts = self._path(key)
         last = self._config
-        for part in parts[:len(parts) - 1]:
-            last = last[part]
-        last[parts] = value
+        for part in parts[:-1]:
+            last = last.setdefault(part, {})
+        last[parts[-1]] = value
+        self._changed()
+
+    def _path(self, key: str) -> tuple:
+        try:
+            return _PATHS[key]
+        except KeyError:
+            path = _PATHS[key] = tuple(key.split("."))
+            return path
 
     def get(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
         last = self._config
-        for part in key.split("."):
+        for part in self._path(key):
             last = last[part]
+        self._cache[key] = last
         return last
 
+    def snapshot(self, kind):
+        """Return the top level settings as an instance of the NamedTuple or dataclass *kind*, whose fields name the
+        keys to read. Fields missing from the configuration keep their defaults."""
+        try:
+            return self._snapshots[kind]
+        except KeyError:
+            pass
+        fields = getattr(kind, "_fields", None) or [field.name for field in dataclasses.fields(kind)]
+        snapshot = self._snapshots[kind] = kind(**{name: self._config[name] for name in fields if name in self._config})
+        return snapshot
+
+    async def _reload(self):
+        stamp = self._stamp()
+        if stamp is None or stamp == self._file_stamp:
+            return
+        self._file_stamp = stamp
+
+        def read():
+            with open(self._file, mode="r") as file:
+                return json.load(file)
+
+        try:
+            file_config = await asyncio.get_running_loop().run_in_executor(None, read)
+        except (OSError, json.JSONDecodeError) as err:
+            logging.getLogger("PyCCS").warning(f"Not reloading {self._file}: {err}")
+            return
+        config = copy.deepcopy(self._defaults)
+        deep_update(config, file_config)
+        for override in self._overrides:
+            deep_update(config, copy.deepcopy(override))
+        self._config = config
+        self._cache.clear()
+        self._snapshots.clear()
+        logging.getLogger("PyCCS").info(f"Reloaded {self._file}")
+        await self.changed.fire()
+
+    async def watch(self, interval: float = 2.0):
+        """Reload the file whenever it changes, checking every *interval* seconds, until cancelled."""
+        self._file_stamp = self._file_stamp or self._stamp()
+        while True:
+            await asyncio.sleep(interval)
+            if self._file:
+                await self._reload()
+
+    def start_watching(self, interval: float = 2.0):
+        if self._file and not self._watcher:
+            self._watcher = asyncio.get_running_loop().create_task(self.watch(interval))
+
+    async def close(self):
+        """Stop watching the file and save any pending change."""
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+        await self.flush()
+
 
 class Connection:
     """Subscription to a Event. Should only be created by Event."""
 
     def __init__(self, listener, coroutine=False):
         self._listener = listener
+        self._timing = None
         self._disconnected = False
         self._coro = coroutine
 
@@ -114,6 +263,13 @@ class Connection:
         else:
             await self._listener(*args, **kwargs)
 
+    def timing(self) -> metrics.HistogramSeries:
+        """Return the series the listener's latency is recorded in."""
+        if self._timing is None:
+            name = f"{getattr(self._listener, '__module__', '')}.{getattr(self._listener, '__qualname__', '')}"
+            self._timing = _LISTENER_SECONDS.series(name)
+        return self._timing
+
     def disconnect(self):
         """Mark this connection for disconnection from the event"""
         self._disconnected = True
@@ -126,13 +282,20 @@ class Connection:
 class Event:
     """Event callback dispatcher for AsyncIO similar in syntax to RBXScriptSignal."""
 
-    def __init__(self):
+    def __init__(self, name: str = "unnamed", timed: bool = True):
+        self.name = name
+        """Name the event's timings are recorded under."""
+        self.timed = timed
+        """Whether firing the event is timed, for events whose callers time them already."""
         self._connections = []
-        pass
+        self._timing = None
 
     async def fire(self, *args, **kwargs) -> None:
         """Fire the event with the given arguments."""
-        for connection in self._connections:
+        timed = metrics.enabled
+        fired = started = time.perf_counter() if timed else 0
+        each = timed and metrics.time_listeners
+        for connection in list(self._connections):
             if connection.disconnected():
                 self._connections.remove(connection)
             else:
@@ -140,6 +303,14 @@ class Event:
                     await connection.invoke(*args, **kwargs)
                 except Exception:
                     logging.exception("Error occurred while running event callback")
+                if each:
+                    finished = time.perf_counter()
+                    connection.timing().observe(finished - started)
+                    started = finished
+        if timed and self.timed:
+            if self._timing is None:
+                self._timing = _EVENT_SECONDS.series(self.name)
+            self._timing.observe(time.perf_counter() - fired)
 
     def connect(self, listener) -> Connection:
         """Subscribe the coroutine *listener* to this event."""
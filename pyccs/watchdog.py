@@ -0,0 +1,143 @@
+#  Copyright 2020 Jacob Shtabnoy <shtabnoyjacob@scps.net>
+#  This source code file is available under the terms of the ISC License.
+#  If the LICENSE file was not provided, you can find the full text of the license here:
+#  https://opensource.org/licenses/ISC
+"""This module watches the event loop for stalls.
+
+A heartbeat coroutine wakes up every `interval` and records how late it was woken, which is the time the loop spent
+busy with something else. A sampling thread checks the last heartbeat, and when the loop has not come back for longer
+than `threshold` it grabs the stack of the loop's thread while it is still blocked, and logs it along with the packet
+being handled. Both only wake up a few times per `threshold`, so the watchdog can be left on."""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+from collections import deque
+from typing import Dict, Optional
+
+import pyccs.server as server
+from pyccs import metrics
+
+monitor: Optional["Watchdog"] = None
+"""The running Watchdog, if enabled."""
+handling: Dict[asyncio.Task, tuple] = {}
+"""(player, packet) each connection's task is handling, kept while a Watchdog is running. The sampling thread looks
+up the task the loop is running, since other tasks can run while a handler is suspended."""
+
+_LAG = metrics.Histogram("pyccs_event_loop_lag_seconds", "How late the event loop woke up the watchdog heartbeat")
+_ROLLING_LAG = metrics.Gauge("pyccs_event_loop_lag_rolling_seconds", "Recent event loop lag percentiles",
+                             ["quantile"])
+_STALLS = metrics.Counter("pyccs_event_loop_stalls_total", "Times the event loop was blocked for over the threshold")
+
+
+class Watchdog:
+    """Measures event loop lag and logs the stack of whatever blocks the loop for longer than *threshold* seconds.
+
+    If *asyncio_debug* is true the loop's debug mode is turned on too, so asyncio logs every callback slower than the
+    threshold. That is more precise but noticeably slower, so keep it for diagnosing."""
+
+    def __init__(self, threshold: float = 0.1, interval: float = None, window: int = 1200,
+                 asyncio_debug: bool = False):
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.samples = deque(maxlen=window)
+        """Lag of the most recent heartbeats, in seconds."""
+        self.stalls = 0
+        """Number of stalls over the threshold seen so far."""
+        self.asyncio_debug = asyncio_debug
+        self._beat = time.monotonic()
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Start watching the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self.asyncio_debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._sample, name="pyccs-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._task:
+            self._task.cancel()
+
+    def percentiles(self, *quantiles: float) -> dict:
+        """Return the lag at each quantile (0 to 1) of the recent heartbeats, in seconds."""
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {quantile: 0.0 for quantile in quantiles}
+        return {quantile: ordered[min(int(quantile * len(ordered)), len(ordered) - 1)] for quantile in quantiles}
+
+    async def _heartbeat(self):
+        beats = 0
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(now - expected, 0.0)
+            self.samples.append(lag)
+            if lag > self.threshold:
+                server.logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms")
+            if metrics.enabled:
+                _LAG.observe(lag)
+                beats += 1
+                if beats % 20 == 0:
+                    for quantile, value in self.percentiles(0.5, 0.9, 0.99).items():
+                        _ROLLING_LAG.set(value, quantile)
+
+    def _sample(self):
+        reported = None
+        while not self._stopping.wait(self.interval):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked <= self.threshold or reported == beat:
+                continue
+            reported = beat
+            self.stalls += 1
+            if metrics.enabled:
+                _STALLS.inc()
+            context = handling.get(asyncio.current_task(self._loop), None)
+            frame = sys._current_frames().get(self._loop_thread, None)
+            stack = "".join(traceback.format_stack(frame)) if frame else "  (stack unavailable)\n"
+            server.logger.warning(f"Event loop blocked for over {blocked * 1000:.0f}ms {_describe(context)}, "
+                           f"it is currently at:\n{stack.rstrip()}")
+
+
+def _describe(current) -> str:
+    if not current:
+        return "outside of packet handling"
+    player, packet = current
+    return f"while handling packet 0x{packet.packet_id():02x} from {player}"
+
+
+def enable(threshold: float, asyncio_debug: bool = False):
+    """Run a Watchdog with the given threshold in seconds while the server is running."""
+
+    async def start():
+        global monitor
+        monitor = Watchdog(threshold, asyncio_debug=asyncio_debug)
+        monitor.start()
+        server.logger.info(f"Watching for event loop stalls over {threshold * 1000:.0f}ms")
+
+    async def stop():
+        global monitor
+        if monitor:
+            monitor.stop()
+            monitor = None
+        handling.clear()
+
+    server.starting.connect(start)
+    server.shutdown.connect(stop)
@@ -20,6 +20,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=[
         'nbtlib>=1.6.5,<2',
+        'numpy>=1.17',
     ],
     classifiers=[
         "Development Status :: 3 - Alpha",